@@ -5,73 +5,216 @@ Identifica immagini con problemi di ground truth o occlusioni
 """
 
 import os
-import json
+import hashlib
 import numpy as np
 from PIL import Image  # pyright: ignore[reportMissingImports]
 import matplotlib.pyplot as plt  # pyright: ignore[reportMissingImports]
 from pathlib import Path
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from quality_metrics import compute_quality_metrics, compute_label_metrics, load_metrics_table
+from array_store import ArrayStore
 
 # Configurazione
 dataset_name = "Dataset001_Strade"
 raw_data_dir = f"/workspace/nnUNet_raw/{dataset_name}"
 images_dir = os.path.join(raw_data_dir, "imagesTr")
 labels_dir = os.path.join(raw_data_dir, "labelsTr")
+batch_size = 64  # Campioni decodificati e analizzati insieme da ogni worker
+num_workers = os.cpu_count() or 1  # Processi per l'analisi dei PNG (1 = nel processo principale)
 output_dir = "/workspace/risultati/analisi_dataset"
+incremental = True  # Riusa dataset_statistics.npy per i campioni non modificati (dimensione + mtime)
+hash_contents = False  # Salva anche lo SHA-1 dei file: campioni solo "toccati" (mtime diverso) non vengono rianalizzati
+use_store = True  # Legge immagini e label dallo store a shard .npy (se generato) invece di decodificare i PNG
 
 os.makedirs(output_dir, exist_ok=True)
 
-def analyze_sample(img_path, label_path):
-    """Analizza un campione per identificare potenziali problemi"""
-    img = np.array(Image.open(img_path))
-    label = np.array(Image.open(label_path))
-    
-    # Statistiche
-    road_pixels = np.sum(label > 0)
-    total_pixels = label.size
-    road_percentage = road_pixels / total_pixels * 100
-    
-    # Analisi colore immagine (per rilevare vegetazione/ombre)
-    mean_rgb = img.mean(axis=(0, 1))
-    std_rgb = img.std(axis=(0, 1))
-    
-    # Indice di vegetazione semplificato (NDVI-like)
-    # Verde alto + Rosso basso = vegetazione
-    vegetation_index = mean_rgb[1] - mean_rgb[0]  # G - R
-    
-    # Brightness (per rilevare ombre)
-    brightness = mean_rgb.mean()
-    
-    # Texture variance (immagini con alta variance = molti dettagli)
-    texture_variance = img.std()
-    
-    return {
-        'road_percentage': road_percentage,
-        'mean_rgb': mean_rgb.tolist(),
-        'std_rgb': std_rgb.tolist(),
-        'vegetation_index': float(vegetation_index),
-        'brightness': float(brightness),
-        'texture_variance': float(texture_variance),
-        'road_pixels': int(road_pixels)
-    }
+# Tabella statistiche per campione (array strutturato NumPy, una riga per campione)
+# Le colonne img_*/label_* identificano la versione dei file analizzati (cache incrementale)
+STATS_DTYPE = np.dtype([
+    ('filename', 'U64'),
+    ('img_size', 'i8'),
+    ('img_mtime_ns', 'i8'),
+    ('img_hash', 'S40'),
+    ('label_size', 'i8'),
+    ('label_mtime_ns', 'i8'),
+    ('label_hash', 'S40'),
+    ('road_percentage', 'f8'),
+    ('road_pixels', 'i8'),
+    ('vegetation_index', 'f8'),
+    ('brightness', 'f8'),
+    ('texture_variance', 'f8'),
+    ('vegetation', 'f8'),
+    ('black_ratio', 'f8'),
+    ('mean_rgb', 'f8', (3,)),
+    ('std_rgb', 'f8', (3,)),
+])
+METRIC_FIELDS = STATS_DTYPE.names[7:]
 
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
-def identify_problematic_samples():
-    """Identifica campioni potenzialmente problematici"""
-    print("\n" + "="*70)
-    print("🔍 ANALISI CAMPIONI PROBLEMATICI")
-    print("="*70 + "\n")
-    
-    # Lista tutti i campioni
-    label_files = sorted([f for f in os.listdir(labels_dir) if f.endswith('.png')])
-    
-    print(f"📊 Analisi di {len(label_files)} campioni...")
-    
-    results = []
-    
-    for i, label_file in enumerate(label_files, 1):
-        if i % 200 == 0:
-            print(f"  Processati {i}/{len(label_files)}...")
-        
+def compute_sample_metrics(images, labels):
+    """Metriche condivise (quality_metrics) per immagini (N, H, W, 3) e label (N, H, W)"""
+    metrics = compute_quality_metrics(images)
+    metrics.update(compute_label_metrics(labels))
+    return metrics
+
+def analyze_chunk(chunk, with_hash=False):
+    """Analizza un blocco di (nome, immagine, label) in un worker
+    
+    Ogni file viene letto una sola volta: gli stessi byte servono per lo SHA-1
+    (se with_hash) e per la decodifica.
+    
+    Returns:
+        Array strutturato STATS_DTYPE con una riga per campione (senza size/mtime)
+    """
+    rows = np.zeros(len(chunk), dtype=STATS_DTYPE)
+    rows['filename'] = [c[0] for c in chunk]
+    images, labels = [], []
+    for i, (_, img_path, label_path) in enumerate(chunk):
+        for path, decoded, hash_field in ((img_path, images, 'img_hash'), (label_path, labels, 'label_hash')):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if with_hash:
+                rows[hash_field][i] = hashlib.sha1(data).hexdigest()
+            img = Image.open(BytesIO(data))
+            decoded.append(np.array(img.convert('RGB') if decoded is images else img))
+    
+    metrics = compute_sample_metrics(np.stack(images), np.stack(labels))
+    for field in METRIC_FIELDS:
+        rows[field] = metrics[field]
+    return rows
+
+_stores = {}
+
+def analyze_store_chunk(indices, store_dir):
+    """Analizza un blocco di campioni dello store (indici) in un worker, senza decodifica
+    
+    Returns:
+        Array strutturato STATS_DTYPE con una riga per campione (senza size/mtime)
+    """
+    if store_dir not in _stores:
+        _stores[store_dir] = ArrayStore(store_dir)
+    store = _stores[store_dir]
+    rows = np.zeros(len(indices), dtype=STATS_DTYPE)
+    rows['filename'] = [store.names[i] for i in indices]
+    metrics = compute_sample_metrics(*store.take(indices))
+    for field in METRIC_FIELDS:
+        rows[field] = metrics[field]
+    return rows
+
+def table_row(name, metrics, file_stats, fingerprint):
+    """Riga STATS_DTYPE dalla tabella metriche della generazione
+    
+    None se le metriche sono incomplete o se i PNG non sono più quelli scritti dalla
+    generazione (dimensione/mtime diversi da file_stats, o impronta non registrata).
+    Con fingerprint None (store a shard) le metriche valgono sempre: store e journal
+    vengono riscritti insieme.
+    """
+    if any(field not in metrics for field in METRIC_FIELDS):
+        return None
+    if fingerprint is not None:
+        img_size, img_mtime, label_size, label_mtime = (int(v) for v in fingerprint)
+        expected = (file_stats.get(f"imagesTr/{name}_0000.png"), file_stats.get(f"labelsTr/{name}.png"))
+        if expected != ([img_size, img_mtime], [label_size, label_mtime]):
+            return None
+    row = np.zeros((), dtype=STATS_DTYPE)
+    row['filename'] = name
+    for field in METRIC_FIELDS:
+        row[field] = metrics[field]
+    return row
+
+def load_stats_cache(stats_path):
+    """Statistiche dell'analisi precedente (cache incrementale)
+    
+    Returns:
+        (array STATS_DTYPE in sola lettura, dict nome → riga) oppure (None, {})
+    """
+    if not incremental or not os.path.exists(stats_path):
+        return None, {}
+    try:
+        cache = np.load(stats_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None, {}
+    if cache.dtype != STATS_DTYPE:
+        return None, {}  # File di una versione precedente: si ricalcola tutto
+    return cache, {name: j for j, name in enumerate(cache['filename'])}
+
+def cached_row(cached, fingerprint, img_path, label_path, with_hash=False):
+    """Riga della cache ancora valida per i file attuali, oppure None
+    
+    Valida se dimensione e mtime coincidono; con with_hash anche se cambia solo
+    l'mtime ma il contenuto (SHA-1) è lo stesso.
+    """
+    img_size, img_mtime, label_size, label_mtime = fingerprint
+    if cached['img_size'] != img_size or cached['label_size'] != label_size:
+        return None
+    if cached['img_mtime_ns'] == img_mtime and cached['label_mtime_ns'] == label_mtime:
+        return cached
+    if with_hash and cached['img_hash'] and cached['label_hash']:
+        if (cached['img_hash'].decode() == file_sha1(img_path)
+                and cached['label_hash'].decode() == file_sha1(label_path)):
+            return cached
+    return None
+
+def partition_percentile(values, q):
+    """Percentile q (interpolazione lineare, come np.percentile) con np.partition"""
+    pos = (len(values) - 1) * q / 100
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, len(values) - 1)
+    part = np.partition(values, [lo, hi])
+    return part[lo] + (part[hi] - part[lo]) * (pos - lo)
+
+def top_k(values, candidates, k, largest=True):
+    """Indici dei k valori estremi tra `candidates` (ordinati, a parità vince l'indice minore)"""
+    subset = values[candidates]
+    keys = -subset if largest else subset
+    if len(candidates) > k:
+        # Tutti i pari merito del k-esimo, così l'ordinamento finale resta stabile
+        kth = np.partition(keys, k - 1)[k - 1]
+        keep = np.flatnonzero(keys <= kth)
+    else:
+        keep = np.arange(len(candidates))
+    order = np.lexsort((candidates[keep], keys[keep]))[:k]
+    return candidates[keep][order]
+
+
+def collect_statistics(stats_path):
+    """Calcola le statistiche di tutti i campioni e le scrive in stats_path (.npy)
+    
+    Ordine delle fonti per ogni campione: riga della analisi precedente se i file
+    non sono cambiati (cache incrementale); per i campioni mai analizzati, riga della
+    tabella metriche della generazione se i file sono ancora quelli generati;
+    altrimenti (file nuovi o modificati) analisi a blocchi su un pool di processi
+    (viste dello store a shard se presente, altrimenti decodifica dei PNG). I
+    blocchi arrivano in ordine e sono scritti subito nel file mappato in memoria,
+    quindi la memoria non cresce con il numero di campioni; il file nuovo sostituisce
+    il vecchio solo a fine analisi (rename atomico).
+    
+    Returns:
+        Array strutturato STATS_DTYPE (memmap) ordinato per nome file
+    """
+    store = ArrayStore.open(raw_data_dir) if use_store else None
+    samples = []
+    fingerprints = []
+    if store is not None:
+        # Lo store è solo in append per generazione: posizione + istante di creazione
+        # identificano il contenuto al posto di dimensione + mtime dei PNG
+        print(f"📊 Analisi di {len(store)} campioni (store {store.store_dir})...")
+        for i in sorted(range(len(store)), key=lambda i: store.names[i]):
+            samples.append((store.names[i], i, None))
+            fingerprints.append((i, store.created_ns, i, store.created_ns))
+        label_files = []
+    else:
+        # Lista tutti i campioni
+        label_files = sorted([f for f in os.listdir(labels_dir) if f.endswith('.png')])
+        print(f"📊 Analisi di {len(label_files)} campioni...")
+    
+    for label_file in label_files:
         base_name = label_file.replace('.png', '')
         img_file = base_name + '_0000.png'
         
@@ -80,20 +223,103 @@ def identify_problematic_samples():
         
         if not os.path.exists(img_path):
             continue
-        
-        stats = analyze_sample(img_path, label_path)
-        stats['filename'] = base_name
-        results.append(stats)
+        img_stat, label_stat = os.stat(img_path), os.stat(label_path)
+        samples.append((base_name, img_path, label_path))
+        fingerprints.append((img_stat.st_size, img_stat.st_mtime_ns, label_stat.st_size, label_stat.st_mtime_ns))
+    fingerprints = np.array(fingerprints, dtype=np.int64).reshape(-1, 4)
+    
+    cache, cache_index = load_stats_cache(stats_path)
+    # Metriche salvate da made_dataset.py durante la generazione: nessun PNG da decodificare
+    table = load_metrics_table(raw_data_dir) or {}
+    
+    tmp_path = f"{stats_path}.tmp"
+    stats = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=STATS_DTYPE, shape=(len(samples),))
+    
+    # Campioni nuovi o modificati: decodifica e analisi a blocchi
+    to_compute = []
+    from_cache = 0
+    from_table = 0
+    for i, (base_name, img_path, label_path) in enumerate(samples):
+        j = cache_index.get(base_name)
+        row = cached_row(cache[j], fingerprints[i], img_path, label_path,
+                         with_hash=hash_contents and store is None) if j is not None else None
+        if row is not None:
+            stats[i] = row
+            from_cache += 1
+            continue
+        if j is not None or base_name not in table:
+            # Già analizzato ma cambiato (o assente dal journal): nuova analisi
+            to_compute.append(i)
+            continue
+        row = table_row(base_name, *table[base_name], None if store is not None else fingerprints[i])
+        if row is not None:
+            if hash_contents and store is None:
+                row['img_hash'] = file_sha1(img_path)
+                row['label_hash'] = file_sha1(label_path)
+            stats[i] = row
+            from_table += 1
+        else:
+            to_compute.append(i)
+    del table, cache_index
+    
+    if from_cache:
+        print(f"  ♻️  {from_cache} campioni invariati letti dalla cache ({os.path.basename(stats_path)})")
+    if from_table:
+        print(f"  {from_table} campioni letti dalla tabella metriche della generazione")
+    
+    chunks = [to_compute[start:start + batch_size] for start in range(0, len(to_compute), batch_size)]
+    if store is not None:
+        jobs = ([samples[i][1] for i in chunk] for chunk in chunks)
+        analyze = partial(analyze_store_chunk, store_dir=store.store_dir)
+    else:
+        jobs = ([samples[i] for i in chunk] for chunk in chunks)
+        analyze = partial(analyze_chunk, with_hash=hash_contents)
+    if num_workers > 1 and len(chunks) > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(analyze, jobs)
+    else:
+        executor = None
+        results = map(analyze, jobs)
+    
+    try:
+        done = 0
+        for chunk, rows in zip(chunks, results):
+            stats[chunk] = rows
+            done += len(chunk)
+            if done % (batch_size * 10) < batch_size or done == len(to_compute):
+                print(f"  Processati {done}/{len(to_compute)}...")
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    # Impronte dei file analizzati (per la prossima esecuzione incrementale)
+    for k, field in enumerate(('img_size', 'img_mtime_ns', 'label_size', 'label_mtime_ns')):
+        stats[field] = fingerprints[:, k]
+    stats.flush()
+    del cache
+    os.replace(tmp_path, stats_path)
+    return stats
+
+
+def identify_problematic_samples():
+    """Identifica campioni potenzialmente problematici"""
+    print("\n" + "="*70)
+    print("🔍 ANALISI CAMPIONI PROBLEMATICI")
+    print("="*70 + "\n")
+    
+    stats_file = os.path.join(output_dir, "dataset_statistics.npy")
+    stats = collect_statistics(stats_file)
     
     print(f"✓ Analisi completata!\n")
     
-    # Converti in array per analisi
-    results_array = np.array([(
-        r['road_percentage'],
-        r['vegetation_index'],
-        r['brightness'],
-        r['texture_variance']
-    ) for r in results])
+    if len(stats) == 0:
+        print("⚠️  Nessun campione da analizzare")
+        return stats
+    
+    filenames = stats['filename']
+    road_percentage = np.asarray(stats['road_percentage'])
+    vegetation_index = np.asarray(stats['vegetation_index'])
+    brightness = np.asarray(stats['brightness'])
     
     # Identifica categorie problematiche
     print("="*70)
@@ -101,55 +327,48 @@ def identify_problematic_samples():
     print("="*70 + "\n")
     
     # 1. Campioni con TROPPA vegetazione (probabile occlusione)
-    vegetation_threshold = np.percentile([r['vegetation_index'] for r in results], 75)
-    high_vegetation = [r for r in results if r['vegetation_index'] > vegetation_threshold and r['road_percentage'] > 5]
+    vegetation_threshold = partition_percentile(vegetation_index, 75)
+    high_vegetation = np.flatnonzero((vegetation_index > vegetation_threshold) & (road_percentage > 5))
     
     print(f"🌳 Alta vegetazione (possibili occlusioni): {len(high_vegetation)} campioni")
     print(f"   Threshold: vegetation_index > {vegetation_threshold:.2f}")
     if len(high_vegetation) > 0:
         print(f"   Top 5 peggiori:")
-        sorted_veg = sorted(high_vegetation, key=lambda x: x['vegetation_index'], reverse=True)[:5]
-        for r in sorted_veg:
-            print(f"     - {r['filename']}: veg_idx={r['vegetation_index']:.2f}, strada={r['road_percentage']:.1f}%")
+        for i in top_k(vegetation_index, high_vegetation, 5, largest=True):
+            print(f"     - {filenames[i]}: veg_idx={vegetation_index[i]:.2f}, strada={road_percentage[i]:.1f}%")
     
     # 2. Campioni con POCHE strade (possibile GT incompleto o zona errata)
-    low_road = [r for r in results if r['road_percentage'] < 2]
+    low_road = np.flatnonzero(road_percentage < 2)
     print(f"\n🛣️  Poche strade (< 2% pixel): {len(low_road)} campioni")
     if len(low_road) > 0:
         print(f"   Top 5 con meno strade:")
-        sorted_road = sorted(low_road, key=lambda x: x['road_percentage'])[:5]
-        for r in sorted_road:
-            print(f"     - {r['filename']}: {r['road_percentage']:.2f}% strade")
+        for i in top_k(road_percentage, low_road, 5, largest=False):
+            print(f"     - {filenames[i]}: {road_percentage[i]:.2f}% strade")
     
     # 3. Campioni molto scuri (ombre, sera, nuvole)
-    dark_threshold = np.percentile([r['brightness'] for r in results], 25)
-    dark_samples = [r for r in results if r['brightness'] < dark_threshold]
+    dark_threshold = partition_percentile(brightness, 25)
+    dark_samples = np.flatnonzero(brightness < dark_threshold)
     print(f"\n🌑 Immagini scure (possibili ombre/nuvole): {len(dark_samples)} campioni")
     print(f"   Threshold: brightness < {dark_threshold:.2f}")
     
     # 4. Campioni con MOLTE strade (potenziale area urbana complessa)
-    high_road = [r for r in results if r['road_percentage'] > 15]
+    high_road = np.flatnonzero(road_percentage > 15)
     print(f"\n🏙️  Molte strade (> 15% pixel, aree urbane dense): {len(high_road)} campioni")
     if len(high_road) > 0:
         print(f"   Top 5 con più strade:")
-        sorted_high = sorted(high_road, key=lambda x: x['road_percentage'], reverse=True)[:5]
-        for r in sorted_high:
-            print(f"     - {r['filename']}: {r['road_percentage']:.1f}% strade")
-    
-    # Salva statistiche complete
-    stats_file = os.path.join(output_dir, "dataset_statistics.json")
-    with open(stats_file, 'w') as f:
-        json.dump(results, f, indent=2)
+        for i in top_k(road_percentage, high_road, 5, largest=True):
+            print(f"     - {filenames[i]}: {road_percentage[i]:.1f}% strade")
+    
     print(f"\n💾 Statistiche complete salvate in: {stats_file}")
     
     # Crea visualizzazione distribuzione
-    create_distribution_plots(results)
+    create_distribution_plots(stats)
     
     # Genera lista campioni da rivedere manualmente
     samples_to_check = set()
-    samples_to_check.update([r['filename'] for r in high_vegetation[:20]])  # Top 20 vegetazione
-    samples_to_check.update([r['filename'] for r in low_road[:20]])  # Top 20 poche strade
-    samples_to_check.update([r['filename'] for r in dark_samples[:20]])  # Top 20 scure
+    samples_to_check.update(filenames[high_vegetation[:20]].tolist())  # Top 20 vegetazione
+    samples_to_check.update(filenames[low_road[:20]].tolist())  # Top 20 poche strade
+    samples_to_check.update(filenames[dark_samples[:20]].tolist())  # Top 20 scure
     
     check_file = os.path.join(output_dir, "samples_to_review.txt")
     with open(check_file, 'w') as f:
@@ -160,49 +379,49 @@ def identify_problematic_samples():
     
     print(f"📝 Lista {len(samples_to_check)} campioni da rivedere: {check_file}")
     
-    return results
+    return stats
 
 
 def create_distribution_plots(results):
-    """Crea grafici di distribuzione delle statistiche"""
+    """Crea grafici di distribuzione delle statistiche (array strutturato STATS_DTYPE)"""
     fig, axes = plt.subplots(2, 3, figsize=(18, 10))
     fig.suptitle('Distribuzione Statistiche Dataset', fontsize=16, fontweight='bold')
     
     # 1. Percentuale strade
-    axes[0, 0].hist([r['road_percentage'] for r in results], bins=50, color='blue', alpha=0.7, edgecolor='black')
+    axes[0, 0].hist(results['road_percentage'], bins=50, color='blue', alpha=0.7, edgecolor='black')
     axes[0, 0].set_xlabel('Percentuale strade (%)')
     axes[0, 0].set_ylabel('Numero campioni')
     axes[0, 0].set_title('Distribuzione Strade')
-    axes[0, 0].axvline(np.median([r['road_percentage'] for r in results]), color='red', linestyle='--', label='Mediana')
+    axes[0, 0].axvline(np.median(results['road_percentage']), color='red', linestyle='--', label='Mediana')
     axes[0, 0].legend()
     
     # 2. Indice vegetazione
-    axes[0, 1].hist([r['vegetation_index'] for r in results], bins=50, color='green', alpha=0.7, edgecolor='black')
+    axes[0, 1].hist(results['vegetation_index'], bins=50, color='green', alpha=0.7, edgecolor='black')
     axes[0, 1].set_xlabel('Indice Vegetazione (G-R)')
     axes[0, 1].set_ylabel('Numero campioni')
     axes[0, 1].set_title('Distribuzione Vegetazione')
-    axes[0, 1].axvline(np.median([r['vegetation_index'] for r in results]), color='red', linestyle='--', label='Mediana')
+    axes[0, 1].axvline(np.median(results['vegetation_index']), color='red', linestyle='--', label='Mediana')
     axes[0, 1].legend()
     
     # 3. Brightness
-    axes[0, 2].hist([r['brightness'] for r in results], bins=50, color='orange', alpha=0.7, edgecolor='black')
+    axes[0, 2].hist(results['brightness'], bins=50, color='orange', alpha=0.7, edgecolor='black')
     axes[0, 2].set_xlabel('Brightness (media RGB)')
     axes[0, 2].set_ylabel('Numero campioni')
     axes[0, 2].set_title('Distribuzione Luminosità')
-    axes[0, 2].axvline(np.median([r['brightness'] for r in results]), color='red', linestyle='--', label='Mediana')
+    axes[0, 2].axvline(np.median(results['brightness']), color='red', linestyle='--', label='Mediana')
     axes[0, 2].legend()
     
     # 4. Texture variance
-    axes[1, 0].hist([r['texture_variance'] for r in results], bins=50, color='purple', alpha=0.7, edgecolor='black')
+    axes[1, 0].hist(results['texture_variance'], bins=50, color='purple', alpha=0.7, edgecolor='black')
     axes[1, 0].set_xlabel('Varianza Texture')
     axes[1, 0].set_ylabel('Numero campioni')
     axes[1, 0].set_title('Distribuzione Texture')
-    axes[1, 0].axvline(np.median([r['texture_variance'] for r in results]), color='red', linestyle='--', label='Mediana')
+    axes[1, 0].axvline(np.median(results['texture_variance']), color='red', linestyle='--', label='Mediana')
     axes[1, 0].legend()
     
     # 5. Scatter: Vegetazione vs Strade
-    axes[1, 1].scatter([r['vegetation_index'] for r in results], 
-                       [r['road_percentage'] for r in results], 
+    axes[1, 1].scatter(results['vegetation_index'], 
+                       results['road_percentage'], 
                        alpha=0.5, s=10, color='green')
     axes[1, 1].set_xlabel('Indice Vegetazione')
     axes[1, 1].set_ylabel('Percentuale Strade (%)')
@@ -210,8 +429,8 @@ def create_distribution_plots(results):
     axes[1, 1].grid(True, alpha=0.3)
     
     # 6. Scatter: Brightness vs Strade
-    axes[1, 2].scatter([r['brightness'] for r in results], 
-                       [r['road_percentage'] for r in results], 
+    axes[1, 2].scatter(results['brightness'], 
+                       results['road_percentage'], 
                        alpha=0.5, s=10, color='orange')
     axes[1, 2].set_xlabel('Brightness')
     axes[1, 2].set_ylabel('Percentuale Strade (%)')
@@ -233,7 +452,7 @@ if __name__ == "__main__":
     print("✅ ANALISI COMPLETATA")
     print("="*70)
     print(f"\n📁 Risultati salvati in: {output_dir}/")
-    print("   - dataset_statistics.json (statistiche complete)")
+    print("   - dataset_statistics.npy (statistiche complete, np.load)")
     print("   - dataset_distributions.png (grafici)")
     print("   - samples_to_review.txt (campioni da controllare)")
     print()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Archivio del dataset in shard .npy memory-mapped
+Immagini (N, H, W, 3) uint8 e label (N, H, W) uint8 in shard di dimensione fissa più un
+indice JSON con i nomi dei campioni: i consumatori (analisi, visualizzazione, test)
+leggono viste zero-copy invece di aprire e decodificare un PNG per file. I PNG di
+imagesTr/labelsTr restano la vista di compatibilità per nnU-Net (export_png_view).
+
+Struttura in <dataset_dir>/store/:
+    index.json           shard_size, forme, numero di campioni e nomi in ordine
+    images_00000.npy     (shard_size, H, W, 3) uint8
+    labels_00000.npy     (shard_size, H, W) uint8
+"""
+
+import os
+import json
+import time
+import numpy as np
+from io import BytesIO
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+from generation_journal import atomic_write_bytes
+
+STORE_DIR = "store"
+INDEX_FILE = "index.json"
+
+
+def store_dir_for(dataset_dir):
+    return os.path.join(dataset_dir, STORE_DIR)
+
+
+def _shard_paths(store_dir, shard):
+    return (os.path.join(store_dir, f"images_{shard:05d}.npy"),
+            os.path.join(store_dir, f"labels_{shard:05d}.npy"))
+
+
+class ArrayStore:
+    """Lettura zero-copy di un archivio a shard (memmap in sola lettura, aperti al primo uso)
+
+    Args:
+        store_dir: Cartella dell'archivio (con index.json)
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        self.shard_size = index['shard_size']
+        self.image_shape = tuple(index['image_shape'])
+        self.label_shape = tuple(index['label_shape'])
+        self.created_ns = index['created_ns']
+        self.names = index['names'][:index['count']]
+        self._positions = {name: i for i, name in enumerate(self.names)}
+        self._shards = {}
+
+    @classmethod
+    def open(cls, dataset_dir):
+        """Archivio del dataset, oppure None se la generazione non l'ha prodotto"""
+        store_dir = store_dir_for(dataset_dir)
+        if not os.path.exists(os.path.join(store_dir, INDEX_FILE)):
+            return None
+        return cls(store_dir)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def index_of(self, name):
+        return self._positions[name]
+
+    def shard(self, shard):
+        """(immagini, label) memmap dello shard, limitati ai campioni validi"""
+        if shard not in self._shards:
+            image_path, label_path = _shard_paths(self.store_dir, shard)
+            count = min(self.shard_size, len(self.names) - shard * self.shard_size)
+            self._shards[shard] = (np.load(image_path, mmap_mode='r')[:count],
+                                   np.load(label_path, mmap_mode='r')[:count])
+        return self._shards[shard]
+
+    def get(self, key):
+        """(immagine (H, W, 3), label (H, W)) di un campione per indice o nome (viste in sola lettura)"""
+        i = self._positions[key] if isinstance(key, str) else key
+        if not 0 <= i < len(self.names):
+            raise IndexError(f"Campione {key} non presente nell'archivio")
+        images, labels = self.shard(i // self.shard_size)
+        return images[i % self.shard_size], labels[i % self.shard_size]
+
+    def take(self, indices):
+        """Batch (immagini (N, H, W, 3), label (N, H, W)) per indici
+
+        Viste zero-copy se gli indici sono consecutivi nello stesso shard, altrimenti copia.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and np.all(np.diff(indices) == 1) \
+                and indices[0] // self.shard_size == indices[-1] // self.shard_size:
+            images, labels = self.shard(int(indices[0] // self.shard_size))
+            offset = int(indices[0] % self.shard_size)
+            return images[offset:offset + len(indices)], labels[offset:offset + len(indices)]
+        images = np.empty((len(indices), *self.image_shape), dtype=np.uint8)
+        labels = np.empty((len(indices), *self.label_shape), dtype=np.uint8)
+        shards = indices // self.shard_size
+        for shard in np.unique(shards):
+            sel = np.flatnonzero(shards == shard)
+            shard_images, shard_labels = self.shard(int(shard))
+            offsets = indices[sel] % self.shard_size
+            images[sel] = shard_images[offsets]
+            labels[sel] = shard_labels[offsets]
+        return images, labels
+
+    def iter_batches(self, batch_size=64):
+        """Batch consecutivi (inizio, nomi, immagini, label) come viste zero-copy (mai a cavallo di due shard)"""
+        for start in range(0, len(self.names), batch_size):
+            shard, offset = divmod(start, self.shard_size)
+            stop = min(start + batch_size, (shard + 1) * self.shard_size, len(self.names))
+            images, labels = self.shard(shard)
+            yield start, self.names[start:stop], images[offset:offset + stop - start], labels[offset:offset + stop - start]
+
+
+class ArrayStoreWriter:
+    """Scrittura in ordine dei campioni accettati negli shard dell'archivio
+
+    Gli shard sono creati pieni (shard_size campioni) e riempiti in place; index.json
+    viene riscritto in modo atomico alla creazione, a ogni shard completato e alla
+    chiusura. Usato dal writer in background di made_dataset.py prima di registrare la
+    patch nel journal: ogni patch nel journal è quindi già negli shard e alla ripresa
+    resume() tronca l'archivio alle patch confermate.
+
+    Args:
+        store_dir: Cartella dell'archivio
+        image_shape: Forma di un'immagine (H, W, 3)
+        label_shape: Forma di una label (H, W)
+        shard_size: Campioni per shard
+    """
+
+    def __init__(self, store_dir, image_shape, label_shape, shard_size=256):
+        self.store_dir = store_dir
+        self.image_shape = tuple(image_shape)
+        self.label_shape = tuple(label_shape)
+        self.shard_size = shard_size
+        self.index_path = os.path.join(store_dir, INDEX_FILE)
+        self.names = []
+        self.created_ns = time.time_ns()
+        self._shard = None
+        self._images = self._labels = None
+
+    def reset(self):
+        """Archivio vuoto (run da zero): elimina shard e indice esistenti"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        for f in os.listdir(self.store_dir):
+            if f == INDEX_FILE or (f.endswith('.npy') and f.split('_')[0] in ('images', 'labels')):
+                os.remove(os.path.join(self.store_dir, f))
+        self.names = []
+        self.created_ns = time.time_ns()
+        self._write_index()
+
+    def resume(self, names):
+        """Riprende dopo le patch confermate dal journal (nell'ordine degli indici)
+
+        Senza patch confermate (run nuovo o journal azzerato) l'archivio riparte da
+        zero con reset(): shard nuovi e nuovo created_ns, così la cache di
+        analyze_problematic_samples.py non riusa statistiche del run precedente.
+
+        Raises:
+            ValueError: se l'archivio manca o ha forme/shard diversi dalla configurazione
+        """
+        if not names:
+            self.reset()
+            return
+        if not os.path.exists(self.index_path):
+            raise ValueError(
+                f"Archivio {self.store_dir} assente ma il journal ha {len(names)} patch: "
+                f"ricostruirlo dai PNG con 'python array_store.py build'"
+            )
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if (index['shard_size'] != self.shard_size or tuple(index['image_shape']) != self.image_shape
+                or tuple(index['label_shape']) != self.label_shape):
+            raise ValueError(f"Archivio {self.store_dir} scritto con shard o dimensioni diverse")
+        self.names = list(names)
+        self.created_ns = index['created_ns']
+        self._write_index()
+
+    def _open_shard(self, shard):
+        self._close_shard()
+        image_path, label_path = _shard_paths(self.store_dir, shard)
+        if os.path.exists(image_path) and os.path.exists(label_path):
+            self._images = np.load(image_path, mmap_mode='r+')
+            self._labels = np.load(label_path, mmap_mode='r+')
+        else:
+            self._images = np.lib.format.open_memmap(image_path, mode='w+', dtype=np.uint8,
+                                                     shape=(self.shard_size, *self.image_shape))
+            self._labels = np.lib.format.open_memmap(label_path, mode='w+', dtype=np.uint8,
+                                                     shape=(self.shard_size, *self.label_shape))
+        self._shard = shard
+
+    def _close_shard(self):
+        if self._images is not None:
+            self._images.flush()
+            self._labels.flush()
+        self._images = self._labels = None
+        self._shard = None
+
+    def _write_index(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        index = {
+            'shard_size': self.shard_size,
+            'image_shape': list(self.image_shape),
+            'label_shape': list(self.label_shape),
+            'dtype': 'uint8',
+            'created_ns': self.created_ns,
+            'count': len(self.names),
+            'names': self.names,
+        }
+        atomic_write_bytes(self.index_path, json.dumps(index).encode())
+
+    def append(self, index, name, image, label):
+        """Scrive il campione `index` (deve essere il successivo all'ultimo scritto)"""
+        if index != len(self.names):
+            raise ValueError(f"Campione {index} fuori ordine: l'archivio ne contiene {len(self.names)}")
+        shard, offset = divmod(index, self.shard_size)
+        if shard != self._shard:
+            self._open_shard(shard)
+        self._images[offset] = image
+        self._labels[offset] = label
+        self.names.append(name)
+        if offset == self.shard_size - 1:
+            self._close_shard()
+            self._write_index()
+
+    def close(self):
+        self._close_shard()
+        self._write_index()
+
+
+def build_from_png(images_dir, labels_dir, store_dir, shard_size=256):
+    """Costruisce l'archivio da un dataset PNG esistente (imagesTr/labelsTr)
+
+    Returns:
+        Numero di campioni scritti
+    """
+    names = sorted(f[:-len('_0000.png')] for f in os.listdir(images_dir) if f.endswith('_0000.png'))
+    names = [n for n in names if os.path.exists(os.path.join(labels_dir, f"{n}.png"))]
+    writer = None
+    for i, name in enumerate(names):
+        image = np.array(Image.open(os.path.join(images_dir, f"{name}_0000.png")).convert('RGB'))
+        label = np.array(Image.open(os.path.join(labels_dir, f"{name}.png")))
+        if writer is None:
+            writer = ArrayStoreWriter(store_dir, image.shape, label.shape, shard_size)
+            writer.reset()
+        writer.append(i, name, image, label)
+    if writer is not None:
+        writer.close()
+    return len(names)
+
+
+def export_png_view(store, images_dir, labels_dir, labels_viz_dir=None, compress_level=6, overwrite=False):
+    """Scrive i PNG per nnU-Net (imagesTr/labelsTr, opzionale labelsTr_viz) dall'archivio
+
+    Returns:
+        Numero di campioni esportati
+    """
+    for d in (images_dir, labels_dir, labels_viz_dir):
+        if d:
+            os.makedirs(d, exist_ok=True)
+
+    def save(array, path):
+        if overwrite or not os.path.exists(path):
+            buf = BytesIO()
+            Image.fromarray(np.asarray(array)).save(buf, format='PNG', compress_level=compress_level)
+            atomic_write_bytes(path, buf.getvalue())
+
+    for _, names, images, labels in store.iter_batches():
+        for name, image, label in zip(names, images, labels):
+            save(image, os.path.join(images_dir, f"{name}_0000.png"))
+            save(label, os.path.join(labels_dir, f"{name}.png"))
+            if labels_viz_dir:
+                save(label * np.uint8(255), os.path.join(labels_viz_dir, f"{name}.png"))
+    return len(store)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Archivio .npy a shard del dataset')
+    parser.add_argument('command', choices=['build', 'export', 'info'],
+                        help='build: PNG → archivio, export: archivio → PNG per nnU-Net, info: riepilogo')
+    parser.add_argument('--dataset-dir', type=str, default="/workspace/nnUNet_raw/Dataset001_Strade")
+    parser.add_argument('--shard-size', type=int, default=256, help='Campioni per shard (build)')
+    parser.add_argument('--overwrite', action='store_true', help='Riscrive i PNG già presenti (export)')
+    args = parser.parse_args()
+
+    images_dir = os.path.join(args.dataset_dir, "imagesTr")
+    labels_dir = os.path.join(args.dataset_dir, "labelsTr")
+    if args.command == 'build':
+        n = build_from_png(images_dir, labels_dir, store_dir_for(args.dataset_dir), args.shard_size)
+        print(f"✓ Archivio creato: {n} campioni in {store_dir_for(args.dataset_dir)}")
+    else:
+        store = ArrayStore.open(args.dataset_dir)
+        if store is None:
+            print(f"❌ Nessun archivio in {store_dir_for(args.dataset_dir)}")
+        elif args.command == 'export':
+            n = export_png_view(store, images_dir, labels_dir, os.path.join(args.dataset_dir, "labelsTr_viz"),
+                                overwrite=args.overwrite)
+            print(f"✓ Esportati {n} campioni in {images_dir} e {labels_dir}")
+        else:
+            n_shards = -(-len(store) // store.shard_size)
+            print(f"📦 {len(store)} campioni in {n_shards} shard da {store.shard_size} "
+                  f"(immagini {store.image_shape}, label {store.label_shape})")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark dei backend di inferenza CPU sul validation set di un fold
+Confronta il predittore nnU-Net di riferimento (PyTorch, pipeline di nnU-Net) con la
+sliding window in batch in PyTorch e con ONNX Runtime fp32 e int8: immagini/s e
+differenza di Dice (rispetto al riferimento e rispetto alla ground truth)
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+from nnunet_inference import RoadPredictor, model_dir_for
+from sliding_window import load_rgb
+from onnx_inference import (OnnxRoadPredictor, export_onnx, quantize_onnx, onnx_dir_for,
+                            MODEL_FILE, MODEL_INT8_FILE)
+from test_predictions import confusion_counts, metrics_from_counts
+
+# === CONFIGURAZIONE ===
+dataset_name = "Dataset001_Strade"
+fold = 0
+checkpoint = 'checkpoint_final.pth'
+model_dir = model_dir_for(dataset_name)
+raw_data_dir = f"/workspace/nnUNet_raw/{dataset_name}"
+images_dir = os.path.join(raw_data_dir, "imagesTr")
+labels_dir = os.path.join(raw_data_dir, "labelsTr")
+splits_file = f"/workspace/nnUNet_preprocessed/{dataset_name}/splits_final.json"
+
+WARMUP = 2  # Immagini predette e scartate prima di misurare
+
+
+def validation_cases(num_images=None):
+    """Casi del validation set del fold (splits_final.json, altrimenti cartella validation)"""
+    if os.path.exists(splits_file):
+        with open(splits_file, 'r') as f:
+            cases = sorted(json.load(f)[fold]['val'])
+    else:
+        val_dir = os.path.join(model_dir, f"fold_{fold}", "validation")
+        cases = sorted(f[:-4] for f in os.listdir(val_dir) if f.endswith('.png'))
+    return cases[:num_images] if num_images else cases
+
+
+def calibration_images(exclude, count):
+    """Primi `count` casi di training fuori dal validation set (per la quantizzazione statica)"""
+    names = sorted(f for f in os.listdir(images_dir) if f.endswith('_0000.png'))
+    names = [n for n in names if n.replace('_0000.png', '') not in exclude]
+    return [os.path.join(images_dir, n) for n in names[:count]]
+
+
+def run_backend(predict_batch, images, batch_size):
+    """Predice tutte le immagini con predict_batch(lista) e restituisce (maschere, immagini/s)"""
+    predict_batch(images[:WARMUP])
+    start = time.perf_counter()
+    masks = []
+    for i in range(0, len(images), batch_size):
+        masks.extend(predict_batch(images[i:i + batch_size]))
+    elapsed = time.perf_counter() - start
+    return masks, len(images) / elapsed
+
+
+def dice(masks, references):
+    """Dice micro (matrice di confusione accumulata) tra due liste di maschere"""
+    counts = np.zeros(4, dtype=np.int64)
+    for mask, ref in zip(masks, references):
+        counts += confusion_counts(mask, ref)
+    return metrics_from_counts(counts)['dice']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark inferenza CPU (PyTorch vs ONNX Runtime fp32/int8)')
+    parser.add_argument('--images', type=int, default=50, help='Immagini del validation set (0 = tutte)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[0],
+                        help='Thread intra-op da provare (0 = default di ONNX Runtime)')
+    parser.add_argument('--batch-size', type=int, default=4, help='Immagini per chiamata a predict_batch e finestre per forward')
+    parser.add_argument('--mirroring', action='store_true', help='Test-time mirroring (tutti i backend)')
+    parser.add_argument('--calibration', type=int, default=0,
+                        help='Immagini per la quantizzazione statica (0 = quantizzazione dinamica)')
+    parser.add_argument('--reexport', action='store_true', help='Riesporta ONNX e int8 anche se presenti')
+    parser.add_argument('--no-reference', action='store_true', help='Salta il predittore PyTorch')
+    args = parser.parse_args()
+
+    cases = validation_cases(args.images or None)
+    print("\n" + "="*60)
+    print("⏱️  BENCHMARK INFERENZA CPU")
+    print("="*60)
+    print(f"Fold {fold}: {len(cases)} immagini di validazione, mirroring: {'sì' if args.mirroring else 'no'}\n")
+
+    images = [load_rgb(os.path.join(images_dir, f"{case}_0000.png")) for case in cases]
+    gt = [(np.asarray(Image.open(os.path.join(labels_dir, f"{case}.png"))) > 0).astype(np.uint8)
+          for case in cases]
+
+    onnx_dir = onnx_dir_for(model_dir, fold)
+    if args.reexport or not os.path.exists(os.path.join(onnx_dir, MODEL_FILE)):
+        print("📦 Export ONNX...")
+        export_onnx(model_dir, fold, checkpoint, onnx_dir)
+    if args.reexport or not os.path.exists(os.path.join(onnx_dir, MODEL_INT8_FILE)):
+        mode = f"statica, {args.calibration} immagini" if args.calibration else "dinamica"
+        print(f"📦 Quantizzazione int8 ({mode})...")
+        quantize_onnx(onnx_dir, calibration_images(set(cases), args.calibration) if args.calibration else None)
+
+    rows = []
+    reference = None
+    if not args.no_reference:
+        predictor = RoadPredictor(model_dir, (fold,), checkpoint, device='cpu', use_mirroring=args.mirroring,
+                                  batch_size=args.batch_size)
+        # Riferimento: pipeline di nnU-Net (predict_single_npy_array), un'immagine alla volta
+        reference, speed = run_backend(lambda batch: [predictor.predict_mask(img) for img in batch],
+                                       images, args.batch_size)
+        rows.append(("pytorch", "-", speed, dice(reference, gt), None))
+        # Sliding window in batch di sliding_window.py (la stessa dei backend ONNX)
+        masks, speed = run_backend(predictor.predict_batch, images, args.batch_size)
+        rows.append(("pt-batch", "-", speed, dice(masks, gt), dice(masks, reference)))
+        del predictor
+
+    for threads in args.threads:
+        for quantized in (False, True):
+            predictor = OnnxRoadPredictor(onnx_dir, quantized=quantized, intra_op_threads=threads or None,
+                                          batch_size=args.batch_size, use_mirroring=args.mirroring)
+            masks, speed = run_backend(predictor.predict_batch, images, args.batch_size)
+            label = "onnx-int8" if quantized else "onnx-fp32"
+            rows.append((label, str(threads or "auto"), speed, dice(masks, gt),
+                         dice(masks, reference) if reference is not None else None))
+            del predictor
+
+    ref_speed = rows[0][2] if reference is not None else None
+    ref_dice = rows[0][3] if reference is not None else None
+    print(f"{'Backend':>10} {'Thread':>7} {'Img/s':>8} {'Speedup':>8} {'Dice GT':>8} {'ΔDice':>8} {'Dice rif':>9}")
+    print("─" * 60)
+    for row in rows:
+        label, threads, speed, dice_gt, dice_ref = row
+        speedup = f"{speed / ref_speed:.2f}x" if ref_speed else "-"
+        delta = f"{dice_gt - ref_dice:+.4f}" if ref_dice is not None else "-"
+        agree = f"{dice_ref:.4f}" if dice_ref is not None else "-"
+        print(f"{label:>10} {threads:>7} {speed:>8.2f} {speedup:>8} {dice_gt:>8.4f} {delta:>8} {agree:>9}")
+    print("="*60 + "\n")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark del download tile contro un tile server stub locale
+Misura tile/s al variare della concorrenza massima del TileDownloader
+"""
+
+import time
+import random
+import argparse
+import threading
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+from tile_downloader import TileDownloader
+
+
+def make_stub_server(latency=0.05, port=0):
+    """Avvia un tile server HTTP locale che risponde con un JPEG 256x256 dopo `latency` secondi"""
+    buf = BytesIO()
+    Image.new('RGB', (256, 256), color=(90, 110, 80)).save(buf, format='JPEG')
+    payload = buf.getvalue()
+
+    class StubTileHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubTileHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def run_benchmark(url_template, num_patches, workers, rate_per_host=None, zoom=17):
+    """Scarica i 3x3 tile di `num_patches` patch casuali e restituisce tile/s"""
+    downloader = TileDownloader(url_template, max_workers=workers, rate_per_host=rate_per_host)
+    rng = random.Random(42)
+
+    start = time.perf_counter()
+    futures = []
+    for _ in range(num_patches):
+        tx, ty = rng.randint(0, 2**zoom - 1), rng.randint(0, 2**zoom - 1)
+        for dy in [-1, 0, 1]:
+            for dx in [-1, 0, 1]:
+                futures.append(downloader.submit(zoom, tx + dx, ty + dy))
+    ok = sum(1 for f in futures if f.result() is not None)
+    elapsed = time.perf_counter() - start
+
+    downloader.close()
+    return len(futures) / elapsed, ok, len(futures)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark download tile su server stub locale')
+    parser.add_argument('--patches', type=int, default=50, help='Numero di patch (9 tile ciascuna)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latenza simulata per tile (s)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 9, 16, 32],
+                        help='Valori di concorrenza da provare')
+    parser.add_argument('--rate', type=float, default=None, help='Rate limit per host (richieste/s)')
+    args = parser.parse_args()
+
+    server = make_stub_server(latency=args.latency)
+    host, port = server.server_address
+    url_template = f"http://{host}:{port}/tile/{{z}}/{{y}}/{{x}}"
+
+    print("\n" + "="*60)
+    print("⏱️  BENCHMARK DOWNLOAD TILE (server stub locale)")
+    print("="*60)
+    print(f"Patch: {args.patches} ({args.patches * 9} tile), latenza: {args.latency*1000:.0f} ms\n")
+    print(f"{'Workers':>8} {'Tile/s':>10} {'OK':>10}")
+    print("─" * 60)
+
+    for workers in args.workers:
+        tiles_per_sec, ok, total = run_benchmark(url_template, args.patches, workers, args.rate)
+        print(f"{workers:>8d} {tiles_per_sec:>10.1f} {ok:>5d}/{total}")
+
+    server.shutdown()
+    print("="*60 + "\n")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Journal di generazione del dataset per riprendere run interrotti
+Stato RNG + contatori in un checkpoint atomico, patch accettate in un log append-only
+"""
+
+import os
+import json
+
+
+def atomic_write_bytes(path, data):
+    """Scrive un file in modo atomico (file temporaneo nella stessa cartella + rename)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _encode_rng_state(state):
+    version, internal, gauss_next = state
+    return [version, list(internal), gauss_next]
+
+
+def _decode_rng_state(state):
+    version, internal, gauss_next = state
+    return (version, tuple(internal), gauss_next)
+
+
+class GenerationJournal:
+    """Checkpoint della generazione in dataset_dir
+
+    - generation_state.json: patch salvate, tentativi e stato di `random` subito dopo
+      il candidato dell'ultima patch accettata (riscritto in modo atomico)
+    - generation_journal.jsonl: una riga per patch accettata (bbox, centro, file scritti)
+
+    Ordine di scrittura per ogni patch: PNG (atomici) → riga del journal → checkpoint.
+    Se il processo muore a metà, il checkpoint punta ancora alla patch precedente e al
+    riavvio i file orfani vengono semplicemente riscritti con gli stessi byte.
+
+    Args:
+        dataset_dir: Cartella del dataset
+        fingerprint: Dizionario dei parametri che determinano il dataset; un checkpoint
+            scritto con parametri diversi non viene ripreso
+    """
+
+    STATE_FILE = "generation_state.json"
+    LOG_FILE = "generation_journal.jsonl"
+
+    def __init__(self, dataset_dir, fingerprint):
+        self.dataset_dir = dataset_dir
+        self.fingerprint = fingerprint
+        self.state_path = os.path.join(dataset_dir, self.STATE_FILE)
+        self.log_path = os.path.join(dataset_dir, self.LOG_FILE)
+        self.entries = []
+        self._log = None
+
+    def load(self):
+        """Carica il checkpoint esistente
+
+        Returns:
+            (saved, attempts, rng_state) oppure None se non c'è nulla da riprendere
+
+        Raises:
+            ValueError: se il checkpoint è stato scritto con parametri diversi
+        """
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, 'r') as f:
+            state = json.load(f)
+        if state.get('fingerprint') != self.fingerprint:
+            raise ValueError(
+                f"Checkpoint {self.state_path} generato con parametri diversi: "
+                f"eliminarlo (insieme a {self.LOG_FILE}) o ripristinare la configurazione"
+            )
+        saved = state['saved']
+
+        # Tieni solo le righe confermate dal checkpoint (le successive sono di una patch interrotta)
+        entries = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Riga troncata dal crash
+                    if entry['index'] >= saved:
+                        break
+                    entries.append(entry)
+        if len(entries) != saved:
+            raise ValueError(
+                f"Journal {self.log_path} incompleto: {len(entries)} patch registrate, "
+                f"checkpoint a {saved}"
+            )
+        self.entries = entries
+        self._rewrite_log()
+        return saved, state['attempts'], _decode_rng_state(state['rng'])
+
+    def _rewrite_log(self):
+        data = "".join(json.dumps(entry) + "\n" for entry in self.entries).encode()
+        atomic_write_bytes(self.log_path, data)
+
+    def reset(self):
+        """Inizia un journal nuovo (run da zero)"""
+        self.entries = []
+        for path in (self.state_path, self.log_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record(self, entry, attempts, rng_state):
+        """Registra una patch accettata (dopo che i suoi file sono stati scritti)"""
+        if self._log is None:
+            self._log = open(self.log_path, 'a')
+        self._log.write(json.dumps(entry) + "\n")
+        self._log.flush()
+        self.entries.append(entry)
+
+        state = {
+            'fingerprint': self.fingerprint,
+            'saved': len(self.entries),
+            'attempts': attempts,
+            'rng': _encode_rng_state(rng_state),
+        }
+        atomic_write_bytes(self.state_path, json.dumps(state).encode())
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
+import atexit
 import random
-import requests  # pyright: ignore[reportMissingModuleSource]
+import pandas as pd  # pyright: ignore[reportMissingModuleSource]
 import geopandas as gpd  # pyright: ignore[reportMissingModuleSource]
 import numpy as np
 from PIL import Image, ImageDraw  # pyright: ignore[reportMissingImports]
 from io import BytesIO
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+import multiprocessing
 import math
 from pathlib import Path
 from shapely.geometry import box  # pyright: ignore[reportMissingModuleSource]
+from tile_cache import TileCache
+from tile_downloader import TileDownloader, ARCGIS_TILE_URL
+from tile_pipeline import AsyncTileFetcher, PatchPipeline
+from generation_journal import GenerationJournal, atomic_write_bytes
+from array_store import ArrayStoreWriter, store_dir_for
+from patch_writer import BackgroundWriter
+from quality_metrics import compute_quality_metrics, compute_label_metrics, metrics_row
 
 # === SEED FISSO PER RIPRODUCIBILITÀ ===
 random.seed(42)
@@ -17,15 +30,40 @@ np.random.seed(42)
 
 # === CONFIGURAZIONE ===
 osm_file = "/workspace/belgium-roads.osm.pbf"
+region_bbox = None  # [minx, miny, maxx, maxy] WGS84 per leggere solo una regione (None = tutto il file)
 dataset_id = "001"
 dataset_name = "Strade"
 num_images = 2000  # Ripristinato a 2000 (era 70 per test)
 image_size = 512
 max_attempts = 100  # Numero massimo di tentativi per trovare patch con strade
-data = "imm, lab"  # Opzioni: imm, lab, all (separate da virgola)
+data = "imm, lab"  # Opzioni: imm, lab, all, store (separate da virgola)
 # imm = solo immagini satellitari → imagesTr/
 # lab = solo maschere binarie strade → labelsTr/
 # all = immagini satellitari + strade → allTr/
+# store = immagini + label in shard .npy memory-mapped → store/ (letti zero-copy da analisi,
+#         visualizzazione e test; i PNG per nnU-Net si ricavano con 'python array_store.py export')
+store_shard_size = 256  # Campioni per shard dello store (256 × 512×512×3 ≈ 200 MB di immagini)
+
+# Download tile: sessione HTTP condivisa + executor globale
+tile_server = ARCGIS_TILE_URL  # Template URL {z}/{y}/{x} (es. stub locale per benchmark)
+download_workers = 16  # Download concorrenti massimi (in tutto il processo)
+download_rate_per_host = None  # Richieste/secondo per host (None = nessun limite)
+patches_in_flight = 8  # Patch scaricate in parallelo mentre la corrente viene validata/salvata
+
+# Generazione multi-processo (render, resize e PNG encoding)
+num_workers = os.cpu_count() or 1  # 1 = tutto nel processo principale
+png_compress_level = 6  # Livello zlib dei PNG (0-9): 1 è molto più veloce, file ~10-20% più grandi
+write_queue_size = 16  # Patch accettate in attesa di scrittura su disco (backpressure)
+
+# Cache tile satellitari su disco (riusata tra run e tra patch sovrapposte)
+tile_cache_path = "/workspace/tile_cache/world_imagery.sqlite"
+tile_cache_max_mb = 8192  # Limite dimensione cache (evizione LRU)
+tile_cache_offline = False  # Se True usa SOLO la cache (nessun accesso rete, tile mancanti → neri)
+
+# === RIPRESA RUN INTERROTTI ===
+# Journal in dataset_dir (stato RNG + patch accettate): un run interrotto riparte dall'ultima
+# patch salvata e produce lo stesso dataset di un run senza interruzioni
+resume = True  # False = ricomincia da zero (il journal esistente viene cancellato)
 
 # Struttura nnU-Net
 nnunet_raw_base = "/workspace/nnUNet_raw"
@@ -40,50 +78,15 @@ data_set = {x.strip() for x in data.split(',') if x.strip()}
 SAVE_IMM = 'imm' in data_set
 SAVE_LAB = 'lab' in data_set
 SAVE_ALL = 'all' in data_set
+SAVE_STORE = 'store' in data_set
 
-# Crea cartelle necessarie
-if SAVE_IMM:
-    os.makedirs(images_dir, exist_ok=True)
-if SAVE_LAB:
-    os.makedirs(labels_dir, exist_ok=True)
-    os.makedirs(labels_viz_dir, exist_ok=True)  # Anche versioni visualizzabili
-if SAVE_ALL:
-    os.makedirs(all_dir, exist_ok=True)
-
-# Crea/aggiorna dataset.json se non esiste
-dataset_json_path = os.path.join(dataset_dir, "dataset.json")
-if not os.path.exists(dataset_json_path):
-    dataset_json = {
-        "channel_names": {
-            "0": "R",
-            "1": "G",
-            "2": "B"
-        },
-        "labels": {
-            "background": 0,
-            "road": 1
-        },
-        "numTraining": num_images,  # Sarà aggiornato alla fine
-        "file_ending": ".png",
-        "name": dataset_name,
-        "description": "Road segmentation from satellite imagery (RGB)",
-        "reference": "Francesco Girardello - PhD Project",
-        "licence": "proprietary",
-        "release": "1.0"
-    }
-    with open(dataset_json_path, 'w') as f:
-        json.dump(dataset_json, f, indent=4)
-    print(f"✓ Creato dataset.json in {dataset_dir}")
-
-print("Caricamento dati OSM...")
-gdf = gpd.read_file(osm_file, layer='lines')
-roads = gdf[gdf['highway'].notna()].copy()
-
-if len(roads) == 0:
-    print("ERRORE: Nessuna strada trovata!")
-    exit(1)
-
-print(f"Strade prima del filtro: {len(roads)}")
+# === FILTRO 2: Qualità immagine (is_patch_valid) ===
+# FILTRI PIÙ STRINGENTI per evitare campioni problematici:
+# - max_vegetation=0.45 → max 45% vegetazione (era 60%, troppo permissivo)
+# - min_brightness=50 → brightness minima 50 (era 30, troppo scuro)
+# - max_black_ratio=0.01 → scarta immagini con >1% pixel neri
+# - max_black_band_size=30 → scarta se c'è una banda nera >30px
+quality_filters = dict(max_vegetation=0.45, min_brightness=50, max_black_ratio=0.01, max_black_band_size=30)
 
 # === FILTRO 1: Solo strade principali visibili da satellite ===
 ALLOWED_HIGHWAY_TYPES = [
@@ -98,26 +101,6 @@ ALLOWED_HIGHWAY_TYPES = [
     # 'track', 'path', 'footway', 'cycleway'  # NON includere: troppo stretti/nascosti
 ]
 
-roads = roads[roads['highway'].isin(ALLOWED_HIGHWAY_TYPES)].copy()
-
-if len(roads) == 0:
-    print("ERRORE: Nessuna strada valida dopo il filtro!")
-    exit(1)
-
-print(f"✓ Strade dopo filtro tipo: {len(roads)} (eliminati sentieri/piste nascoste)")
-
-# Converti a WGS84 se necessario
-if roads.crs is not None and roads.crs != 'EPSG:4326':
-    print("Conversione coordinate a WGS84...")
-    roads = roads.to_crs('EPSG:4326')
-    print("✓ Coordinate convertite")
-
-print(f"CRS strade: {roads.crs}")
-
-# Ottieni bounds
-bounds = roads.total_bounds  # [minx, miny, maxx, maxy]
-print(f"Bounds: {bounds}")
-
 # Dimensione patch in gradi (circa 500m)
 patch_size_deg = 0.005
 
@@ -144,183 +127,345 @@ def latlon_to_pixel_in_tile(lat, lon, zoom, tile_x, tile_y, tile_size=256):
     
     return x_pixel, y_pixel
 
-def download_satellite_image(bbox, zoom=17, size=512, max_retries=2, use_parallel=True):
-    """Scarica immagine satellitare per un bbox specifico con download parallelo
+_default_downloader = None
+_default_tile_cache = None
+
+def get_default_downloader():
+    """TileDownloader di processo creato alla prima richiesta (config di questo file)
     
-    Args:
-        bbox: Bounding box [minx, miny, maxx, maxy]
-        zoom: Livello zoom tile
-        size: Dimensione finale immagine
-        max_retries: Numero massimo tentativi per tile falliti (default 2)
-        use_parallel: Se True, scarica i 9 tile in parallelo (MOLTO più veloce!)
+    Usa la stessa cache tile su disco di main() (tile_cache_path), quindi anche
+    in modalità offline; downloader e cache vengono chiusi all'uscita (atexit).
     """
-    import time
-    from concurrent.futures import ThreadPoolExecutor, as_completed
+    global _default_downloader, _default_tile_cache
+    if _default_downloader is None:
+        _default_tile_cache = TileCache(tile_cache_path, max_bytes=tile_cache_max_mb * 1024**2)
+        _default_downloader = TileDownloader(tile_server, max_workers=download_workers,
+                                             rate_per_host=download_rate_per_host,
+                                             cache=_default_tile_cache, offline=tile_cache_offline)
+        atexit.register(close_default_downloader)
+    return _default_downloader
+
+def close_default_downloader():
+    """Chiude il downloader di default e la sua cache tile (se creati)"""
+    global _default_downloader, _default_tile_cache
+    if _default_downloader is not None:
+        _default_downloader.close()
+        _default_tile_cache.close()
+        _default_downloader = _default_tile_cache = None
+
+def satellite_tile_grid(bbox, zoom=17):
+    """Tile 3x3 necessari per coprire il bbox (centrati sul tile del centro)
     
-    # Calcola centro del bbox
+    Returns:
+        (tile_x, tile_y, coords): tile centrale e lista (dx, dy) dei 9 offset
+    """
     lon_center = (bbox[0] + bbox[2]) / 2
     lat_center = (bbox[1] + bbox[3]) / 2
-    
-    # Ottieni tile che contiene il centro
     tile_x, tile_y = latlon_to_tile(lat_center, lon_center, zoom)
-    
-    def download_single_tile(dx, dy):
-        """Scarica un singolo tile con retry"""
-        url = f"https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{zoom}/{tile_y+dy}/{tile_x+dx}"
-        
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(url, timeout=8)  # timeout ridotto a 8s
-                if response.status_code == 200:
-                    return (dx, dy, Image.open(BytesIO(response.content)))
-                elif attempt < max_retries - 1:
-                    time.sleep(0.3 * (attempt + 1))  # backoff ridotto: 0.3s, 0.6s
-            except Exception:
-                if attempt < max_retries - 1:
-                    time.sleep(0.3 * (attempt + 1))
-        
-        # Tutti i tentativi falliti → tile nero
-        return (dx, dy, Image.new('RGB', (256, 256), color='black'))
-    
-    # Scarica tile (parallelo o seriale)
-    tiles = []
-    if use_parallel:
-        # DOWNLOAD PARALLELO: ~5-10x più veloce!
-        with ThreadPoolExecutor(max_workers=9) as executor:
-            tile_coords = [(dx, dy) for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
-            futures = {executor.submit(download_single_tile, dx, dy): (dx, dy) 
-                      for dx, dy in tile_coords}
-            
-            for future in as_completed(futures):
-                tiles.append(future.result())
-    else:
-        # Download seriale (backup)
-        for dy in [-1, 0, 1]:
-            for dx in [-1, 0, 1]:
-                tiles.append(download_single_tile(dx, dy))
-    
-    # Crea immagine composita 3x3
-    composite = Image.new('RGB', (256*3, 256*3))
-    for dx, dy, tile in tiles:
-        composite.paste(tile, ((dx+1)*256, (dy+1)*256))
-    
-    # Trova coordinate pixel degli angoli del bbox nell'immagine composita
+    coords = [(dx, dy) for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
+    return tile_x, tile_y, coords
+
+def satellite_crop_rect(bbox, zoom, tile_x, tile_y):
+    """Rettangolo del bbox (x1, y1, x2, y2) in pixel del mosaico 3x3 centrato su (tile_x, tile_y)"""
     corners_pixel = []
     for lon, lat in [(bbox[0], bbox[3]), (bbox[2], bbox[1])]:  # top-left, bottom-right
         x_px, y_px = latlon_to_pixel_in_tile(lat, lon, zoom, tile_x-1, tile_y-1, 256)
         corners_pixel.append((x_px, y_px))
+    (x1, y1), (x2, y2) = corners_pixel
+    return x1, y1, x2, y2
+
+def build_tile_composite(tiles):
+    """Mosaico 3x3 (768x768) dai byte dei tile; tile mancanti o corrotti restano neri
     
-    # Crop e resize
-    x1, y1 = corners_pixel[0]
-    x2, y2 = corners_pixel[1]
+    Args:
+        tiles: Lista (dx, dy, bytes o None)
+    """
+    composite = Image.new('RGB', (256*3, 256*3))
+    for dx, dy, data in tiles:
+        if data is None:
+            continue  # Tile mancante → resta nero
+        try:
+            tile = Image.open(BytesIO(data))
+            composite.paste(tile, ((dx+1)*256, (dy+1)*256))
+        except Exception:
+            continue  # Tile corrotto → resta nero
+    return composite
+
+def compose_satellite_image(bbox, zoom, tile_x, tile_y, tiles, size=512):
+    """Compone i tile 3x3, ritaglia il bbox e ridimensiona
     
-    cropped = composite.crop((x1, y1, x2, y2))
+    Args:
+        tiles: Lista (dx, dy, bytes o None); None → tile nero
+    """
+    composite = build_tile_composite(tiles)
+    
+    # Crop e resize
+    cropped = composite.crop(satellite_crop_rect(bbox, zoom, tile_x, tile_y))
     resized = cropped.resize((size, size), Image.Resampling.LANCZOS)
     
     return resized
 
-def calculate_vegetation_score(img):
-    """Calcola score di vegetazione (0-1). Più alto = più verde/alberi"""
-    img_array = np.array(img)
+def precheck_satellite_tiles(bbox, zoom, tile_x, tile_y, missing, size=512, max_black_ratio=0.01, max_black_band_size=30):
+    """Validazione anticipata sui tile: scarta prima di comporre/ridimensionare
+    
+    Calcola per difetto i pixel dell'immagine finale che saranno sicuramente neri:
+    quelli il cui supporto LANCZOS cade tutto fuori dal mosaico 3x3 o dentro tile
+    mancanti. Se già questi superano le soglie di is_patch_valid la patch è persa,
+    quindi lo scarto coincide con quello che is_patch_valid darebbe dopo il resize.
+    
+    Args:
+        missing: Insieme di (dx, dy) dei tile falliti
+    
+    Returns:
+        Motivo dello scarto oppure None
+    """
+    x1, y1, x2, y2 = (int(round(v)) for v in satellite_crop_rect(bbox, zoom, tile_x, tile_y))  # come Image.crop
+    w, h = x2 - x1, y2 - y1
+    if w <= 0 or h <= 0:
+        return None
     
-    # Calcola pseudo-NDVI (Normalized Difference Vegetation Index)
-    # NDVI = (NIR - Red) / (NIR + Red)
-    # Per RGB usiamo: (Green - Red) / (Green + Red + epsilon)
+    # Raggio del supporto LANCZOS (a=3, allargato in downscale) in pixel sorgente, +1 di sicurezza
+    rx = 3 * max(1.0, w / size) + 1
+    ry = 3 * max(1.0, h / size) + 1
+    cx = x1 + (np.arange(size) + 0.5) * w / size
+    cy = y1 + (np.arange(size) + 0.5) * h / size
     
-    r = img_array[:, :, 0].astype(float)
-    g = img_array[:, :, 1].astype(float)
-    b = img_array[:, :, 2].astype(float)
+    black = np.ones((size, size), dtype=bool)
+    for dy in [-1, 0, 1]:
+        for dx in [-1, 0, 1]:
+            if (dx, dy) in missing:
+                continue
+            left, top = (dx + 1) * 256, (dy + 1) * 256
+            cols = (cx + rx > left) & (cx - rx < left + 256)
+            rows = (cy + ry > top) & (cy - ry < top + 256)
+            black[np.ix_(rows, cols)] = False
     
-    # Pseudo vegetation index
-    epsilon = 1e-6
-    veg_index = (g - r) / (g + r + epsilon)
+    black_ratio = black.mean()
+    if black_ratio > max_black_ratio:
+        return f"Troppi tile mancanti ({black_ratio:.1%})"
+    max_black_in_row = int(black.sum(axis=1).max())
+    if max_black_in_row > max_black_band_size:
+        return f"Banda nera orizzontale ({max_black_in_row}px)"
+    max_black_in_col = int(black.sum(axis=0).max())
+    if max_black_in_col > max_black_band_size:
+        return f"Banda nera verticale ({max_black_in_col}px)"
+    return None
+
+@lru_cache(maxsize=64)
+def lanczos_positive_weight_sums(in_size, out_size):
+    """Pesi LANCZOS di PIL lungo un asse (stessa costruzione di precompute_coeffs in Resample.c)
     
-    # Conta pixel "verdi" (vegetazione)
-    green_pixels = np.sum(veg_index > 0.15)  # Soglia empirica
-    total_pixels = veg_index.size
+    In cache: le dimensioni del ritaglio cambiano di pochi pixel tra le patch.
     
-    vegetation_score = green_pixels / total_pixels
-    return vegetation_score
+    Returns:
+        (sums, max_row): per ogni pixel sorgente la somma su tutti i pixel di output
+        dei pesi normalizzati positivi, e la massima somma dei pesi positivi di un
+        pixel di output
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+    sums = np.zeros(in_size)
+    max_row = 0.0
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        t = (np.arange(xmin, xmax) - center + 0.5) / filterscale
+        weights = np.where(np.abs(t) < 3, np.sinc(t) * np.sinc(t / 3), 0.0)
+        total = weights.sum()
+        if total != 0:
+            weights /= total
+        positive = np.maximum(weights, 0.0)
+        sums[xmin:xmax] += positive
+        max_row = max(max_row, float(positive.sum()))
+    sums.flags.writeable = False
+    return sums, max_row
 
-def is_patch_valid(img, max_vegetation=0.60, min_brightness=30, max_black_ratio=0.01, max_black_band_size=30):
-    """Valida se una patch è adatta per il training
+def resized_brightness_upper_bound(crop_array, size):
+    """Maggiorante della brightness di compose_satellite_image (resize LANCZOS a size x size)
+    
+    Il resize sono due passate separabili uint8, ciascuna clip(round(Σ w·x)): con x ≥ 0
+    ogni passata vale al più Σ w⁺·x + 0.5. Sommando su tutti i pixel, la media finale è
+    limitata da A·X·B / size² più l'arrotondamento, con A e B le somme dei pesi positivi
+    per riga e colonna sorgente e X la media dei canali del ritaglio. Il fattore
+    (1 + 1e-4) e lo 0.01 coprono i coefficienti a virgola fissa di PIL.
+    """
+    h, w = crop_array.shape[:2]
+    row_sums, max_row_v = lanczos_positive_weight_sums(h, size)
+    col_sums, max_row_h = lanczos_positive_weight_sums(w, size)
+    channel_mean = crop_array.mean(axis=2)
+    weighted = float(row_sums @ channel_mean @ col_sums) / (size * size)
+    return weighted * (1 + 1e-4) + 0.5 * max(max_row_v, max_row_h) + 0.5 + 0.01
+
+def compose_satellite_image_checked(bbox, zoom, tile_x, tile_y, tiles, size=512, min_brightness=50):
+    """Come compose_satellite_image, ma scarta prima del resize LANCZOS le patch che
+    saranno sicuramente troppo scure
+    
+    Lo scarto avviene solo se il maggiorante della brightness dopo il resize
+    (resized_brightness_upper_bound) è sotto min_brightness, cioè quando is_patch_valid
+    scarterebbe comunque: le patch accettate, e quindi il dataset di un seed, non
+    cambiano. La vegetazione (frazione di pixel sopra una soglia di pseudo-NDVI) non
+    ha un limite analogo sul ritaglio e resta al controllo completo.
+    
+    Returns:
+        (immagine o None, motivo scarto o None)
+    """
+    composite = build_tile_composite(tiles)
+    cropped = composite.crop(satellite_crop_rect(bbox, zoom, tile_x, tile_y))
+    
+    crop_array = np.asarray(cropped)
+    if crop_array.size > 0:
+        max_brightness = resized_brightness_upper_bound(crop_array, size)
+        if max_brightness < min_brightness:
+            return None, f"Troppo scura (brightness ≤ {max_brightness:.1f})"
+    
+    return cropped.resize((size, size), Image.Resampling.LANCZOS), None
+
+def download_satellite_image(bbox, zoom=17, size=512, downloader=None, use_parallel=True):
+    """Scarica immagine satellitare per un bbox specifico con download parallelo
     
     Args:
-        img: Immagine PIL
-        max_vegetation: Percentuale massima di vegetazione tollerata (0-1)
-        min_brightness: Luminosità media minima (0-255)
-        max_black_ratio: Percentuale massima di pixel neri tollerata (0-1, default 1%)
-        max_black_band_size: Dimensione massima banda nera continua in pixel (default 30px)
+        bbox: Bounding box [minx, miny, maxx, maxy]
+        zoom: Livello zoom tile
+        size: Dimensione finale immagine
+        downloader: TileDownloader condiviso (sessione keep-alive, cache, retry, concorrenza)
+        use_parallel: Se True, accoda i 9 tile sull'executor condiviso del downloader
+    """
+    if downloader is None:
+        downloader = get_default_downloader()
+    
+    tile_x, tile_y, coords = satellite_tile_grid(bbox, zoom)
+    
+    tiles = []
+    if use_parallel:
+        # I 9 tile vanno sull'executor globale: la concorrenza è limitata dal downloader
+        futures = [(dx, dy, downloader.submit(zoom, tile_x + dx, tile_y + dy)) for dx, dy in coords]
+        for dx, dy, future in futures:
+            tiles.append((dx, dy, future.result()))
+    else:
+        # Download seriale (backup)
+        for dx, dy in coords:
+            tiles.append((dx, dy, downloader.fetch_tile(zoom, tile_x + dx, tile_y + dy)))
+    
+    return compose_satellite_image(bbox, zoom, tile_x, tile_y, tiles, size)
+
+def calculate_vegetation_score(img):
+    """Calcola score di vegetazione (0-1). Più alto = più verde/alberi"""
+    # Pseudo-NDVI (Normalized Difference Vegetation Index): NDVI = (NIR - Red) / (NIR + Red)
+    # Per RGB usiamo (Green - Red) / (Green + Red), pixel "verde" sopra 0.15 (soglia empirica)
+    return float(compute_quality_metrics([img], full=False)['vegetation'][0])
+
+def check_quality_metrics(metrics, i=0, max_vegetation=0.60, min_brightness=30, max_black_ratio=0.01, max_black_band_size=30):
+    """Applica le soglie di is_patch_valid alla patch i di un batch di metriche
     
     Returns:
         (bool, str): (is_valid, reason)
     """
-    img_array = np.array(img)
-    
-    # Check 1: Pixel neri (PRIMA - più veloce e scarta molte patch)
-    black_mask = np.all(img_array == 0, axis=2)
-    black_pixels = np.sum(black_mask)
-    total_pixels = img_array.shape[0] * img_array.shape[1]
-    black_ratio = black_pixels / total_pixels
+    # Check 1: Pixel neri
+    black_ratio = metrics['black_ratio'][i]
     if black_ratio > max_black_ratio:  # Default: Max 1% pixel neri (bilanciato)
         return False, f"Troppi tile mancanti ({black_ratio:.1%})"
     
-    # Check 2: Bande nere continue (secondo check più veloce)
-    # Controlla righe con troppi pixel neri
-    black_rows = np.sum(black_mask, axis=1)
-    max_black_in_row = np.max(black_rows)
+    # Check 2: Bande nere continue (righe, poi colonne con troppi pixel neri)
+    max_black_in_row = metrics['max_black_row'][i]
     if max_black_in_row > max_black_band_size:
         return False, f"Banda nera orizzontale ({max_black_in_row}px)"
-    
-    # Controlla colonne con troppi pixel neri
-    black_cols = np.sum(black_mask, axis=0)
-    max_black_in_col = np.max(black_cols)
+    max_black_in_col = metrics['max_black_col'][i]
     if max_black_in_col > max_black_band_size:
         return False, f"Banda nera verticale ({max_black_in_col}px)"
     
-    # Check 3: Luminosità (veloce)
-    mean_brightness = np.mean(img_array)
+    # Check 3: Luminosità
+    mean_brightness = metrics['brightness'][i]
     if mean_brightness < min_brightness:
         return False, f"Troppo scura (brightness={mean_brightness:.1f})"
     
-    # Check 4: Vegetazione (più lento, ultimo)
-    veg_score = calculate_vegetation_score(img)
+    # Check 4: Vegetazione
+    veg_score = metrics['vegetation'][i]
     if veg_score > max_vegetation:
         return False, f"Troppa vegetazione ({veg_score:.1%})"
     
     return True, "OK"
 
+def is_patch_valid(img, max_vegetation=0.60, min_brightness=30, max_black_ratio=0.01, max_black_band_size=30):
+    """Valida se una patch è adatta per il training
+    
+    Args:
+        img: Immagine PIL
+        max_vegetation: Percentuale massima di vegetazione tollerata (0-1)
+        min_brightness: Luminosità media minima (0-255)
+        max_black_ratio: Percentuale massima di pixel neri tollerata (0-1, default 1%)
+        max_black_band_size: Dimensione massima banda nera continua in pixel (default 30px)
+    
+    Returns:
+        (bool, str): (is_valid, reason)
+    """
+    return check_quality_metrics(compute_quality_metrics([img], full=False), 0, max_vegetation, min_brightness,
+                                 max_black_ratio, max_black_band_size)
+
 def process_satellite_image(sat_img, bbox, size=512):
-    """Processa l'immagine satellitare con matplotlib per avere lo stesso formato"""
-    from matplotlib.backends.backend_agg import FigureCanvasAgg  # pyright: ignore[reportMissingImports]
-    from matplotlib.figure import Figure  # pyright: ignore[reportMissingImports]
+    """Porta l'immagine satellitare nel formato finale RGB size x size (senza matplotlib)
     
-    fig = Figure(figsize=(size/100, size/100), dpi=100)
-    canvas = FigureCanvasAgg(fig)
-    ax = fig.add_axes([0, 0, 1, 1])
-    ax.set_xlim(bbox[0], bbox[2])
-    ax.set_ylim(bbox[1], bbox[3])
-    ax.set_aspect('equal', adjustable='box')
-    ax.axis('off')
-    ax.set_facecolor('black')
+    Equivale al vecchio rendering con imshow(extent=bbox, aspect='equal') su una
+    Figure size x size: per bbox quadrati e immagini già size x size (il caso di
+    download_satellite_image) è una copia pixel per pixel. Altrimenti l'immagine
+    viene ridimensionata (bilineare) nel riquadro con l'aspect del bbox, centrata
+    su sfondo bianco come faceva la Figure.
+    """
+    w_deg = bbox[2] - bbox[0]
+    h_deg = bbox[3] - bbox[1]
+    if w_deg >= h_deg:
+        box_w, box_h = size, max(1, int(round(size * h_deg / w_deg)))
+    else:
+        box_w, box_h = max(1, int(round(size * w_deg / h_deg))), size
     
-    # Mostra solo l'immagine satellitare
-    ax.imshow(sat_img, extent=[bbox[0], bbox[2], bbox[1], bbox[3]], aspect='equal', interpolation='bilinear')
-    # Reinforza limiti/aspect (nel caso qualche artist modifichi gli assi)
-    ax.set_xlim(bbox[0], bbox[2])
-    ax.set_ylim(bbox[1], bbox[3])
-    ax.set_aspect('equal', adjustable='box')
+    img = sat_img.convert('RGB')
+    if img.size != (box_w, box_h):
+        img = img.resize((box_w, box_h), Image.Resampling.BILINEAR)
     
-    fig.set_size_inches(size/100, size/100)
-    canvas.draw()
+    if (box_w, box_h) == (size, size):
+        return img.copy() if img is sat_img else img
     
-    buf = canvas.buffer_rgba()
-    img_array = np.frombuffer(buf, dtype=np.uint8).reshape(size, size, 4)
+    canvas = Image.new('RGB', (size, size), color='white')
+    canvas.paste(img, ((size - box_w) // 2, (size - box_h) // 2))
+    return canvas
+
+def road_lines_to_pixels(geoms, bbox, size=512):
+    """Converte le geometrie in polilinee in pixel, in blocco (shapely 2 vettorizzato)
     
-    # Converti in RGB
-    rgb_array = img_array[:, :, :3]
+    Multi/GeometryCollection vengono esplose in LineString con get_parts, tutte le
+    coordinate estratte con una sola get_coordinates e trasformate con un'unica
+    operazione affine NumPy, poi divise per linea tramite gli offset.
     
-    return Image.fromarray(rgb_array, mode='RGB')
+    Args:
+        geoms: Array di geometrie (es. roads_subset.geometry.values)
+        bbox: Bounding box [minx, miny, maxx, maxy]
+        size: Dimensione immagine in pixel
+    
+    Returns:
+        Lista di array (N_i, 2) float64 con coordinate pixel (solo linee con >= 2 punti)
+    """
+    import shapely  # pyright: ignore[reportMissingModuleSource]
+    
+    parts = shapely.get_parts(np.asarray(geoms, dtype=object))
+    # GeometryCollection può contenere MultiLineString: un secondo livello di esplosione
+    nested = shapely.get_type_id(parts) == 5  # MultiLineString
+    if np.any(nested):
+        parts = np.concatenate([parts[~nested], shapely.get_parts(parts[nested])])
+    lines = parts[shapely.get_type_id(parts) == 1]  # Solo LineString
+    if len(lines) == 0:
+        return []
+    
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    counts = np.bincount(line_idx, minlength=len(lines))
+    
+    minx, miny, maxx, maxy = bbox
+    scale = np.array([size / (maxx - minx), -size / (maxy - miny)])
+    offset = np.array([-minx * scale[0], size + miny * size / (maxy - miny)])
+    px = coords * scale + offset
+    
+    splits = np.split(px, np.cumsum(counts)[:-1])
+    return [line for line, n in zip(splits, counts) if n >= 2]
 
 def create_road_binary_mask(roads_subset, bbox, size=512, line_width=5, sat_img=None, mask_black_areas=True):
     """Rasterizza le geometrie delle strade su una maschera binaria mono-canale (L).
@@ -337,43 +482,11 @@ def create_road_binary_mask(roads_subset, bbox, size=512, line_width=5, sat_img=
     if roads_subset.crs is not None and roads_subset.crs != 'EPSG:4326':
         roads_subset = roads_subset.to_crs('EPSG:4326')
 
-    minx, miny, maxx, maxy = bbox
-    sx = size / (maxx - minx)
-    sy = size / (maxy - miny)
-
-    def to_px(pt):
-        x, y = pt
-        px = (x - minx) * sx
-        py = size - (y - miny) * sy
-        return (px, py)
-
     mask = Image.new('L', (size, size), 0)
     draw = ImageDraw.Draw(mask)
 
-    for geom in roads_subset.geometry:
-        if geom is None or geom.is_empty:
-            continue
-        geom_type = geom.geom_type
-        if geom_type == 'LineString':
-            coords = list(geom.coords)
-            if len(coords) >= 2:
-                draw.line([to_px(pt) for pt in coords], fill=255, width=line_width)
-        elif geom_type == 'MultiLineString':
-            for line in geom.geoms:
-                coords = list(line.coords)
-                if len(coords) >= 2:
-                    draw.line([to_px(pt) for pt in coords], fill=255, width=line_width)
-        elif geom_type == 'GeometryCollection':
-            for sub in geom.geoms:
-                if sub.geom_type == 'LineString':
-                    coords = list(sub.coords)
-                    if len(coords) >= 2:
-                        draw.line([to_px(pt) for pt in coords], fill=255, width=line_width)
-                elif sub.geom_type == 'MultiLineString':
-                    for line in sub.geoms:
-                        coords = list(line.coords)
-                        if len(coords) >= 2:
-                            draw.line([to_px(pt) for pt in coords], fill=255, width=line_width)
+    for line_px in road_lines_to_pixels(roads_subset.geometry.values, bbox, size):
+        draw.line(line_px.ravel().tolist(), fill=255, width=line_width)
 
     # Converti da 0/255 a 0/1 per nnU-Net (le strade sono 1, background è 0)
     mask_array = np.array(mask)
@@ -450,6 +563,195 @@ def create_road_mask(roads_subset, bbox, sat_img, size=512, line_width=5, mask_b
     
     return result
 
+def prepare_output_dirs():
+    """Crea le cartelle di output e il dataset.json (se non esiste)"""
+    # Crea cartelle necessarie
+    if SAVE_IMM:
+        os.makedirs(images_dir, exist_ok=True)
+    if SAVE_LAB:
+        os.makedirs(labels_dir, exist_ok=True)
+        os.makedirs(labels_viz_dir, exist_ok=True)  # Anche versioni visualizzabili
+    if SAVE_ALL:
+        os.makedirs(all_dir, exist_ok=True)
+    if SAVE_STORE:
+        os.makedirs(store_dir_for(dataset_dir), exist_ok=True)
+
+    # Crea/aggiorna dataset.json se non esiste
+    dataset_json_path = os.path.join(dataset_dir, "dataset.json")
+    if not os.path.exists(dataset_json_path):
+        dataset_json = {
+            "channel_names": {
+                "0": "R",
+                "1": "G",
+                "2": "B"
+            },
+            "labels": {
+                "background": 0,
+                "road": 1
+            },
+            "numTraining": num_images,  # Sarà aggiornato alla fine
+            "file_ending": ".png",
+            "name": dataset_name,
+            "description": "Road segmentation from satellite imagery (RGB)",
+            "reference": "Francesco Girardello - PhD Project",
+            "licence": "proprietary",
+            "release": "1.0"
+        }
+        with open(dataset_json_path, 'w') as f:
+            json.dump(dataset_json, f, indent=4)
+        print(f"✓ Creato dataset.json in {dataset_dir}")
+    return dataset_json_path
+
+def source_cache_digest(osm_file, *parts):
+    """Hash breve per le cache derivate dal file OSM
+    
+    Dipende dal file sorgente (dimensione + mtime), dai tipi di strada ammessi,
+    dal bbox della regione e da eventuali parametri aggiuntivi della cache.
+    """
+    import hashlib
+    
+    st = os.stat(osm_file)
+    key = "|".join([str(st.st_size), str(int(st.st_mtime)), ','.join(sorted(ALLOWED_HIGHWAY_TYPES)), str(region_bbox)]
+                   + [str(p) for p in parts])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+def roads_cache_path(osm_file):
+    """Percorso della cache GeoParquet delle strade filtrate in WGS84 (accanto al .osm.pbf)"""
+    return f"{osm_file}.roads_{source_cache_digest(osm_file, 'EPSG:4326')}.parquet"
+
+def highway_filter_sql(highway_types):
+    """Filtro attributi OGR SQL sui tipi di strada (eseguito dal reader)"""
+    quoted = ", ".join("'" + t.replace("'", "''") + "'" for t in highway_types)
+    return f"highway IN ({quoted})"
+
+def iter_road_chunks(osm_file, highway_types=None, region_bbox=None, chunk_size=100_000):
+    """Legge il layer lines in streaming, a blocchi di GeoDataFrame
+    
+    Il filtro sui tipi di strada (OGR SQL) e il bbox della regione vengono passati al
+    reader, quindi footway, track ecc. non vengono mai materializzati: la memoria
+    dipende da chunk_size e non dalla dimensione dell'estratto Geofabrik.
+    Senza pyogrio/pyarrow ripiega su gpd.read_file (stessi filtri, un solo blocco).
+    
+    Args:
+        osm_file: File .osm.pbf (o altro formato OGR con layer 'lines')
+        highway_types: Tipi di strada ammessi (default ALLOWED_HIGHWAY_TYPES)
+        region_bbox: [minx, miny, maxx, maxy] nel CRS del file (None = tutto)
+        chunk_size: Numero di feature per blocco
+    
+    Yields:
+        GeoDataFrame con colonne highway e geometry
+    """
+    if highway_types is None:
+        highway_types = ALLOWED_HIGHWAY_TYPES
+    where = highway_filter_sql(highway_types)
+    bbox = tuple(region_bbox) if region_bbox is not None else None
+    
+    try:
+        from pyogrio.raw import open_arrow  # pyright: ignore[reportMissingImports]
+        import pyarrow  # noqa: F401  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        gdf = gpd.read_file(osm_file, layer='lines', where=where, bbox=bbox)
+        yield gdf[['highway', 'geometry']]
+        return
+    
+    with open_arrow(osm_file, layer='lines', where=where, bbox=bbox, columns=['highway'],
+                    batch_size=chunk_size, use_pyarrow=True) as source:
+        meta, reader = source
+        geom_col = meta['geometry_name'] or 'wkb_geometry'
+        for batch in reader:
+            yield gpd.GeoDataFrame(
+                {'highway': batch.column('highway').to_pandas()},
+                geometry=gpd.GeoSeries.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False)),
+                crs=meta['crs'],
+            )
+
+def read_filtered_roads(osm_file):
+    """Legge in streaming le strade ammesse dal file OSM e le converte a WGS84
+    
+    Returns:
+        GeoDataFrame con le sole colonne highway e geometry
+    """
+    print("Caricamento dati OSM (streaming, filtro tipo/bbox nel reader)...")
+    chunks = []
+    total = 0
+    for chunk in iter_road_chunks(osm_file, region_bbox=region_bbox):
+        # Converti a WGS84 se necessario (blocco per blocco)
+        if chunk.crs is not None and chunk.crs != 'EPSG:4326':
+            chunk = chunk.to_crs('EPSG:4326')
+        chunks.append(chunk)
+        total += len(chunk)
+        print(f"  ... {total} strade lette")
+
+    if total == 0:
+        print("ERRORE: Nessuna strada valida dopo il filtro!")
+        sys.exit(1)
+
+    roads = gpd.GeoDataFrame(pd.concat(chunks, ignore_index=True), geometry='geometry', crs='EPSG:4326')
+    print(f"✓ Strade dopo filtro tipo: {len(roads)} (eliminati sentieri/piste nascoste)")
+    return roads
+
+def load_roads(osm_file, use_cache=True):
+    """Carica le strade (dalla cache GeoParquet se valida) e costruisce l'indice spaziale
+    
+    Alla prima esecuzione il layer filtrato e riproiettato viene salvato in GeoParquet;
+    le esecuzioni successive leggono solo le colonne geometry e highway da lì.
+    Senza pyarrow la cache viene semplicemente saltata; una cache illeggibile
+    (scrittura interrotta, file corrotto) viene eliminata e ricostruita.
+    
+    Returns:
+        (roads, bounds)
+    """
+    cache_path = roads_cache_path(osm_file)
+    roads = None
+    
+    if use_cache and os.path.exists(cache_path):
+        try:
+            roads = gpd.read_parquet(cache_path, columns=['highway', 'geometry'])
+            print(f"✓ Strade caricate da cache: {cache_path} ({len(roads)} strade)")
+        except ImportError:
+            print("⚠️  pyarrow non installato: cache strade ignorata")
+        except (OSError, ValueError) as e:  # File troncato/corrotto (ArrowInvalid è un ValueError)
+            print(f"⚠️  Cache strade illeggibile ({e}): eliminata, verrà ricostruita")
+            os.remove(cache_path)
+    
+    if roads is None:
+        roads = read_filtered_roads(osm_file)
+        if use_cache:
+            try:
+                tmp_path = cache_path + ".tmp"
+                roads.to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, cache_path)
+                print(f"✓ Cache strade salvata in: {cache_path}")
+            except ImportError:
+                print("⚠️  pyarrow non installato: cache strade non salvata")
+
+    print(f"CRS strade: {roads.crs.to_string() if roads.crs is not None else None}")
+
+    # Ottieni bounds
+    bounds = roads.total_bounds  # [minx, miny, maxx, maxy]
+    print(f"Bounds: {bounds}")
+
+    # Indice spaziale (STRtree) costruito una sola volta e riusato per ogni ricerca
+    print("Costruzione indice spaziale strade...")
+    _ = roads.sindex
+    print("✓ Indice spaziale pronto")
+    return roads, bounds
+
+def query_roads_in_bbox(roads, bbox):
+    """Restituisce le strade che intersecano il bbox usando l'indice spaziale
+    
+    L'STRtree (roads.sindex) fa prima un filtro sui bounding box e poi il test
+    esatto di intersezione solo sui candidati, invece di scansionare tutte le strade.
+    
+    Args:
+        roads: GeoDataFrame con le strade (indice spaziale già costruito)
+        bbox: Bounding box [minx, miny, maxx, maxy]
+    """
+    bbox_geom = box(bbox[0], bbox[1], bbox[2], bbox[3])
+    idx = roads.sindex.query(bbox_geom, predicate='intersects')
+    idx.sort()  # Mantiene l'ordine originale delle strade
+    return roads.iloc[idx]
+
 def find_patch_with_roads(roads, bounds, patch_size_deg, max_attempts=100, ensure_geographic_diversity=True):
     """Trova una patch casuale che contiene almeno una strada
     
@@ -495,9 +797,8 @@ def find_patch_with_roads(roads, bounds, patch_size_deg, max_attempts=100, ensur
                 y_center + half_size
             ]
             
-            # Verifica se ci sono strade
-            bbox_geom = box(bbox[0], bbox[1], bbox[2], bbox[3])
-            roads_in_patch = roads[roads.intersects(bbox_geom)]
+            # Verifica se ci sono strade (query su indice spaziale)
+            roads_in_patch = query_roads_in_bbox(roads, bbox)
             
             if len(roads_in_patch) > 0:
                 return bbox, roads_in_patch, (x_center, y_center)
@@ -519,107 +820,430 @@ def find_patch_with_roads(roads, bounds, patch_size_deg, max_attempts=100, ensur
             y_center + half_size
         ]
         
-        # Verifica se ci sono strade
-        bbox_geom = box(bbox[0], bbox[1], bbox[2], bbox[3])
-        roads_in_patch = roads[roads.intersects(bbox_geom)]
+        # Verifica se ci sono strade (query su indice spaziale)
+        roads_in_patch = query_roads_in_bbox(roads, bbox)
         
         if len(roads_in_patch) > 0:
             return bbox, roads_in_patch, (x_center, y_center)
     
     return None, None, None
 
-print(f"\nGenerazione {num_images} immagini con strade...\n")
+def road_grid_cache_path(osm_file, cell_size, num_strata=10):
+    """Percorso del file cache della griglia strade (accanto al .osm.pbf)
+    
+    La chiave dipende dal file sorgente, dai tipi di strada ammessi, dalla
+    dimensione cella e dal numero di strati.
+    """
+    return f"{osm_file}.roadgrid_{source_cache_digest(osm_file, cell_size, num_strata)}.npz"
 
-saved_images = 0
-attempts = 0
+def build_road_coverage_grid(roads, bounds, cell_size, num_strata=10):
+    """Rasterizza presenza e lunghezza strade su una griglia con celle grandi quanto una patch
+    
+    Args:
+        roads: GeoDataFrame con le strade (indice spaziale già costruito)
+        bounds: Bounds geografici [minx, miny, maxx, maxy]
+        cell_size: Dimensione cella in gradi (= patch_size_deg)
+        num_strata: Lato della griglia di stratificazione (10 → 10x10 strati)
+    
+    Returns:
+        dict con 'cells' (indici flat delle celle con strade), 'lengths' (lunghezza
+        strade per cella, in gradi), 'strata' (strato di ogni cella), 'shape', 'origin', 'cell_size'
+    """
+    import shapely  # pyright: ignore[reportMissingModuleSource]
+    
+    nx = max(1, int(math.ceil((bounds[2] - bounds[0]) / cell_size)))
+    ny = max(1, int(math.ceil((bounds[3] - bounds[1]) / cell_size)))
+    
+    # Tutte le celle come box (vettorizzato)
+    ix, iy = np.meshgrid(np.arange(nx), np.arange(ny))
+    ix = ix.ravel()
+    iy = iy.ravel()
+    x0 = bounds[0] + ix * cell_size
+    y0 = bounds[1] + iy * cell_size
+    cell_boxes = shapely.box(x0, y0, x0 + cell_size, y0 + cell_size)
+    
+    # Coppie (cella, strada) che si intersecano, in un'unica query bulk sull'STRtree
+    cell_idx, road_idx = roads.sindex.query(cell_boxes, predicate='intersects')
+    
+    # Lunghezza della porzione di strada dentro ogni cella
+    geoms = roads.geometry.values
+    pieces = shapely.intersection(cell_boxes[cell_idx], np.asarray(geoms[road_idx]))
+    piece_lengths = shapely.length(pieces)
+    lengths_all = np.bincount(cell_idx, weights=piece_lengths, minlength=nx * ny)
+    
+    cells = np.unique(cell_idx)
+    strata = (iy[cells] * num_strata // ny) * num_strata + (ix[cells] * num_strata // nx)
+    
+    return {
+        'cells': cells.astype(np.int64),
+        'lengths': lengths_all[cells],
+        'strata': strata.astype(np.int64),
+        'shape': np.array([ny, nx], dtype=np.int64),
+        'origin': np.array([bounds[0], bounds[1]], dtype=np.float64),
+        'cell_size': np.float64(cell_size),
+    }
+
+def load_or_build_road_grid(roads, bounds, osm_file, cell_size, num_strata=10):
+    """Carica la griglia strade dalla cache su disco o la calcola e la salva"""
+    cache_path = road_grid_cache_path(osm_file, cell_size, num_strata)
+    
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            grid = {k: cached[k] for k in cached.files}
+        print(f"✓ Griglia strade caricata da cache: {cache_path}")
+    else:
+        print("Precalcolo griglia copertura strade (una tantum)...")
+        grid = build_road_coverage_grid(roads, bounds, cell_size, num_strata)
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez_compressed(tmp_path, **grid)
+        os.replace(tmp_path, cache_path)
+        print(f"✓ Griglia strade salvata in: {cache_path}")
+    
+    # Raggruppa le celle per strato: il campionamento diventa O(1)
+    order = np.argsort(grid['strata'], kind='stable')
+    strata_sorted = grid['strata'][order]
+    strata_ids, starts = np.unique(strata_sorted, return_index=True)
+    grid['by_stratum'] = np.split(order, starts[1:])
+    grid['strata_ids'] = strata_ids
+    
+    print(f"✓ Celle con strade: {len(grid['cells'])}/{int(np.prod(grid['shape']))} in {len(strata_ids)} strati")
+    return grid
 
-while saved_images < num_images and attempts < max_attempts * num_images:
-    attempts += 1
+def sample_patch_from_grid(roads, grid, patch_size_deg, weight_by_length=False):
+    """Campiona una patch direttamente da una cella che contiene strade (zero retry)
     
-    # Cerca una patch con strade
-    bbox, roads_in_patch, center = find_patch_with_roads(roads, bounds, patch_size_deg, max_attempts=50)
+    Sceglie uno strato a caso tra quelli con strade (diversità geografica), poi una
+    cella dello strato (uniforme o pesata per lunghezza strade) e un centro casuale
+    dentro la cella. Se la patch centrata lì non tocca strade, usa la cella stessa,
+    che per costruzione ne contiene almeno una.
     
-    if bbox is None:
-        print(f"⚠️  Nessuna patch con strade trovata dopo {attempts} tentativi")
-        continue
+    Returns:
+        (bbox, roads_in_patch, center) come find_patch_with_roads
+    """
+    if len(grid['cells']) == 0:
+        return None, None, None
     
-    x_center, y_center = center
-    print(f"Patch {saved_images+1}/{num_images} - Centro: ({x_center:.4f}, {y_center:.4f})")
-    print(f"  Trovate {len(roads_in_patch)} strade")
+    members = grid['by_stratum'][random.randrange(len(grid['by_stratum']))]
+    if weight_by_length:
+        weights = grid['lengths'][members]
+        k = random.choices(range(len(members)), weights=weights)[0]
+    else:
+        k = random.randrange(len(members))
+    cell = int(grid['cells'][members[k]])
     
-    sat_img_raw = None
-    # === SCARICA TILE SATELLITARE (necessario per imm, lab, e all) ===
-    if SAVE_IMM or SAVE_ALL or SAVE_LAB:
-        print("  Scaricando immagine satellitare...")
-        sat_img_raw = download_satellite_image(bbox, zoom=17, size=image_size)
-        
-        # === VALIDAZIONE PATCH (FILTRO 2: Qualità immagine) ===
-        # FILTRI PIÙ STRINGENTI per evitare campioni problematici:
-        # - max_vegetation=0.45 → max 45% vegetazione (era 60%, troppo permissivo)
-        # - min_brightness=50 → brightness minima 50 (era 30, troppo scuro)
-        # - max_black_ratio=0.01 → scarta immagini con >1% pixel neri
-        # - max_black_band_size=30 → scarta se c'è una banda nera >30px
-        is_valid, reason = is_patch_valid(sat_img_raw, max_vegetation=0.45, min_brightness=50, max_black_ratio=0.01, max_black_band_size=30)
+    nx = int(grid['shape'][1])
+    cell_size = float(grid['cell_size'])
+    cx0 = float(grid['origin'][0]) + (cell % nx) * cell_size
+    cy0 = float(grid['origin'][1]) + (cell // nx) * cell_size
+    
+    half_size = patch_size_deg / 2
+    x_center = random.uniform(cx0, cx0 + cell_size)
+    y_center = random.uniform(cy0, cy0 + cell_size)
+    bbox = [x_center - half_size, y_center - half_size, x_center + half_size, y_center + half_size]
+    roads_in_patch = query_roads_in_bbox(roads, bbox)
+    
+    if len(roads_in_patch) == 0:
+        # Patch = cella (contiene strade per costruzione)
+        x_center = cx0 + cell_size / 2
+        y_center = cy0 + cell_size / 2
+        bbox = [x_center - half_size, y_center - half_size, x_center + half_size, y_center + half_size]
+        roads_in_patch = query_roads_in_bbox(roads, bbox)
+    
+    return bbox, roads_in_patch, (x_center, y_center)
+
+def encode_png(img, compress_level=6):
+    """Codifica un'immagine PIL in PNG (byte)"""
+    buf = BytesIO()
+    img.save(buf, format='PNG', compress_level=compress_level)
+    return buf.getvalue()
+
+def render_patch(bbox, roads_in_patch, sat_img_raw, size=512, check_quality=True,
+                 save_imm=SAVE_IMM, save_all=SAVE_ALL, save_lab=SAVE_LAB, compress_level=6,
+                 save_store=SAVE_STORE):
+    """Valida e renderizza una patch; eseguita nei processi worker
+    
+    È una funzione pura del candidato: lo stesso input produce sempre gli stessi
+    byte PNG, indipendentemente dal worker o dal numero di worker.
+    
+    Returns:
+        (is_valid, reason, outputs, metrics): outputs è un dict {'imm'|'all'|'lab'|'lab_viz': bytes PNG}
+        più 'store_img'/'store_lab' (array uint8) se save_store, metrics la riga della tabella
+        metriche (quality_metrics) da salvare nel journal
+    """
+    metrics = {}
+    if sat_img_raw is not None:
+        quality = compute_quality_metrics([sat_img_raw])
+        metrics.update(metrics_row(quality))
+    
+    # === VALIDAZIONE PATCH (FILTRO 2: Qualità immagine) ===
+    if check_quality and sat_img_raw is not None:
+        is_valid, reason = check_quality_metrics(quality, 0, **quality_filters)
         if not is_valid:
-            print(f"  ⚠️  Patch scartata: {reason}")
-            continue  # Salta questa patch e prova la prossima
-    
-    # === SALVA IMMAGINE SATELLITARE RGB (imm) ===
-    if SAVE_IMM and sat_img_raw is not None:
-        print("  Processando immagine satellitare...")
-        sat_img_processed = process_satellite_image(sat_img_raw, bbox, size=image_size)
-        # Salva immagine RGB completa (nnU-Net NaturalImage2DIO gestisce RGB automaticamente)
-        img_filename = f"{dataset_name.lower()}_{saved_images:04d}_0000.png"
-        sat_img_processed.save(os.path.join(images_dir, img_filename))
-    
-    # === SALVA IMMAGINE SATELLITARE + STRADE (all) ===
-    if SAVE_ALL and sat_img_raw is not None:
-        print("  Creando immagine satellitare + strade...")
-        all_img = create_road_mask(roads_in_patch, bbox, sat_img_raw, size=image_size)
-        all_filename = f"{dataset_name.lower()}_{saved_images:04d}.png"
-        all_img.save(os.path.join(all_dir, all_filename))
-    
-    # === SALVA MASCHERA STRADE BINARIA (lab) ===
-    if SAVE_LAB:
-        print("  Creando maschera strade binaria...")
+            return False, f"Patch scartata: {reason}", {}, {}
+    
+    outputs = {}
+    
+    # === IMMAGINE SATELLITARE RGB (imm) ===
+    if (save_imm or save_store) and sat_img_raw is not None:
+        # nnU-Net NaturalImage2DIO gestisce RGB automaticamente
+        sat_img = process_satellite_image(sat_img_raw, bbox, size=size)
+        if save_imm:
+            outputs['imm'] = encode_png(sat_img, compress_level)
+        if save_store:
+            outputs['store_img'] = np.asarray(sat_img.convert('RGB'))
+    
+    # === IMMAGINE SATELLITARE + STRADE (all) ===
+    if save_all and sat_img_raw is not None:
+        outputs['all'] = encode_png(create_road_mask(roads_in_patch, bbox, sat_img_raw, size=size), compress_level)
+    
+    # === MASCHERA STRADE BINARIA (lab) ===
+    if save_lab or save_store:
         # Passa l'immagine satellitare per rimuovere strade dalle aree nere
-        lab_mask = create_road_binary_mask(roads_in_patch, bbox, size=image_size, sat_img=sat_img_raw, mask_black_areas=True)
+        lab_mask = create_road_binary_mask(roads_in_patch, bbox, size=size, sat_img=sat_img_raw, mask_black_areas=True)
         
         # Verifica che ci siano abbastanza pixel strada
-        road_pixels = np.sum(np.array(lab_mask) > 0)
+        lab_arr = np.asarray(lab_mask)
+        label_metrics = compute_label_metrics(lab_arr[None])
+        road_pixels = label_metrics['road_pixels'][0]
         if road_pixels < 50:  # Almeno 50 pixel di strada
-            print(f"  ⚠️  Troppo pochi pixel strada ({road_pixels}), patch scartata")
-            continue
-        # lab_mask ora contiene valori 0 e 1 (corretto per nnUNet)
-        lbl_filename = f"{dataset_name.lower()}_{saved_images:04d}.png"
-        lab_mask.save(os.path.join(labels_dir, lbl_filename))
+            return False, f"Troppo pochi pixel strada ({road_pixels}), patch scartata", {}, {}
+        metrics.update(metrics_row(label_metrics))
+        if save_lab:
+            # lab_mask contiene valori 0 e 1 (corretto per nnUNet)
+            outputs['lab'] = encode_png(lab_mask, compress_level)
+            # Versione visualizzabile (0/255) per debug
+            outputs['lab_viz'] = encode_png(Image.fromarray(lab_arr * np.uint8(255)), compress_level)
+        if save_store:
+            outputs['store_lab'] = lab_arr
+    
+    return True, "OK", outputs, metrics
+
+def write_patch_outputs(outputs, index):
+    """Scrive su disco (in modo atomico) i PNG di una patch accettata con il suo indice definitivo
+    
+    Returns:
+        Lista dei percorsi scritti
+    """
+    name = dataset_name.lower()
+    paths = {
+        'imm': os.path.join(images_dir, f"{name}_{index:04d}_0000.png"),
+        'all': os.path.join(all_dir, f"{name}_{index:04d}.png"),
+        'lab': os.path.join(labels_dir, f"{name}_{index:04d}.png"),
+        'lab_viz': os.path.join(labels_viz_dir, f"{name}_{index:04d}.png"),
+    }
+    written = []
+    for key, png in outputs.items():
+        if key not in paths:
+            continue  # Array per lo store (commit_patch)
+        atomic_write_bytes(paths[key], png)
+        written.append(paths[key])
+    return written
+
+def commit_patch(outputs, index, entry, journal, attempts, rng_state, store=None):
+    """Scrive i PNG (e lo store) di una patch e poi la registra nel journal (eseguita dal writer in background)"""
+    written = write_patch_outputs(outputs, index)
+    if store is not None:
+        store.append(index, entry['name'], outputs['store_img'], outputs['store_lab'])
+    entry['files'] = [os.path.relpath(path, dataset_dir) for path in written]
+    # Impronta (dimensione, mtime) dei file appena scritti: le metriche del journal
+    # valgono per l'analisi solo finché i file restano questi
+    entry['file_stats'] = {}
+    for path, rel in zip(written, entry['files']):
+        st = os.stat(path)
+        entry['file_stats'][rel] = [st.st_size, st.st_mtime_ns]
+    journal.record(entry, attempts, rng_state)
+
+def generation_fingerprint():
+    """Parametri che determinano il contenuto del dataset (per validare la ripresa)"""
+    return {
+        'source': source_cache_digest(osm_file, patch_size_deg),
+        'image_size': image_size,
+        'data': sorted(data_set),
+        'quality_filters': quality_filters,
+        'tile_server': tile_server,
+    }
+
+def main():
+    dataset_json_path = prepare_output_dirs()
+    roads, bounds = load_roads(osm_file)
+    
+    # Griglia copertura strade (cache su disco accanto al .osm.pbf)
+    road_grid = load_or_build_road_grid(roads, bounds, osm_file, patch_size_deg)
+    
+    # Journal per la ripresa: riparte dall'ultima patch salvata con lo stesso stato RNG
+    journal = GenerationJournal(dataset_dir, generation_fingerprint())
+    saved_images = 0
+    attempts = 0
+    if resume:
+        try:
+            checkpoint = journal.load()
+        except ValueError as e:
+            print(f"ERRORE: {e}")
+            sys.exit(1)
+        if checkpoint is not None:
+            saved_images, attempts, rng_state = checkpoint
+            random.setstate(rng_state)
+            print(f"✓ Ripresa dal journal: {saved_images} patch già salvate, {attempts} tentativi")
+    else:
+        journal.reset()
+    
+    # Store a shard: allineato al journal (le patch oltre l'ultima registrata vengono riscritte)
+    store = None
+    if SAVE_STORE:
+        store = ArrayStoreWriter(store_dir_for(dataset_dir), (image_size, image_size, 3),
+                                 (image_size, image_size), shard_size=store_shard_size)
+        try:
+            store.resume([entry['name'] for entry in journal.entries])
+        except ValueError as e:
+            print(f"ERRORE: {e}")
+            sys.exit(1)
+    
+    print(f"\nGenerazione {num_images} immagini con strade...\n")
+    
+    def generate_candidates():
+        """Genera all'infinito candidati (bbox, roads_in_patch, center, rng_state) in ordine deterministico
         
-        # Salva anche versione visualizzabile (0/255) per debug
-        lab_mask_viz = lab_mask.point(lambda p: p * 255)
-        lab_mask_viz.save(os.path.join(labels_viz_dir, lbl_filename))
-    
-    print(f"  ✓ Salvata\n")
-    saved_images += 1
-
-if saved_images < num_images:
-    print(f"⚠️  ATTENZIONE: Salvate solo {saved_images}/{num_images} immagini")
-else:
-    print("✓ COMPLETATO!")
-
-# Aggiorna dataset.json con il numero reale di immagini salvate
-if os.path.exists(dataset_json_path):
-    with open(dataset_json_path, 'r') as f:
-        dataset_json = json.load(f)
-    dataset_json["numTraining"] = saved_images
-    with open(dataset_json_path, 'w') as f:
-        json.dump(dataset_json, f, indent=4)
-    print(f"✓ Aggiornato dataset.json con numTraining: {saved_images}")
-
-print(f"\n📁 File salvati in:")
-if SAVE_IMM:
-    print(f"  Images (imm): {images_dir}")
-if SAVE_LAB:
-    print(f"  Labels per nnUNet (lab): {labels_dir} [valori 0/1]")
-    print(f"  Labels per visualizzazione: {labels_viz_dir} [valori 0/255]")
-if SAVE_ALL:
-    print(f"  All (all): {all_dir}")
+        Tutto lo stream RNG (random.seed(42)) viene consumato qui, nel processo
+        principale e sempre nello stesso ordine: i worker non usano RNG. rng_state è
+        lo stato subito dopo il candidato, da salvare nel journal se la patch viene accettata.
+        """
+        while True:
+            # Cerca una patch con strade
+            candidate = sample_patch_from_grid(roads, road_grid, patch_size_deg)
+            if candidate[0] is None:
+                # Griglia vuota: fallback al campionamento con retry
+                candidate = find_patch_with_roads(roads, bounds, patch_size_deg, max_attempts=50)
+            yield (*candidate, random.getstate())
+    
+    # === PIPELINE: campionamento → download (N patch in volo) → validazione/render ===
+    # Il download delle patch successive procede mentre questa viene validata e salvata
+    fetch_images = SAVE_IMM or SAVE_ALL or SAVE_LAB or SAVE_STORE  # necessario per imm, lab, all e store
+    # Validazione a stadi: tile falliti → maggiorante della luminosità sul ritaglio → is_patch_valid completo
+    tile_check = partial(precheck_satellite_tiles, size=image_size,
+                         max_black_ratio=quality_filters['max_black_ratio'],
+                         max_black_band_size=quality_filters['max_black_band_size'])
+    compose_checked = partial(compose_satellite_image_checked,
+                              min_brightness=quality_filters['min_brightness'])
+    # Cache e downloader aperti solo ora: chiusi nel finally anche se la generazione fallisce
+    tile_cache = TileCache(tile_cache_path, max_bytes=tile_cache_max_mb * 1024**2)
+    print(f"✓ Cache tile: {tile_cache_path} ({tile_cache.total_bytes / 1024**2:.1f} MB)")
+    tile_downloader = TileDownloader(tile_server, max_workers=download_workers,
+                                     rate_per_host=download_rate_per_host,
+                                     cache=tile_cache, offline=tile_cache_offline)
+    fetcher = AsyncTileFetcher(tile_downloader, satellite_tile_grid, compose_checked, tile_check_fn=tile_check)
+    pipeline = PatchPipeline(generate_candidates(), fetcher, zoom=17, size=image_size,
+                             in_flight=patches_in_flight, fetch=fetch_images)
+    
+    # Render/encoding su pool di processi; i risultati si consumano nell'ordine dei
+    # candidati, quindi gli indici strade_XXXX (e i byte) non dipendono da num_workers
+    if num_workers > 1:
+        render_pool = ProcessPoolExecutor(max_workers=num_workers,
+                                          mp_context=multiprocessing.get_context('spawn'))
+    else:
+        render_pool = ThreadPoolExecutor(max_workers=1)
+    render_window = max(2, 2 * num_workers)
+    
+    writer = BackgroundWriter(max_pending=write_queue_size)
+    pending = deque()
+    candidates = iter(pipeline)
+    exhausted = False
+    
+    try:
+        while saved_images < num_images:
+            # Riempi la finestra di render
+            while not exhausted and len(pending) < render_window and attempts < max_attempts * num_images:
+                try:
+                    (bbox, roads_in_patch, center, rng_state), sat_img_raw, early_reason = next(candidates)
+                except StopIteration:
+                    exhausted = True
+                    break
+                attempts += 1
+                
+                if bbox is None:
+                    print(f"⚠️  Nessuna patch con strade trovata dopo {attempts} tentativi")
+                    continue
+                
+                if early_reason is not None:
+                    # Scartata sui tile: nessun render, ma resta in ordine con le altre
+                    future = Future()
+                    future.set_result((False, f"Patch scartata: {early_reason}", {}, {}))
+                else:
+                    future = render_pool.submit(render_patch, bbox, roads_in_patch, sat_img_raw,
+                                                image_size, fetch_images, SAVE_IMM, SAVE_ALL, SAVE_LAB,
+                                                png_compress_level, SAVE_STORE)
+                pending.append((bbox, center, len(roads_in_patch), attempts, rng_state, future))
+            
+            if not pending:
+                break
+            
+            bbox, (x_center, y_center), n_roads, patch_attempts, rng_state, future = pending.popleft()
+            is_valid, reason, outputs, metrics = future.result()
+            
+            print(f"Patch {saved_images+1}/{num_images} - Centro: ({x_center:.4f}, {y_center:.4f})")
+            print(f"  Trovate {n_roads} strade")
+            if not is_valid:
+                print(f"  ⚠️  {reason}")
+                continue  # Salta questa patch e prova la prossima
+            
+            # Scrittura + journal in background: il ciclo passa subito alla patch successiva
+            entry = {
+                'index': saved_images,
+                'name': f"{dataset_name.lower()}_{saved_images:04d}",
+                'bbox': [float(v) for v in bbox],
+                'center': [float(x_center), float(y_center)],
+                'n_roads': n_roads,
+                'metrics': metrics,  # Tabella metriche per analyze_problematic_samples.py
+            }
+            writer.submit(commit_patch, outputs, saved_images, entry, journal, patch_attempts, rng_state, store)
+            print(f"  ✓ Salvata\n")
+            saved_images += 1
+    finally:
+        for *_, future in pending:
+            future.cancel()
+        render_pool.shutdown(wait=True)
+        pipeline.close()
+        tile_downloader.close()
+        tile_cache.close()
+        try:
+            writer.close()  # Tutti i PNG su disco prima di aggiornare dataset.json
+        finally:
+            if store is not None:
+                store.close()
+            journal.close()
+    
+    if saved_images < num_images:
+        print(f"⚠️  ATTENZIONE: Salvate solo {saved_images}/{num_images} immagini")
+    else:
+        print("✓ COMPLETATO!")
+    
+    # Aggiorna dataset.json con il numero reale di immagini salvate
+    if os.path.exists(dataset_json_path):
+        with open(dataset_json_path, 'r') as f:
+            dataset_json = json.load(f)
+        dataset_json["numTraining"] = saved_images
+        with open(dataset_json_path, 'w') as f:
+            json.dump(dataset_json, f, indent=4)
+        print(f"✓ Aggiornato dataset.json con numTraining: {saved_images}")
+    
+    print(f"✓ Tile condivisi tra patch vicine (deduplicati): {fetcher.dedup_hits}")
+    print(f"✓ Patch scartate prima del resize: {fetcher.early_rejects} "
+          f"(download annullati: {fetcher.cancelled_tiles})")
+    cache_stats = tile_cache.stats()
+    print(f"✓ Cache tile: {cache_stats['hits']} hit, {cache_stats['misses']} miss "
+          f"(hit rate {cache_stats['hit_rate']:.1%}), {cache_stats['evictions']} evizioni, "
+          f"{cache_stats['size_mb']:.1f} MB")
+    
+    print(f"\n📁 File salvati in:")
+    if SAVE_IMM:
+        print(f"  Images (imm): {images_dir}")
+    if SAVE_LAB:
+        print(f"  Labels per nnUNet (lab): {labels_dir} [valori 0/1]")
+        print(f"  Labels per visualizzazione: {labels_viz_dir} [valori 0/255]")
+    if SAVE_ALL:
+        print(f"  All (all): {all_dir}")
+    if SAVE_STORE:
+        print(f"  Store (store): {store_dir_for(dataset_dir)} [shard .npy da {store_shard_size}]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Inferenza nnU-Net in-process per immagini RGB (modello 2d di Dataset001_Strade)
+Il modello viene caricato una volta sola e riusato per tutte le immagini
+"""
+
+import os
+import numpy as np
+
+from sliding_window import plan_meta, gaussian_importance, sliding_window_probabilities
+
+# Modello di default (stesso training di test_predictions.py)
+nnunet_results_base = "/workspace/nnUNet_results"
+DEFAULT_MODEL_DIR = os.path.join(nnunet_results_base, "Dataset001_Strade", "nnUNetTrainer__nnUNetPlans__2d")
+
+
+def model_dir_for(dataset_name, configuration="2d", trainer="nnUNetTrainer", plans="nnUNetPlans",
+                  results_base=nnunet_results_base):
+    """Cartella del modello in nnUNet_results (quella che contiene fold_0, fold_1, ...)"""
+    return os.path.join(results_base, dataset_name, f"{trainer}__{plans}__{configuration}")
+
+
+class RoadPredictor:
+    """Predittore nnU-Net caldo: pesi caricati in __init__, poi solo forward
+
+    Args:
+        model_dir: Cartella del modello (nnUNetTrainer__nnUNetPlans__2d)
+        folds: Fold da usare (ensemble se più di uno)
+        checkpoint: Nome del checkpoint
+        device: 'cuda', 'cpu' o None (cuda se disponibile)
+        tile_step_size: Passo della sliding window interna di nnU-Net (frazione della patch)
+        use_mirroring: Test-time augmentation con mirroring (più preciso, ~4x più lento)
+        batch_size: Finestre per forward della rete in predict_batch
+    """
+
+    def __init__(self, model_dir=DEFAULT_MODEL_DIR, folds=(0,), checkpoint='checkpoint_final.pth',
+                 device=None, tile_step_size=0.5, use_mirroring=True, batch_size=4):
+        import torch  # pyright: ignore[reportMissingImports]
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor  # pyright: ignore[reportMissingImports]
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.predictor = nnUNetPredictor(
+            tile_step_size=tile_step_size,
+            use_gaussian=True,
+            use_mirroring=use_mirroring,
+            perform_everything_on_device=self.device.type == 'cuda',
+            device=self.device,
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=False,
+        )
+        self.predictor.initialize_from_trained_model_folder(model_dir, use_folds=tuple(folds),
+                                                            checkpoint_name=checkpoint)
+
+        # Sliding window in batch (sliding_window.py, la stessa del backend ONNX)
+        self.meta = plan_meta(self.predictor)
+        self.batch_size = max(1, batch_size)
+        self.tile_step_size = tile_step_size
+        self.mirror_axes = self.meta['mirror_axes'] if use_mirroring else []
+        self.gaussian = gaussian_importance(self.meta['patch_size'])
+        self.network = self.predictor.network.to(self.device)
+        self.network.eval()
+        if len(self.predictor.list_of_parameters) == 1:
+            self.network.load_state_dict(self.predictor.list_of_parameters[0])
+
+    def _run(self, patches):
+        """Logits delle finestre, batch_size alla volta, media sui fold dell'ensemble"""
+        import torch  # pyright: ignore[reportMissingImports]
+
+        parameters = self.predictor.list_of_parameters
+        logits = None
+        with torch.no_grad():
+            for params in parameters:
+                if len(parameters) > 1:
+                    self.network.load_state_dict(params)
+                out = []
+                for start in range(0, len(patches), self.batch_size):
+                    batch = torch.from_numpy(np.ascontiguousarray(np.stack(patches[start:start + self.batch_size])))
+                    out.append(self.network(batch.to(self.device)).float().cpu().numpy())
+                out = np.concatenate(out) if out else np.zeros((0,), dtype=np.float32)
+                logits = out if logits is None else logits + out
+        return list(logits / len(parameters))
+
+    def predict_probabilities(self, img):
+        """Probabilità della classe strada per un'immagine RGB (pipeline di nnU-Net, riferimento)
+
+        Args:
+            img: Array (H, W, 3) uint8 (come le immagini di imagesTr)
+
+        Returns:
+            Array (H, W) float32 in [0, 1]
+        """
+        # Stesso formato di NaturalImage2DIO: (canali, 1, H, W) con spacing fittizio
+        data = np.ascontiguousarray(np.asarray(img)[..., :3].transpose(2, 0, 1)[:, None], dtype=np.float32)
+        _, probabilities = self.predictor.predict_single_npy_array(
+            data, {'spacing': [999, 1, 1]}, None, None, True)
+        return np.asarray(probabilities[1, 0], dtype=np.float32)
+
+    def predict_mask(self, img, threshold=0.5):
+        """Maschera binaria (0/1, uint8) per un'immagine RGB"""
+        return (self.predict_probabilities(img) >= threshold).astype(np.uint8)
+
+    def predict_batch_probabilities(self, images):
+        """Probabilità della classe strada per una lista di immagini
+
+        Le finestre della sliding window di tutte le immagini passano nella rete
+        batch_size alla volta, invece di una finestra per forward come in
+        predict_probabilities.
+        """
+        return sliding_window_probabilities(images, self.meta, self._run, self.tile_step_size,
+                                            self.mirror_axes, self.gaussian)
+
+    def predict_batch(self, items, threshold=0.5):
+        """Maschere di un batch di immagini (finestre in batch, vedi predict_batch_probabilities)
+
+        Args:
+            items: Iterabile di array (H, W, 3) o percorsi di file immagine
+            threshold: Soglia sulla probabilità della classe strada
+
+        Returns:
+            Lista di array (H, W) uint8 0/1, nello stesso ordine di items
+        """
+        return [(p >= threshold).astype(np.uint8) for p in self.predict_batch_probabilities(list(items))]
+
+
+_predictors = {}
+
+
+def get_predictor(model_dir=DEFAULT_MODEL_DIR, folds=(0,), checkpoint='checkpoint_final.pth', device=None, **kwargs):
+    """RoadPredictor condiviso nel processo: il checkpoint viene caricato alla prima chiamata"""
+    key = (os.path.abspath(model_dir), tuple(folds), checkpoint, device, tuple(sorted(kwargs.items())))
+    if key not in _predictors:
+        _predictors[key] = RoadPredictor(model_dir, folds, checkpoint, device, **kwargs)
+    return _predictors[key]
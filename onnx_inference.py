@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Backend di inferenza CPU: rete nnU-Net 2d esportata in ONNX ed eseguita con ONNX Runtime
+Export fp32, quantizzazione int8 (dinamica o statica con calibrazione) e predittore con
+la stessa interfaccia di RoadPredictor (predict_probabilities / predict_mask / predict_batch)
+
+Preprocessing e sliding window (gli stessi di nnU-Net per le immagini 2D naturali)
+sono in sliding_window.py; qui c'è solo la sessione ONNX Runtime che esegue le finestre.
+"""
+
+import os
+import json
+import numpy as np
+
+from nnunet_inference import DEFAULT_MODEL_DIR
+from sliding_window import (load_rgb, plan_meta, preprocess, pad_to_patch, sliding_window_slices,
+                            gaussian_importance, sliding_window_probabilities)
+
+MODEL_FILE = "model_fp32.onnx"
+MODEL_INT8_FILE = "model_int8.onnx"
+META_FILE = "onnx_export.json"
+
+
+def onnx_dir_for(model_dir, fold):
+    """Cartella degli export ONNX di un fold (dentro la cartella del fold)"""
+    return os.path.join(model_dir, f"fold_{fold}", "onnx")
+
+
+def export_onnx(model_dir=DEFAULT_MODEL_DIR, fold=0, checkpoint='checkpoint_final.pth', out_dir=None, opset=17):
+    """Esporta la rete del fold in ONNX (batch dinamico, patch fissa del piano)
+
+    Salva anche onnx_export.json con patch size, schemi di normalizzazione e assi di
+    mirroring, in modo che il predittore ONNX non dipenda da nnunetv2 né da torch.
+
+    Returns:
+        Percorso del modello fp32
+    """
+    import torch  # pyright: ignore[reportMissingImports]
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor  # pyright: ignore[reportMissingImports]
+
+    out_dir = out_dir or onnx_dir_for(model_dir, fold)
+    os.makedirs(out_dir, exist_ok=True)
+
+    predictor = nnUNetPredictor(device=torch.device('cpu'), perform_everything_on_device=False,
+                                verbose=False, allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(model_dir, use_folds=(fold,), checkpoint_name=checkpoint)
+    network = predictor.network
+    network.load_state_dict(predictor.list_of_parameters[0])
+    network.eval()
+
+    plan = plan_meta(predictor)
+    dummy = torch.zeros((1, plan['num_channels'], *plan['patch_size']), dtype=torch.float32)
+
+    model_path = os.path.join(out_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(network, dummy, model_path, opset_version=opset,
+                          input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}})
+
+    meta = {
+        'model_dir': os.path.abspath(model_dir),
+        'fold': fold,
+        'checkpoint': checkpoint,
+        **plan,
+    }
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return model_path
+
+
+class PatchCalibrationReader:
+    """CalibrationDataReader di ONNX Runtime: finestre preprocessate di alcune immagini"""
+
+    def __init__(self, input_name, images, meta):
+        self.input_name = input_name
+        self._patches = (patch[None] for img in images for patch in _calibration_patches(load_rgb(img), meta))
+
+    def get_next(self):
+        patch = next(self._patches, None)
+        return None if patch is None else {self.input_name: patch}
+
+
+def _calibration_patches(img, meta):
+    data, _ = preprocess(img, meta)
+    if data is None:
+        return
+    data, _ = pad_to_patch(data, meta['patch_size'])
+    for sl in sliding_window_slices(data.shape[1:], meta['patch_size'], 0.5):
+        yield np.ascontiguousarray(data[(slice(None), *sl)])
+
+
+def quantize_onnx(onnx_dir, calibration_images=None, per_channel=True):
+    """Quantizza int8 il modello fp32 di onnx_dir
+
+    Senza immagini di calibrazione usa la quantizzazione dinamica (pesi int8,
+    attivazioni quantizzate a runtime); con calibration_images (array o percorsi)
+    quella statica QDQ, più veloce sulle convoluzioni.
+
+    Returns:
+        Percorso del modello int8
+    """
+    from onnxruntime.quantization import (QuantFormat, QuantType,  # pyright: ignore[reportMissingImports]
+                                          quantize_dynamic, quantize_static)
+
+    fp32_path = os.path.join(onnx_dir, MODEL_FILE)
+    int8_path = os.path.join(onnx_dir, MODEL_INT8_FILE)
+    if calibration_images:
+        meta = load_export_meta(onnx_dir)
+        reader = PatchCalibrationReader('input', calibration_images, meta)
+        quantize_static(fp32_path, int8_path, reader, quant_format=QuantFormat.QDQ,
+                        per_channel=per_channel, activation_type=QuantType.QInt8,
+                        weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(fp32_path, int8_path, per_channel=per_channel, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+def load_export_meta(onnx_dir):
+    with open(os.path.join(onnx_dir, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+class OnnxRoadPredictor:
+    """Predittore ONNX Runtime su CPU con la stessa interfaccia di RoadPredictor
+
+    Args:
+        onnx_dir: Cartella dell'export (modello + onnx_export.json)
+        quantized: Se True usa model_int8.onnx
+        intra_op_threads: Thread per operatore (None = default di ONNX Runtime, core fisici)
+        batch_size: Finestre per chiamata alla sessione
+        tile_step_size: Passo della sliding window (frazione della patch, come nnU-Net)
+        use_mirroring: Media dei logits sulle immagini specchiate (come nnU-Net, più lento)
+    """
+
+    def __init__(self, onnx_dir, quantized=False, intra_op_threads=None, batch_size=4,
+                 tile_step_size=0.5, use_mirroring=False):
+        import onnxruntime as ort  # pyright: ignore[reportMissingImports]
+
+        self.meta = load_export_meta(onnx_dir)
+        self.patch_size = tuple(self.meta['patch_size'])
+        self.batch_size = max(1, batch_size)
+        self.tile_step_size = tile_step_size
+        self.mirror_axes = self.meta['mirror_axes'] if use_mirroring else []
+        self.gaussian = gaussian_importance(self.patch_size)
+        self.device = 'cpu'
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        model_path = os.path.join(onnx_dir, MODEL_INT8_FILE if quantized else MODEL_FILE)
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _run(self, patches):
+        logits = []
+        for start in range(0, len(patches), self.batch_size):
+            batch = np.ascontiguousarray(np.stack(patches[start:start + self.batch_size]))
+            logits.extend(self.session.run(None, {self.input_name: batch})[0])
+        return logits
+
+    def predict_batch_probabilities(self, images):
+        """Probabilità della classe strada per una lista di immagini (finestre in batch)"""
+        return sliding_window_probabilities(images, self.meta, self._run, self.tile_step_size,
+                                            self.mirror_axes, self.gaussian)
+
+    def predict_probabilities(self, img):
+        """Probabilità della classe strada (H, W) float32 per un'immagine RGB"""
+        return self.predict_batch_probabilities([img])[0]
+
+    def predict_mask(self, img, threshold=0.5):
+        """Maschera binaria (0/1, uint8) per un'immagine RGB"""
+        return (self.predict_probabilities(img) >= threshold).astype(np.uint8)
+
+    def predict_batch(self, items, threshold=0.5):
+        """Maschere (H, W) uint8 0/1 di un batch di array o percorsi, nello stesso ordine"""
+        return [(p >= threshold).astype(np.uint8) for p in self.predict_batch_probabilities(list(items))]
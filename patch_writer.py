@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Stadio di scrittura in background per le patch accettate
+Coda limitata (backpressure) consumata da un thread che esegue le scritture in ordine
+"""
+
+import queue
+import threading
+
+_SENTINEL = object()
+
+
+class BackgroundWriter:
+    """Esegue in un thread dedicato, nell'ordine di invio, i job di scrittura su disco
+
+    Il ciclo principale accoda il job e passa subito al candidato successivo; se la
+    coda è piena submit() si blocca, quindi i PNG in attesa di scrittura restano al
+    massimo max_pending. L'ordine FIFO garantisce che il journal registri le patch
+    nello stesso ordine degli indici.
+
+    Args:
+        max_pending: Numero massimo di job in coda
+    """
+
+    def __init__(self, max_pending=16):
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._error = None
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name="patch-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _SENTINEL:
+                    return
+                if self._error is None:  # Dopo un errore i job successivi vengono scartati
+                    fn, args = job
+                    fn(*args)
+                    self.written += 1
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"Errore nello stadio di scrittura: {self._error}") from self._error
+
+    def submit(self, fn, *args):
+        """Accoda fn(*args) (bloccante se la coda è piena)"""
+        self._raise_if_failed()
+        self._queue.put((fn, args))
+
+    def close(self):
+        """Scrive i job rimasti e ferma il thread"""
+        if self._thread.is_alive():
+            self._queue.put(_SENTINEL)
+            self._thread.join()
+        self._raise_if_failed()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Mappatura strade su un'area grande (bbox) con sliding window e mosaico in streaming
+
+L'area viene ricampionata sulla stessa griglia delle patch di training (patch_size_deg
+gradi per image_size pixel, stessa composizione tile → crop → LANCZOS di
+download_satellite_image) e predetta con finestre sovrapposte. Le probabilità sono
+fuse con pesi che calano verso i bordi della finestra (nessuna cucitura visibile).
+L'area è divisa in strisce verticali di block_windows finestre; ogni striscia è
+percorsa dall'alto in basso con una banda di accumulo alta una finestra e le righe
+completate vengono scritte subito su file .npy memory-mapped: la memoria (banda e LRU
+dei tile) dipende da window e block_windows, non dalle dimensioni dell'area.
+
+Output in output_dir:
+    <name>_prob.npy  probabilità strada (H, W) uint8 0-255
+    <name>_mask.npy  maschera binaria (H, W) uint8 0/1
+    <name>.json      georeferenziazione (EPSG:4326, geotransform GDAL) e parametri
+"""
+
+import os
+import json
+import math
+import time
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+from tile_cache import TileCache
+from tile_downloader import TileDownloader
+from generation_journal import atomic_write_bytes
+from made_dataset import (latlon_to_tile, latlon_to_pixel_in_tile, patch_size_deg, image_size,
+                          tile_server, download_workers, download_rate_per_host,
+                          tile_cache_path, tile_cache_max_mb, tile_cache_offline)
+
+# === CONFIGURAZIONE ===
+region_bbox = [4.33, 50.83, 4.39, 50.87]  # [minx, miny, maxx, maxy] WGS84
+zoom = 17  # Stesso zoom delle patch di training
+window_size = image_size  # Finestra di predizione (pixel, = patch di training)
+window_overlap = 128  # Sovrapposizione tra finestre adiacenti (pixel)
+block_windows = 16  # Finestre per striscia verticale (memoria costante; +1 finestra ripredetta per riga e striscia)
+threshold = 0.5  # Soglia probabilità → maschera
+output_dir = "/workspace/region_predictions"
+output_name = "region"
+
+# Modello nnU-Net (stesso di test_predictions.py)
+model_dir = "/workspace/nnUNet_results/Dataset001_Strade/nnUNetTrainer__nnUNetPlans__2d"
+fold = 0
+device = None  # None = cuda se disponibile
+
+TILE_SIZE = 256
+MIN_BLEND_WEIGHT = 1e-3  # Peso minimo ai bordi (i bordi dell'area hanno una sola finestra)
+
+
+def window_starts(length, window, stride):
+    """Inizi delle finestre lungo un asse: passo `stride`, l'ultima allineata alla fine"""
+    if length <= window:
+        return [0]
+    starts = list(range(0, length - window, stride))
+    starts.append(length - window)
+    return starts
+
+
+def blend_weights(window, overlap):
+    """Pesi 2D (window x window) float32: rampa lineare sugli `overlap` pixel di bordo"""
+    i = np.arange(window, dtype=np.float64) + 0.5
+    if overlap > 0:
+        ramp = np.minimum(1.0, np.minimum(i, window - i) / overlap)
+    else:
+        ramp = np.ones(window)
+    ramp = np.maximum(ramp, MIN_BLEND_WEIGHT)
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def region_grid(bbox, window, deg_per_px):
+    """Griglia dei pixel dell'area
+
+    Returns:
+        (height, width, lon0, lat0): dimensioni (almeno una finestra) e angolo nord-ovest
+    """
+    lon0, lat0 = bbox[0], bbox[3]
+    width = max(window, math.ceil((bbox[2] - bbox[0]) / deg_per_px))
+    height = max(window, math.ceil((bbox[3] - bbox[1]) / deg_per_px))
+    return height, width, lon0, lat0
+
+
+def column_blocks(cols, window, width, block_windows):
+    """Strisce verticali dell'area
+
+    La striscia k possiede le colonne dal primo inizio delle sue finestre fino al primo
+    della striscia successiva e accumula anche le finestre precedenti che vi sconfinano,
+    quindi i valori sono gli stessi di un'unica banda larga quanto l'area.
+
+    Returns:
+        Lista di (own0, own1, contributing): colonne scritte [own0, own1) e inizi
+        delle finestre che le coprono
+    """
+    blocks = []
+    for k in range(0, len(cols), block_windows):
+        own0 = 0 if k == 0 else cols[k]
+        own1 = cols[k + block_windows] if k + block_windows < len(cols) else width
+        contributing = [c for c in cols if c < own1 and c + window > own0]
+        blocks.append((own0, own1, contributing))
+    return blocks
+
+
+def block_span(window, overlap, block_windows):
+    """Larghezza massima (pixel) della banda di accumulo di una striscia"""
+    return block_windows * (window - overlap) + window
+
+
+def window_bbox(row, col, window, lon0, lat0, deg_per_px):
+    """Bbox [minx, miny, maxx, maxy] della finestra con angolo in alto a sinistra (row, col)"""
+    return [lon0 + col * deg_per_px, lat0 - (row + window) * deg_per_px,
+            lon0 + (col + window) * deg_per_px, lat0 - row * deg_per_px]
+
+
+class RegionTileSource:
+    """Tile di un'area decodificati una volta e tenuti in una LRU di dimensione fissa
+
+    Le finestre sovrapposte condividono gran parte dei tile: ognuno viene letto dalla
+    cache su disco (o scaricato) e decodificato una sola volta finché resta nella LRU.
+    prefetch() accoda sull'executor del downloader i tile della riga di finestre
+    successiva mentre si predice quella corrente.
+
+    Args:
+        downloader: TileDownloader condiviso
+        zoom: Livello zoom tile
+        max_tiles: Tile decodificati tenuti in memoria
+    """
+
+    def __init__(self, downloader, zoom=17, max_tiles=512):
+        self.downloader = downloader
+        self.zoom = zoom
+        self.max_tiles = max_tiles
+        self._decoded = OrderedDict()  # (x, y) -> Image o None (mancante/corrotto)
+        self._pending = {}  # (x, y) -> Future
+        self.missing = 0
+
+    def tile_range(self, bbox):
+        """(tx0, ty0, tx1, ty1) inclusivi dei tile che coprono il bbox"""
+        tx0, ty0 = latlon_to_tile(bbox[3], bbox[0], self.zoom)
+        tx1, ty1 = latlon_to_tile(bbox[1], bbox[2], self.zoom)
+        return tx0, ty0, tx1, ty1
+
+    def prefetch(self, bboxes):
+        """Accoda il download dei tile dei bbox non ancora in memoria"""
+        for bbox in bboxes:
+            tx0, ty0, tx1, ty1 = self.tile_range(bbox)
+            for y in range(ty0, ty1 + 1):
+                for x in range(tx0, tx1 + 1):
+                    key = (x, y)
+                    if key not in self._decoded and key not in self._pending:
+                        self._pending[key] = self.downloader.submit(self.zoom, x, y)
+
+    def get(self, x, y):
+        key = (x, y)
+        if key in self._decoded:
+            self._decoded.move_to_end(key)
+            return self._decoded[key]
+        future = self._pending.pop(key, None)
+        data = future.result() if future is not None else self.downloader.fetch_tile(self.zoom, x, y)
+        tile = None
+        if data is not None:
+            try:
+                tile = Image.open(BytesIO(data)).convert('RGB')
+            except Exception:
+                tile = None  # Tile corrotto → nero
+        if tile is None:
+            self.missing += 1
+        self._decoded[key] = tile
+        while len(self._decoded) > self.max_tiles:
+            self._decoded.popitem(last=False)
+        return tile
+
+    def compose(self, bbox, size):
+        """Immagine size x size del bbox (stessa crop/resize di compose_satellite_image)"""
+        tx0, ty0, tx1, ty1 = self.tile_range(bbox)
+        composite = Image.new('RGB', ((tx1 - tx0 + 1) * TILE_SIZE, (ty1 - ty0 + 1) * TILE_SIZE))
+        for y in range(ty0, ty1 + 1):
+            for x in range(tx0, tx1 + 1):
+                tile = self.get(x, y)
+                if tile is not None:
+                    composite.paste(tile, ((x - tx0) * TILE_SIZE, (y - ty0) * TILE_SIZE))
+        x1, y1 = latlon_to_pixel_in_tile(bbox[3], bbox[0], self.zoom, tx0, ty0, TILE_SIZE)
+        x2, y2 = latlon_to_pixel_in_tile(bbox[1], bbox[2], self.zoom, tx0, ty0, TILE_SIZE)
+        return composite.crop((x1, y1, x2, y2)).resize((size, size), Image.Resampling.LANCZOS)
+
+
+def predict_region(bbox, predict_fn, source, out_dir, name, window=512, overlap=128,
+                   threshold=0.5, deg_per_px=None, block_windows=16):
+    """Predice un'area con finestre sovrapposte e scrive il mosaico in streaming
+
+    La memoria è O(window * block_span): le strisce verticali sono indipendenti e
+    ognuna ripredice le finestre della striscia precedente che la coprono (una per
+    riga con overlap < window / 2).
+
+    Args:
+        bbox: Area [minx, miny, maxx, maxy] WGS84
+        predict_fn: Funzione immagine (window, window, 3) uint8 → probabilità (window, window)
+        source: RegionTileSource
+        out_dir, name: Cartella e prefisso dei file di output
+        window, overlap: Dimensione e sovrapposizione delle finestre in pixel
+        threshold: Soglia della maschera
+        deg_per_px: Risoluzione in gradi (default patch_size_deg / image_size, come il training)
+        block_windows: Finestre per striscia verticale
+
+    Returns:
+        dict dei metadati scritti in <name>.json
+    """
+    if not 0 <= overlap < window:
+        raise ValueError(f"overlap deve essere in [0, {window}), ricevuto {overlap}")
+    if deg_per_px is None:
+        deg_per_px = patch_size_deg / image_size
+    height, width, lon0, lat0 = region_grid(bbox, window, deg_per_px)
+    stride = window - overlap
+    rows = window_starts(height, window, stride)
+    cols = window_starts(width, window, stride)
+    weights = blend_weights(window, overlap)
+    blocks = column_blocks(cols, window, width, block_windows)
+
+    os.makedirs(out_dir, exist_ok=True)
+    prob_path = os.path.join(out_dir, f"{name}_prob.npy")
+    mask_path = os.path.join(out_dir, f"{name}_mask.npy")
+    prob_out = np.lib.format.open_memmap(prob_path, mode='w+', dtype=np.uint8, shape=(height, width))
+    mask_out = np.lib.format.open_memmap(mask_path, mode='w+', dtype=np.uint8, shape=(height, width))
+
+    mask_threshold = np.float32(threshold)
+    n_windows = sum(len(rows) * len(contributing) for _, _, contributing in blocks)
+    print(f"🗺️  Area {width}x{height} px, {len(cols)}x{len(rows)} finestre "
+          f"({window} px, sovrapposizione {overlap} px), {len(blocks)} strisce")
+    start = time.time()
+    done = 0
+
+    def row_bboxes(r, contributing):
+        return [window_bbox(r, c, window, lon0, lat0, deg_per_px) for c in contributing]
+
+    source.prefetch(row_bboxes(rows[0], blocks[0][2]))
+    for bi, (own0, own1, contributing) in enumerate(blocks):
+        # Banda di accumulo: righe [band_top, band_top + window), colonne [span0, span1)
+        span0, span1 = contributing[0], contributing[-1] + window
+        acc = np.zeros((window, span1 - span0), dtype=np.float32)
+        acc_w = np.zeros((window, span1 - span0), dtype=np.float32)
+        band_top = 0
+
+        def flush(n_rows):
+            """Scrive le prime n_rows righe della banda (non più toccate da altre finestre)"""
+            prob = acc[:n_rows, own0 - span0:own1 - span0] / acc_w[:n_rows, own0 - span0:own1 - span0]
+            prob_out[band_top:band_top + n_rows, own0:own1] = np.rint(prob * 255).astype(np.uint8)
+            mask_out[band_top:band_top + n_rows, own0:own1] = prob >= mask_threshold
+
+        for ri, r in enumerate(rows):
+            if ri + 1 < len(rows):
+                source.prefetch(row_bboxes(rows[ri + 1], contributing))
+            elif bi + 1 < len(blocks):
+                source.prefetch(row_bboxes(rows[0], blocks[bi + 1][2]))
+
+            # Avanza la banda: le righe sopra r sono complete
+            shift = r - band_top
+            if shift > 0:
+                flush(shift)
+                acc[:window - shift] = acc[shift:]
+                acc_w[:window - shift] = acc_w[shift:]
+                acc[window - shift:] = 0
+                acc_w[window - shift:] = 0
+                band_top = r
+
+            for c in contributing:
+                img = source.compose(window_bbox(r, c, window, lon0, lat0, deg_per_px), window)
+                prob = np.asarray(predict_fn(np.asarray(img)), dtype=np.float32)
+                acc[:, c - span0:c - span0 + window] += prob * weights
+                acc_w[:, c - span0:c - span0 + window] += weights
+                done += 1
+
+        flush(height - band_top)
+        elapsed = time.time() - start
+        print(f"   Striscia {bi + 1}/{len(blocks)}: {done}/{n_windows} finestre ({done / max(elapsed, 1e-9):.2f} finestre/s)")
+
+    prob_out.flush()
+    mask_out.flush()
+    del prob_out, mask_out
+
+    metadata = {
+        'crs': 'EPSG:4326',
+        'geotransform': [lon0, deg_per_px, 0.0, lat0, 0.0, -deg_per_px],
+        'bbox': [lon0, lat0 - height * deg_per_px, lon0 + width * deg_per_px, lat0],
+        'requested_bbox': list(bbox),
+        'height': height,
+        'width': width,
+        'zoom': source.zoom,
+        'window': window,
+        'overlap': overlap,
+        'threshold': threshold,
+        'windows': n_windows,
+        'block_windows': block_windows,
+        'missing_tiles': source.missing,
+        'prob_file': os.path.basename(prob_path),
+        'mask_file': os.path.basename(mask_path),
+    }
+    atomic_write_bytes(os.path.join(out_dir, f"{name}.json"), json.dumps(metadata, indent=2).encode())
+    return metadata
+
+
+def main(bbox=None, out_dir=None, name=None, overlap=None):
+    from nnunet_inference import get_predictor
+
+    bbox = bbox or region_bbox
+    out_dir = out_dir or output_dir
+    name = name or output_name
+    overlap = window_overlap if overlap is None else overlap
+
+    print("🧠 Caricamento modello...")
+    predictor = get_predictor(model_dir, folds=(fold,), device=device)
+    print(f"   Device: {predictor.device}")
+
+    tile_cache = TileCache(tile_cache_path, max_bytes=tile_cache_max_mb * 1024**2)
+    downloader = TileDownloader(tile_server, max_workers=download_workers,
+                                rate_per_host=download_rate_per_host,
+                                cache=tile_cache, offline=tile_cache_offline)
+    # Due righe di finestre di una striscia in memoria (corrente + prefetch della successiva)
+    deg_per_px = patch_size_deg / image_size
+    _, width, _, _ = region_grid(bbox, window_size, deg_per_px)
+    span = min(width, block_span(window_size, overlap, block_windows))
+    tiles_per_row = (span * deg_per_px / 360.0 * 2 ** zoom) + 2
+    tiles_per_col = (window_size * deg_per_px / 360.0 * 2 ** zoom / math.cos(math.radians(bbox[1]))) + 2
+    source = RegionTileSource(downloader, zoom, max_tiles=int(2 * tiles_per_row * tiles_per_col) + 16)
+    try:
+        metadata = predict_region(bbox, predictor.predict_probabilities, source, out_dir, name,
+                                  window=window_size, overlap=overlap, threshold=threshold,
+                                  deg_per_px=deg_per_px, block_windows=block_windows)
+    finally:
+        downloader.close()
+        tile_cache.close()
+
+    print(f"\n✅ Mosaico {metadata['width']}x{metadata['height']} salvato in {out_dir}")
+    if metadata['missing_tiles']:
+        print(f"   ⚠️  Tile mancanti (neri): {metadata['missing_tiles']}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Predizione strade su un bbox con sliding window')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help='Area WGS84 (default: region_bbox)')
+    parser.add_argument('--output-dir', type=str, help='Cartella output (default: output_dir)')
+    parser.add_argument('--name', type=str, help='Prefisso dei file (default: output_name)')
+    parser.add_argument('--overlap', type=int, help='Sovrapposizione finestre in pixel')
+    args = parser.parse_args()
+    main(args.bbox, args.output_dir, args.name, args.overlap)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Metriche di qualità per patch, vettorizzate su batch (N, H, W, 3) uint8
+Condivise da made_dataset.py (validazione + tabella metriche) e analyze_problematic_samples.py
+"""
+
+import os
+import json
+import numpy as np
+
+from generation_journal import GenerationJournal
+
+
+def _as_batch(images):
+    if isinstance(images, np.ndarray) and images.ndim == 4:
+        batch = images
+    else:
+        batch = np.stack([np.asarray(img) for img in images])
+    if batch.dtype != np.uint8:
+        batch = batch.astype(np.uint8)
+    return batch
+
+
+def compute_quality_metrics(images, full=True):
+    """Statistiche di qualità di un batch di patch in un solo passaggio sul buffer uint8
+
+    Nessuna copia float64 dei canali: maschera nero = r|g|b == 0, somme intere per
+    media/deviazione standard (quadrati in uint16), pseudo-NDVI (g - r) / (g + r) > 0.15
+    riscritto come 17*g > 23*r in uint16 (stesso risultato della versione float).
+
+    Args:
+        images: Array (N, H, W, 3) uint8, oppure lista di immagini PIL/array (H, W, 3)
+        full: Se False calcola solo le metriche usate dalla validazione (più veloce)
+
+    Returns:
+        dict di array di lunghezza N:
+            black_ratio, max_black_row, max_black_col: pixel neri (tile mancanti)
+            brightness: media di tutti i canali (0-255)
+            vegetation: frazione di pixel con pseudo-NDVI > 0.15
+        e con full=True anche:
+            mean_rgb, std_rgb: (N, 3) media/deviazione standard per canale
+            vegetation_index: media G - media R
+            texture_variance: deviazione standard su tutti i canali
+    """
+    batch = _as_batch(images)
+    n, h, w, c = batch.shape
+    pixels = h * w
+    r, g, b = batch[..., 0], batch[..., 1], batch[..., 2]
+
+    black_mask = (r | g | b) == 0
+    black_rows = np.count_nonzero(black_mask, axis=2)
+    black_cols = np.count_nonzero(black_mask, axis=1)
+
+    channel_sums = batch.sum(axis=(1, 2), dtype=np.uint64)  # (N, C)
+    brightness = channel_sums.sum(axis=1) / (pixels * c)
+
+    green = np.multiply(g, 17, dtype=np.uint16) > np.multiply(r, 23, dtype=np.uint16)
+
+    metrics = {
+        'black_ratio': black_rows.sum(axis=1) / pixels,
+        'max_black_row': black_rows.max(axis=1),
+        'max_black_col': black_cols.max(axis=1),
+        'brightness': brightness,
+        'vegetation': np.count_nonzero(green.reshape(n, -1), axis=1) / pixels,
+    }
+    if not full:
+        return metrics
+
+    square_sums = np.stack([
+        np.multiply(batch[..., k], batch[..., k], dtype=np.uint16).sum(axis=(1, 2), dtype=np.uint64)
+        for k in range(c)
+    ], axis=1)
+    mean_rgb = channel_sums / pixels
+    var_rgb = np.maximum(square_sums / pixels - mean_rgb ** 2, 0.0)
+    var_all = np.maximum(square_sums.sum(axis=1) / (pixels * c) - brightness ** 2, 0.0)
+
+    metrics.update({
+        'mean_rgb': mean_rgb,
+        'std_rgb': np.sqrt(var_rgb),
+        'vegetation_index': mean_rgb[:, 1] - mean_rgb[:, 0],  # G - R
+        'texture_variance': np.sqrt(var_all),
+    })
+    return metrics
+
+
+def compute_label_metrics(labels):
+    """Pixel strada di un batch di label (N, H, W) (qualsiasi valore > 0 è strada)
+
+    Returns:
+        dict di array (N,): road_pixels, road_percentage (0-100)
+    """
+    if isinstance(labels, np.ndarray):
+        batch = labels
+    else:
+        batch = np.stack([np.asarray(label) for label in labels])
+    n = batch.shape[0]
+    road_pixels = np.count_nonzero(batch.reshape(n, -1), axis=1)
+    return {
+        'road_pixels': road_pixels,
+        'road_percentage': road_pixels / batch[0].size * 100,
+    }
+
+
+def metrics_row(metrics, i=0):
+    """Riga i di un dict di metriche come dizionario serializzabile in JSON"""
+    row = {}
+    for key, values in metrics.items():
+        value = values[i]
+        row[key] = value.tolist() if isinstance(value, np.ndarray) else value.item()
+    return row
+
+
+def load_metrics_table(dataset_dir):
+    """Legge la tabella metriche scritta durante la generazione (journal in dataset_dir)
+
+    Returns:
+        dict nome patch (es. 'strade_0000') → (metriche, file_stats), oppure None se il
+        dataset non ha un journal con metriche. file_stats è il dict percorso relativo →
+        [dimensione, mtime_ns] dei file alla generazione ({} per journal precedenti)
+    """
+    path = os.path.join(dataset_dir, GenerationJournal.LOG_FILE)
+    if not os.path.exists(path):
+        return None
+    table = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if 'metrics' not in entry or 'name' not in entry:
+                return None  # Journal di una versione senza metriche
+            table[entry['name']] = (entry['metrics'], entry.get('file_stats', {}))
+    return table
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Grafo stradale da maschere binarie e metriche topologiche
+Scheletrizzazione vettorizzata (Zhang-Suen con lookup table), grafo dei pixel dello
+scheletro, vettorizzazione in nodi/archi, completeness/correctness/quality con buffer
+e punteggio stile APLS
+"""
+
+import numpy as np
+from scipy import ndimage  # pyright: ignore[reportMissingImports]
+from scipy.sparse import coo_matrix  # pyright: ignore[reportMissingImports]
+from scipy.sparse.csgraph import connected_components, dijkstra  # pyright: ignore[reportMissingImports]
+
+# Vicini nell'ordine di Zhang-Suen: P2 (N), P3 (NE), P4 (E), P5 (SE), P6 (S), P7 (SW), P8 (W), P9 (NW)
+_NEIGHBOR_OFFSETS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+
+def _zhang_suen_luts():
+    """Lookup table (256 configurazioni dei vicini) dei pixel eliminabili nei due sotto-passi"""
+    codes = np.arange(256)
+    p = [(codes >> k) & 1 for k in range(8)]  # p[0] = P2 ... p[7] = P9
+    neighbors = sum(p)
+    transitions = sum((p[k] == 0) & (p[(k + 1) % 8] == 1) for k in range(8))
+    base = (neighbors >= 2) & (neighbors <= 6) & (transitions == 1)
+    P2, P4, P6, P8 = p[0], p[2], p[4], p[6]
+    first = base & ((P2 * P4 * P6) == 0) & ((P4 * P6 * P8) == 0)
+    second = base & ((P2 * P4 * P8) == 0) & ((P2 * P6 * P8) == 0)
+    return first, second
+
+
+_LUT_FIRST, _LUT_SECOND = _zhang_suen_luts()
+
+
+def _neighbor_codes(img):
+    """Codice a 8 bit dei vicini di ogni pixel (bordo = sfondo)"""
+    padded = np.pad(img, 1)
+    h, w = img.shape
+    code = np.zeros((h, w), dtype=np.uint8)
+    for bit, (dy, dx) in enumerate(_NEIGHBOR_OFFSETS):
+        code |= padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w] << np.uint8(bit)
+    return code
+
+
+def skeletonize(mask):
+    """Scheletro a 1 pixel di una maschera binaria (thinning di Zhang-Suen)
+
+    Il codice dei vicini sull'intera immagine (8 slice traslate) serve solo a trovare
+    i pixel di bordo iniziali; poi ogni sotto-passo valuta con la lookup table solo i
+    candidati, cioè i pixel vicini a quelli rimossi nei due sotto-passi precedenti:
+    gli altri hanno lo stesso intorno dell'ultima volta in cui è stata applicata la
+    stessa tabella e non possono cambiare. Il risultato è identico al thinning
+    completo, ma il costo segue la lunghezza del bordo invece di H*W.
+
+    Args:
+        mask: Array 2D (qualsiasi valore > 0 è strada)
+
+    Returns:
+        Array bool con lo scheletro
+    """
+    img = (np.asarray(mask) > 0).astype(np.uint8)
+    w = img.shape[1]
+    padded = np.pad(img, 1)
+    flat = padded.ravel()  # vista: le rimozioni aggiornano padded
+    offsets = np.array([dy * (w + 2) + dx for dy, dx in _NEIGHBOR_OFFSETS], dtype=np.int64)
+    bits = np.arange(8, dtype=np.uint8)
+
+    # Candidati iniziali: pixel di strada con almeno un vicino di sfondo (gli interni non sono rimovibili)
+    border = np.pad((img == 1) & (_neighbor_codes(img) != 255), 1).ravel()
+    pending = [border, border.copy()]  # pixel da rivalutare con ciascuna lookup table
+    idle = 0
+    step = 0
+    while idle < 2:
+        lut, todo, other = (_LUT_FIRST, *pending) if step % 2 == 0 else (_LUT_SECOND, *pending[::-1])
+        candidates = np.flatnonzero(todo)
+        todo[candidates] = False
+        candidates = candidates[flat[candidates] == 1]
+        removed = candidates[:0]
+        if len(candidates):
+            code = (flat[candidates[:, None] + offsets] << bits).sum(axis=1, dtype=np.int64)
+            removed = candidates[lut[code]]
+        if len(removed):
+            flat[removed] = 0
+            neighbors = (removed[:, None] + offsets).ravel()
+            todo[neighbors] = True
+            other[neighbors] = True
+            idle = 0
+        else:
+            idle += 1
+        step += 1
+    return padded[1:-1, 1:-1].astype(bool)
+
+
+def skeleton_graph(skeleton, prune_diagonals=False):
+    """Grafo dei pixel dello scheletro (8-connessione, pesi 1 e √2) come matrice sparsa
+
+    Args:
+        skeleton: Array bool dello scheletro
+        prune_diagonals: Se True scarta i collegamenti diagonali già coperti da un
+            vicino comune in 4-connessione (gli scalini dello scheletro non diventano
+            falsi incroci di grado 3)
+
+    Returns:
+        (graph, coords, index): graph è una csr_matrix simmetrica (n x n), coords
+        l'array (n, 2) delle coordinate (riga, colonna) dei nodi, index un array
+        H x W con l'indice del nodo per ogni pixel (-1 fuori dallo scheletro)
+    """
+    skeleton = np.asarray(skeleton, dtype=bool)
+    coords = np.argwhere(skeleton)
+    n = len(coords)
+    index = np.full(skeleton.shape, -1, dtype=np.int64)
+    index[skeleton] = np.arange(n)
+
+    h, w = skeleton.shape
+    rows, cols, weights = [], [], []
+    # Solo metà dei vicini: l'altra metà si ottiene per simmetria
+    for dy, dx in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        y0, y1 = max(0, -dy), h - max(0, dy)
+        x0, x1 = max(0, -dx), w - max(0, dx)
+        src = index[y0:y1, x0:x1]
+        dst = index[y0 + dy:y1 + dy, x0 + dx:x1 + dx]
+        both = (src >= 0) & (dst >= 0)
+        if prune_diagonals and dy and dx:
+            corner = skeleton[y0:y1, x0 + dx:x1 + dx] | skeleton[y0 + dy:y1 + dy, x0:x1]
+            both &= ~corner
+        rows.append(src[both])
+        cols.append(dst[both])
+        weights.append(np.full(np.count_nonzero(both), np.hypot(dy, dx)))
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    graph = coo_matrix((np.concatenate([weights, weights]),
+                        (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                       shape=(n, n)).tocsr()
+    return graph, coords, index
+
+
+def vectorize_skeleton(skeleton, min_spur_px=10):
+    """Nodi e archi (polilinee in pixel) dello scheletro, senza cicli Python sui pixel
+
+    Nodi: estremi (grado 1) e incroci (grado >= 3, pixel adiacenti fusi in un nodo nel
+    loro baricentro). Archi: catene di pixel di grado 2 tra due nodi, ordinate con una
+    sola BFS multi-sorgente (una sorgente per catena) e un lexsort; i collegamenti
+    diretti nodo-nodo diventano archi di due punti. Gli anelli isolati ricevono un
+    nodo sul loro primo pixel. Rami morti (estremo-incrocio), segmenti isolati
+    (estremo-estremo) e cappi più corti di min_spur_px vengono scartati.
+
+    Args:
+        skeleton: Array bool dello scheletro (es. da skeletonize)
+        min_spur_px: Lunghezza minima (pixel) di rami morti, segmenti isolati e cappi
+
+    Returns:
+        dict con:
+            node_coords: (k, 2) float64 coordinate (riga, colonna) dei nodi
+            node_degree: (k,) grado dei nodi nel grafo vettoriale
+            edge_u, edge_v: (e,) indici dei nodi estremi di ogni arco
+            edge_coords: (m, 2) float64 vertici (riga, colonna) di tutti gli archi concatenati
+            edge_offsets: (e + 1,) l'arco i usa edge_coords[edge_offsets[i]:edge_offsets[i + 1]]
+            edge_length: (e,) lunghezza in pixel
+    """
+    skeleton = np.asarray(skeleton, dtype=bool)
+    graph, coords, _ = skeleton_graph(skeleton, prune_diagonals=True)
+    n = len(coords)
+    degree = np.diff(graph.indptr)
+    graph = graph.tocoo()
+    src, dst = graph.row, graph.col
+    is_chain = degree == 2
+
+    # Nodi: incroci fusi per componente 8-connessa, poi estremi e pixel isolati
+    node_of = np.full(n, -1, dtype=np.int64)
+    junctions = np.flatnonzero(degree >= 3)
+    junction_mask = np.zeros(skeleton.shape, dtype=bool)
+    junction_mask[coords[junctions, 0], coords[junctions, 1]] = True
+    labels, n_junctions = ndimage.label(junction_mask, structure=np.ones((3, 3)))
+    node_of[junctions] = labels[coords[junctions, 0], coords[junctions, 1]] - 1
+    ends = np.flatnonzero(degree <= 1)
+    node_of[ends] = n_junctions + np.arange(len(ends))
+    n_nodes = n_junctions + len(ends)
+
+    # Catene: componenti connesse del sottografo dei pixel di grado 2
+    chain_edge = is_chain[src] & is_chain[dst]
+    chain_src, chain_dst = src[chain_edge], dst[chain_edge]
+    chain_degree = np.bincount(chain_src, minlength=n)
+    _, comp = connected_components(coo_matrix((np.ones(len(chain_src)), (chain_src, chain_dst)), shape=(n, n)),
+                                   directed=False)
+    chain_pixels = np.flatnonzero(is_chain)
+    chain_comp = comp[chain_pixels]
+    comp_ids, chain_id = np.unique(chain_comp, return_inverse=True)
+    n_chains = len(comp_ids)
+    chain_of = np.full(n, -1, dtype=np.int64)
+    chain_of[chain_pixels] = chain_id
+
+    # Pixel iniziale di ogni catena: l'estremo (grado interno <= 1) di indice minimo;
+    # negli anelli (nessun estremo) il pixel di indice minimo, spezzando un suo collegamento
+    is_end = is_chain & (chain_degree <= 1)
+    start = np.full(n_chains, n, dtype=np.int64)
+    np.minimum.at(start, chain_of[is_end], np.flatnonzero(is_end))
+    is_ring = start == n
+    if is_ring.any():
+        np.minimum.at(start, chain_id, np.where(is_ring[chain_id], chain_pixels, n))
+        ring_start = np.zeros(n, dtype=bool)
+        ring_start[start[is_ring]] = True
+        # Tra i due vicini del pixel iniziale tieni solo quello di indice minore
+        at_start = ring_start[chain_src]
+        other = np.where(at_start, chain_dst, chain_src)
+        pivot = np.where(at_start, chain_src, chain_dst)
+        touches = ring_start[chain_src] | ring_start[chain_dst]
+        keep_neighbor = np.full(n, n, dtype=np.int64)
+        np.minimum.at(keep_neighbor, pivot[touches], other[touches])
+        drop = touches & (other != keep_neighbor[pivot])
+        chain_src, chain_dst = chain_src[~drop], chain_dst[~drop]
+
+    # Ordine lungo le catene: distanza (in passi) dal pixel iniziale della propria catena
+    order_graph = coo_matrix((np.ones(len(chain_src)), (chain_src, chain_dst)), shape=(n, n)).tocsr()
+    if n_chains:
+        steps = dijkstra(order_graph, directed=False, unweighted=True, indices=start, min_only=True)
+    else:
+        steps = np.zeros(n)
+    ordered = chain_pixels[np.lexsort((steps[chain_pixels], chain_id))]
+    ordered_chain = chain_of[ordered]
+    chain_len = np.bincount(chain_id, minlength=n_chains)
+    chain_first = np.concatenate([[0], np.cumsum(chain_len)[:-1]]).astype(np.int64)
+    end = ordered[chain_first + chain_len - 1] if n_chains else np.zeros(0, dtype=np.int64)
+
+    # Nodi agganciati agli estremi delle catene (pixel di catena → pixel nodo)
+    attach = is_chain[src] & ~is_chain[dst]
+    att = np.unique(np.stack([src[attach], node_of[dst[attach]]], axis=1), axis=0).reshape(-1, 2)
+    att_pixel, att_node = att[:, 0], att[:, 1]
+    u = np.full(n_chains, -1, dtype=np.int64)
+    v = np.full(n_chains, -1, dtype=np.int64)
+    if len(att_pixel):
+        first_att = np.minimum(np.searchsorted(att_pixel, start, side='left'), len(att_pixel) - 1)
+        last_att = np.maximum(np.searchsorted(att_pixel, end, side='right') - 1, 0)
+        u = np.where(att_pixel[first_att] == start, att_node[first_att], -1)
+        v = np.where(att_pixel[last_att] == end, att_node[last_att], -1)
+
+    # Anelli isolati: un nodo nuovo sul pixel iniziale, arco chiuso su sé stesso
+    node_pixels = [coords[junctions], coords[ends]]
+    node_labels = [node_of[junctions], node_of[ends]]
+    free = (u < 0) & (v < 0)
+    if free.any():
+        ring_nodes = n_nodes + np.arange(np.count_nonzero(free))
+        u[free] = v[free] = ring_nodes
+        node_pixels.append(coords[start[free]])
+        node_labels.append(ring_nodes)
+        n_nodes += len(ring_nodes)
+    # Catena agganciata a un solo nodo (es. cappio su un incrocio): chiusa sullo stesso nodo
+    u = np.where(u < 0, v, u)
+    v = np.where(v < 0, u, v)
+
+    node_pixels = np.concatenate(node_pixels).astype(np.float64)
+    node_labels = np.concatenate(node_labels)
+    counts = np.bincount(node_labels, minlength=n_nodes).astype(np.float64)
+    node_coords = np.stack([np.bincount(node_labels, node_pixels[:, k], minlength=n_nodes) / np.maximum(counts, 1)
+                            for k in range(2)], axis=1)
+
+    # Vertici degli archi di catena: nodo u, pixel in ordine, nodo v
+    offsets = np.concatenate([[0], np.cumsum(chain_len + 2)]).astype(np.int64)
+    edge_coords = np.empty((offsets[-1], 2), dtype=np.float64)
+    rank = np.arange(len(ordered)) - chain_first[ordered_chain]
+    edge_coords[offsets[ordered_chain] + 1 + rank] = coords[ordered]
+    edge_coords[offsets[:-1]] = node_coords[u]
+    edge_coords[offsets[1:] - 1] = node_coords[v]
+
+    # Collegamenti diretti tra nodi diversi (es. estremo adiacente a un incrocio)
+    direct = ~is_chain[src] & ~is_chain[dst] & (node_of[src] < node_of[dst])
+    pairs = np.unique(np.stack([node_of[src[direct]], node_of[dst[direct]]], axis=1), axis=0).reshape(-1, 2)
+    edge_u = np.concatenate([u, pairs[:, 0]]).astype(np.int64)
+    edge_v = np.concatenate([v, pairs[:, 1]]).astype(np.int64)
+    edge_coords = np.concatenate([edge_coords, node_coords[pairs].reshape(-1, 2)])
+    offsets = np.concatenate([offsets, offsets[-1] + 2 * np.arange(1, len(pairs) + 1)]).astype(np.int64)
+
+    # Lunghezze: somma dei segmenti di ogni polilinea
+    seg = np.hypot(*np.diff(edge_coords, axis=0).T)
+    seg_edge = np.repeat(np.arange(len(edge_u)), np.diff(offsets))[1:]
+    same = np.diff(np.repeat(np.arange(len(edge_u)), np.diff(offsets))) == 0
+    length = np.bincount(seg_edge[same], seg[same], minlength=len(edge_u))
+
+    # Potatura di rami morti e segmenti isolati corti, poi nodi senza archi
+    node_degree = np.bincount(edge_u, minlength=n_nodes) + np.bincount(edge_v, minlength=n_nodes)
+    dead_end = (node_degree[edge_u] == 1) | (node_degree[edge_v] == 1)
+    keep = ~((dead_end | (edge_u == edge_v)) & (length < min_spur_px))
+    return _subset_edges(node_coords, edge_u, edge_v, edge_coords, offsets, length, keep)
+
+
+def _subset_edges(node_coords, edge_u, edge_v, edge_coords, offsets, length, keep):
+    """Tiene gli archi selezionati e i soli nodi che usano, rinumerandoli"""
+    sizes = np.diff(offsets)[keep]
+    vertex_keep = np.repeat(keep, np.diff(offsets))
+    edge_u, edge_v = edge_u[keep], edge_v[keep]
+    used, inverse = np.unique(np.concatenate([edge_u, edge_v]), return_inverse=True)
+    n_edges = len(edge_u)
+    edge_u, edge_v = inverse[:n_edges], inverse[n_edges:]
+    return {
+        'node_coords': node_coords[used],
+        'node_degree': np.bincount(edge_u, minlength=len(used)) + np.bincount(edge_v, minlength=len(used)),
+        'edge_u': edge_u,
+        'edge_v': edge_v,
+        'edge_coords': edge_coords[vertex_keep],
+        'edge_offsets': np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+        'edge_length': length[keep],
+    }
+
+
+def buffered_match_counts(pred_skel, gt_skel, buffer_px=3):
+    """Lunghezze (in pixel di scheletro) abbinate entro buffer_px tra predizione e GT
+
+    Una distance transform per maschera: un pixel dello scheletro è abbinato se dista
+    al più buffer_px dall'altro scheletro.
+
+    Returns:
+        Array int64 [len_gt, matched_gt, len_pred, matched_pred] (sommabile tra immagini)
+    """
+    len_gt = int(np.count_nonzero(gt_skel))
+    len_pred = int(np.count_nonzero(pred_skel))
+    matched_gt = matched_pred = 0
+    if len_gt and len_pred:
+        dist_to_pred = ndimage.distance_transform_edt(~pred_skel)
+        dist_to_gt = ndimage.distance_transform_edt(~gt_skel)
+        matched_gt = int(np.count_nonzero(dist_to_pred[gt_skel] <= buffer_px))
+        matched_pred = int(np.count_nonzero(dist_to_gt[pred_skel] <= buffer_px))
+    return np.array([len_gt, matched_gt, len_pred, matched_pred], dtype=np.int64)
+
+
+def completeness_correctness_quality(counts):
+    """Completeness, correctness e quality (Wiedemann) da [len_gt, matched_gt, len_pred, matched_pred]"""
+    len_gt, matched_gt, len_pred, matched_pred = (int(c) for c in counts)
+    completeness = matched_gt / len_gt if len_gt > 0 else 0.0
+    correctness = matched_pred / len_pred if len_pred > 0 else 0.0
+    denom = len_pred + (len_gt - matched_gt)
+    quality = matched_pred / denom if denom > 0 else 0.0
+    return completeness, correctness, quality
+
+
+def _control_points(graph, coords, shape, max_points):
+    """Nodi di controllo: estremi, un rappresentante per incrocio e punti regolari lungo lo scheletro
+
+    I pixel di grado >= 3 adiacenti (un incrocio nello scheletro a pixel) vengono
+    ridotti a uno solo; i punti intermedi (uno ogni n/max_points pixel in ordine
+    raster) fanno pesare ogni tratto in proporzione alla sua lunghezza.
+    """
+    n = graph.shape[0]
+    degree = np.diff(graph.indptr)
+    endpoints = np.flatnonzero(degree == 1)
+
+    junction_mask = np.zeros(shape, dtype=bool)
+    junctions = np.flatnonzero(degree >= 3)
+    junction_mask[coords[junctions, 0], coords[junctions, 1]] = True
+    labels, _ = ndimage.label(junction_mask, structure=np.ones((3, 3)))
+    junction_labels = labels[coords[junctions, 0], coords[junctions, 1]]
+    _, first = np.unique(junction_labels, return_index=True)
+
+    regular = np.arange(0, n, max(1, n // max_points))
+    points = np.unique(np.concatenate([endpoints, junctions[first], regular]))
+    if len(points) > max_points:
+        points = points[np.linspace(0, len(points) - 1, max_points).astype(np.int64)]
+    return points
+
+
+def _skeleton_data(skel):
+    graph, coords, index = skeleton_graph(skel)
+    return skel, graph, coords, index
+
+
+def _apls_one_way(src, dst, snap_px, max_points, min_path_px):
+    """Somiglianza delle lunghezze dei cammini minimi da src a dst (None se src non ha cammini)"""
+    src_skel, src_graph, src_coords, _ = src
+    dst_skel, dst_graph, _, dst_index = dst
+    if src_graph.shape[0] < 2:
+        return None
+    points = _control_points(src_graph, src_coords, src_skel.shape, max_points)
+    src_dist = dijkstra(src_graph, indices=points)[:, points]
+
+    iu = np.triu_indices(len(points), k=1)
+    src_len = src_dist[iu]
+    valid = np.isfinite(src_len) & (src_len >= min_path_px)
+    if not valid.any():
+        return None
+
+    dst_dist = np.full((len(points), len(points)), np.inf)
+    if dst_graph.shape[0] > 0:
+        # Proiezione dei punti di controllo sul pixel più vicino dell'altro scheletro
+        snap_dist, (near_r, near_c) = ndimage.distance_transform_edt(~dst_skel, return_indices=True)
+        pr, pc = src_coords[points, 0], src_coords[points, 1]
+        snapped = snap_dist[pr, pc] <= snap_px
+        if snapped.any():
+            dst_nodes = dst_index[near_r[pr, pc], near_c[pr, pc]]
+            sources = np.flatnonzero(snapped)
+            dist = dijkstra(dst_graph, indices=dst_nodes[sources])[:, dst_nodes]
+            dist[:, ~snapped] = np.inf
+            dst_dist[sources] = dist
+    dst_len = dst_dist[iu]
+
+    with np.errstate(invalid='ignore'):
+        penalty = np.minimum(1.0, np.abs(src_len - dst_len) / src_len)
+    penalty[~np.isfinite(dst_len)] = 1.0
+    return float(1.0 - penalty[valid].mean())
+
+
+def apls_score(pred_skel, gt_skel, snap_px=6, max_points=50, min_path_px=20):
+    """Punteggio stile APLS (Average Path Length Similarity) tra due scheletri
+
+    Per coppie di punti di controllo confronta la lunghezza del cammino minimo in un
+    grafo con quella tra i punti corrispondenti nell'altro (proiettati entro snap_px);
+    cammini mancanti valgono penalità 1, coppie più vicine di min_path_px sono
+    ignorate. Media armonica delle due direzioni GT→predizione e predizione→GT.
+
+    Returns:
+        Punteggio in [0, 1], None se nessuno dei due scheletri ha cammini
+    """
+    pred = _skeleton_data(pred_skel)
+    gt = _skeleton_data(gt_skel)
+    gt_to_pred = _apls_one_way(gt, pred, snap_px, max_points, min_path_px)
+    pred_to_gt = _apls_one_way(pred, gt, snap_px, max_points, min_path_px)
+    scores = [s for s in (gt_to_pred, pred_to_gt) if s is not None]
+    if not scores:
+        return None
+    if len(scores) == 1:
+        return scores[0]
+    a, b = scores
+    return 2 * a * b / (a + b) if (a + b) > 0 else 0.0
+
+
+def topology_metrics(pred, gt, buffer_px=3, snap_px=6, max_points=50):
+    """Metriche topologiche di una coppia predizione/GT
+
+    Returns:
+        dict con counts ([len_gt, matched_gt, len_pred, matched_pred]), completeness,
+        correctness, quality e apls (None se non definito)
+    """
+    pred_skel = skeletonize(pred)
+    gt_skel = skeletonize(gt)
+    counts = buffered_match_counts(pred_skel, gt_skel, buffer_px)
+    completeness, correctness, quality = completeness_correctness_quality(counts)
+    return {
+        'counts': counts,
+        'completeness': completeness,
+        'correctness': correctness,
+        'quality': quality,
+        'apls': apls_score(pred_skel, gt_skel, snap_px, max_points),
+    }
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Preprocessing e sliding window di nnU-Net in numpy, condivisi dai backend di inferenza
+(RoadPredictor in nnunet_inference.py, OnnxRoadPredictor in onnx_inference.py)
+
+Riproduce la pipeline di nnU-Net per le immagini 2D naturali: crop al bounding box dei
+pixel non neri, normalizzazione del piano (ZScore per canale, RGBTo0_1, ...), padding
+alla patch, finestre con pesi gaussiani e mirroring opzionale. Il backend fornisce solo
+la funzione che trasforma un batch di finestre in logits.
+"""
+
+import os
+import numpy as np
+from PIL import Image  # pyright: ignore[reportMissingImports]
+from scipy.ndimage import gaussian_filter  # pyright: ignore[reportMissingImports]
+
+
+def load_rgb(item):
+    """Immagine RGB (H, W, 3) uint8 da array o percorso di file"""
+    if isinstance(item, (str, os.PathLike)):
+        with Image.open(item) as img:
+            return np.asarray(img.convert('RGB'))
+    return np.asarray(item)[..., :3]
+
+
+def plan_meta(predictor):
+    """Parametri del piano necessari al preprocessing e alla sliding window (da un nnUNetPredictor inizializzato)"""
+    configuration = predictor.configuration_manager
+    mirror_axes = predictor.allowed_mirroring_axes
+    return {
+        'patch_size': [int(p) for p in configuration.patch_size],
+        'num_channels': len(predictor.dataset_json['channel_names']),
+        'num_classes': predictor.label_manager.num_segmentation_heads,
+        'normalization_schemes': list(configuration.normalization_schemes),
+        'intensity_properties': predictor.plans_manager.foreground_intensity_properties_per_channel,
+        'mirror_axes': list(mirror_axes) if mirror_axes is not None else [],
+    }
+
+
+def nonzero_bbox(img):
+    """Slice (righe, colonne) del bounding box dei pixel non neri (crop_to_nonzero di nnU-Net)"""
+    nonzero = np.asarray(img).any(axis=-1)
+    rows = np.flatnonzero(nonzero.any(axis=1))
+    cols = np.flatnonzero(nonzero.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)
+
+
+def normalize(data, schemes, intensity_properties):
+    """Normalizzazione per canale come i normalizer di nnU-Net (data: (C, H, W) float32)"""
+    for c, scheme in enumerate(schemes):
+        channel = data[c]
+        if scheme == 'ZScoreNormalization':
+            channel -= channel.mean()
+            channel /= max(channel.std(), 1e-8)
+        elif scheme == 'RGBTo0_1Normalization':
+            channel /= 255.0
+        elif scheme == 'CTNormalization':
+            props = intensity_properties[str(c)]
+            np.clip(channel, props['percentile_00_5'], props['percentile_99_5'], out=channel)
+            channel -= props['mean']
+            channel /= max(props['std'], 1e-8)
+        elif scheme != 'NoNormalization':
+            raise ValueError(f"Normalizzazione non supportata dal backend ONNX: {scheme}")
+    return data
+
+
+def preprocess(img, meta):
+    """Immagine (H, W, 3) uint8 → (dati (C, h, w) float32 normalizzati, bbox del crop)"""
+    img = np.asarray(img)
+    bbox = nonzero_bbox(img)
+    if bbox is None:
+        return None, None
+    data = np.ascontiguousarray(img[bbox].transpose(2, 0, 1), dtype=np.float32)
+    return normalize(data, meta['normalization_schemes'], meta['intensity_properties']), bbox
+
+
+def pad_to_patch(data, patch_size):
+    """Padding con zeri fino alla patch (pad_nd_image di nnU-Net)
+
+    Returns:
+        (dati (C, H', W'), [(prima, dopo), ...] per asse spaziale)
+    """
+    pad = []
+    for size, patch in zip(data.shape[1:], patch_size):
+        diff = max(0, patch - size)
+        pad.append((diff // 2, diff - diff // 2))
+    if any(before or after for before, after in pad):
+        data = np.pad(data, [(0, 0)] + pad)
+    return data, pad
+
+
+def sliding_window_slices(image_size, tile_size, step_size):
+    """Finestre (slice righe, slice colonne) come compute_steps_for_sliding_window di nnU-Net"""
+    steps = []
+    for size, tile in zip(image_size, tile_size):
+        n = int(np.ceil((size - tile) / (tile * step_size))) + 1
+        step = (size - tile) / (n - 1) if n > 1 else 0
+        steps.append([int(np.round(step * i)) for i in range(n)])
+    return [(slice(y, y + tile_size[0]), slice(x, x + tile_size[1])) for y in steps[0] for x in steps[1]]
+
+
+def gaussian_importance(tile_size, sigma_scale=1. / 8, value_scaling_factor=10):
+    """Pesi gaussiani della finestra (compute_gaussian di nnU-Net)"""
+    tmp = np.zeros(tile_size, dtype=np.float32)
+    tmp[tuple(t // 2 for t in tile_size)] = 1
+    gaussian = gaussian_filter(tmp, [t * sigma_scale for t in tile_size], 0, mode='constant', cval=0)
+    gaussian /= gaussian.max() / value_scaling_factor
+    gaussian[gaussian == 0] = gaussian[gaussian != 0].min()
+    return gaussian.astype(np.float32)
+
+
+def _softmax_road(logits):
+    """Probabilità della classe 1 da logits (K, H, W)"""
+    logits = logits - logits.max(axis=0, keepdims=True)
+    exp = np.exp(logits)
+    return exp[1] / exp.sum(axis=0)
+
+
+def mirror_variants(patch, mirror_axes):
+    """Varianti specchiate (come nnU-Net: tutte le combinazioni degli assi consentiti)"""
+    variants = [()]
+    for axis in mirror_axes:
+        variants += [v + (axis,) for v in variants]
+    return [(axes, np.flip(patch, [a + 1 for a in axes]) if axes else patch) for axes in variants]
+
+
+def sliding_window_probabilities(images, meta, run, tile_step_size=0.5, mirror_axes=(), gaussian=None):
+    """Probabilità della classe strada per una lista di immagini, con le finestre di tutte le immagini in batch
+
+    Args:
+        images: Lista di array (H, W, 3) o percorsi di file immagine
+        meta: Parametri del piano (plan_meta / onnx_export.json)
+        run: Funzione lista di finestre (C, h, w) float32 → lista di logits (K, h, w); è lei a
+            raggrupparle in batch per il backend (sessione ONNX Runtime, rete PyTorch)
+        tile_step_size: Passo della sliding window (frazione della patch)
+        mirror_axes: Assi spaziali specchiati (media dei logits delle varianti)
+        gaussian: Pesi della finestra (default gaussian_importance della patch)
+
+    Returns:
+        Lista di array (H, W) float32, nello stesso ordine di images
+    """
+    patch_size = tuple(meta['patch_size'])
+    if gaussian is None:
+        gaussian = gaussian_importance(patch_size)
+    prepared, jobs = [], []
+    for i, img in enumerate(images):
+        img = load_rgb(img)
+        data, bbox = preprocess(img, meta)
+        if data is None:
+            prepared.append((img.shape[:2], None, None, None, None))
+            continue
+        data, pad = pad_to_patch(data, patch_size)
+        padded_size = data.shape[1:]
+        logits = np.zeros((meta['num_classes'], *padded_size), dtype=np.float32)
+        weights = np.zeros(padded_size, dtype=np.float32)
+        prepared.append((img.shape[:2], bbox, pad, logits, weights))
+        for sl in sliding_window_slices(padded_size, patch_size, tile_step_size):
+            for axes, patch in mirror_variants(data[(slice(None), *sl)], mirror_axes):
+                jobs.append((i, sl, axes, patch))
+
+    n_variants = 2 ** len(mirror_axes)
+    outputs = run([patch for _, _, _, patch in jobs])
+    for (i, sl, axes, _), out in zip(jobs, outputs):
+        _, _, _, logits, weights = prepared[i]
+        if axes:
+            out = np.flip(out, [a + 1 for a in axes])
+        logits[(slice(None), *sl)] += out * (gaussian / n_variants)
+        if not axes:
+            weights[sl] += gaussian
+
+    results = []
+    for shape, bbox, pad, logits, weights in prepared:
+        probs = np.zeros(shape, dtype=np.float32)
+        if bbox is not None:
+            logits = logits / weights
+            crop = tuple(slice(before, logits.shape[k + 1] - after) for k, (before, after) in enumerate(pad))
+            probs[bbox] = _softmax_road(logits[(slice(None), *crop)])
+        results.append(probs)
+    return results
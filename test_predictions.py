@@ -9,10 +9,16 @@ import os
 import sys
 import numpy as np
 from PIL import Image  # pyright: ignore[reportMissingImports]
+import matplotlib  # pyright: ignore[reportMissingImports]
+matplotlib.use('Agg')  # Figure solo salvate su file (anche nei processi worker)
 import matplotlib.pyplot as plt  # pyright: ignore[reportMissingImports]
 from pathlib import Path
 import random
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from road_graph import topology_metrics, completeness_correctness_quality
+from array_store import ArrayStore
 
 # ========== CONFIGURAZIONE ==========
 dataset_name = "Dataset001_Strade"
@@ -42,23 +48,107 @@ NUM_RANDOM = 20             # Numero di immagini casuali da testare
 # Se TEST_MODE = 'specific':
 SPECIFIC_IMAGES = [166, 317, 351, 485, 711, 930, 1186, 1332, 1496, 1797]  # Numeri delle immagini (strade_XXXX)
 
+# Rendering figure di confronto: None = tutte, K = solo le K peggiori per Dice, 0 = nessuna
+RENDER_WORST_K = None
+
+# Processi per metriche e rendering (1 = tutto nel processo principale)
+NUM_WORKERS = os.cpu_count() or 1
+
+# Metriche topologiche sullo scheletro (completeness/correctness/quality con buffer, APLS)
+TOPOLOGY_METRICS = True
+TOPO_BUFFER_PX = 3  # Distanza massima (pixel) per considerare abbinati scheletro predetto e GT
+
+# Predizioni mancanti: generate in-process (modello caldo) invece di lanciare nnUNetv2_predict
+PREDICT_CHECKPOINT = 'checkpoint_final.pth'  # Stesso default di nnUNetv2_predict
+PREDICT_BATCH_SIZE = 16  # Immagini lette e predette per batch
+
+# Immagini e ground truth dallo store a shard .npy di made_dataset.py (se presente) invece dei PNG
+USE_STORE = True
+
 # ========================================
 
+_store = False  # Aperto al primo uso in ogni processo (None = nessuno store)
+
+
+def dataset_store():
+    """Store a shard del dataset (memmap in sola lettura), None se assente o disattivato"""
+    global _store
+    if _store is False:
+        _store = ArrayStore.open(raw_data_dir) if USE_STORE else None
+    return _store
+
+
+def load_image_and_gt(base_name, with_image=True):
+    """(immagine, ground truth, errore): viste dello store se presente, altrimenti PNG
+    
+    Con with_image=False il PNG dell'immagine viene solo verificato, non decodificato.
+    """
+    store = dataset_store()
+    if store is not None and base_name in store:
+        img, gt = store.get(base_name)
+        return img, gt, None
+    img_path = os.path.join(images_dir, base_name + '_0000.png')
+    gt_path = os.path.join(labels_dir, base_name + '.png')
+    if not os.path.exists(img_path):
+        return None, None, f"Immagine non trovata: {img_path}"
+    if not os.path.exists(gt_path):
+        return None, None, f"Ground truth non trovata: {gt_path}"
+    img = np.array(Image.open(img_path)) if with_image else None
+    return img, np.array(Image.open(gt_path)), None
+
+
+def load_image(image_name):
+    """Immagine da predire: vista dello store se presente, altrimenti percorso del PNG in imagesTr
+    
+    Non richiede la ground truth (come nnUNetv2_predict, ogni immagine viene predetta).
+    """
+    store = dataset_store()
+    base_name = image_name.replace('_0000.png', '')
+    if store is not None and base_name in store:
+        return store.get(base_name)[0]
+    return os.path.join(images_dir, image_name)
+
+
+def predict_missing(image_names, batch_size=PREDICT_BATCH_SIZE):
+    """Predizioni in-process con il modello del fold caricato una sola volta
+
+    Le immagini vengono lette e predette a batch; ogni maschera (0/1) viene salvata
+    come PNG in predictions_dir con lo stesso nome che userebbe nnUNetv2_predict.
+    """
+    from nnunet_inference import get_predictor, model_dir_for
+
+    os.makedirs(predictions_dir, exist_ok=True)
+    predictor = get_predictor(model_dir_for(dataset_name), folds=(fold,), checkpoint=PREDICT_CHECKPOINT)
+    print(f"   Modello caricato (fold {fold}, {PREDICT_CHECKPOINT}, device {predictor.device})")
+    for start in range(0, len(image_names), batch_size):
+        batch = image_names[start:start + batch_size]
+        masks = predictor.predict_batch([load_image(name) for name in batch])
+        for name, mask in zip(batch, masks):
+            Image.fromarray(mask).save(os.path.join(predictions_dir, name.replace('_0000.png', '.png')))
+        print(f"   {min(start + batch_size, len(image_names))}/{len(image_names)} predizioni")
+
 
 def run_predictions_if_needed():
     """Esegue predizioni se non esistono già"""
     if not os.path.exists(predictions_dir) or len(os.listdir(predictions_dir)) == 0:
-        print("\n🔮 Le predizioni non esistono ancora. Eseguile con:\n")
-        print(f"nnUNetv2_predict -i {images_dir} -o {predictions_dir} -d {dataset_id} -c 2d -f {fold}\n")
-        print("Questo comando genererà le predizioni per tutte le immagini di training.")
+        # Tutte le immagini di imagesTr più quelle presenti solo nello store
+        store = dataset_store()
+        image_names = set()
+        if os.path.isdir(images_dir):
+            image_names.update(f for f in os.listdir(images_dir) if f.endswith('_0000.png'))
+        if store is not None:
+            image_names.update(f"{name}_0000.png" for name in store.names)
+        image_names = sorted(image_names)
+        source = images_dir if store is None else f"{images_dir} + {store.store_dir}"
+        print(f"\n🔮 Le predizioni non esistono ancora ({len(image_names)} immagini in {source}).")
+        print("Verranno generate in questo processo con il modello nnU-Net del fold "
+              f"{fold} (caricato una sola volta).")
         print("Ci vorrà qualche minuto...\n")
         
         response = input("Vuoi eseguirlo ora? [y/n]: ").strip().lower()
         if response == 'y':
-            import subprocess
             print("\n⏳ Esecuzione predizioni in corso...\n")
-            cmd = f"nnUNetv2_predict -i {images_dir} -o {predictions_dir} -d {dataset_id} -c 2d -f {fold}"
-            subprocess.run(cmd, shell=True)
+            predict_missing(image_names)
             print("\n✓ Predizioni completate!\n")
         else:
             print("\n⚠️  Esegui prima le predizioni, poi rilancia questo script.")
@@ -70,44 +160,46 @@ def load_image_triple(image_name):
     # Nome base (senza _0000)
     base_name = image_name.replace('_0000.png', '')
     
-    # Percorsi
-    img_path = os.path.join(images_dir, image_name)
+    # Predizione sempre da PNG (predictions_dir)
     pred_path = os.path.join(predictions_dir, base_name + '.png')
-    gt_path = os.path.join(labels_dir, base_name + '.png')
-    
-    # Verifica esistenza
-    if not os.path.exists(img_path):
-        return None, None, None, f"Immagine non trovata: {img_path}"
     if not os.path.exists(pred_path):
         return None, None, None, f"Predizione non trovata: {pred_path}"
-    if not os.path.exists(gt_path):
-        return None, None, None, f"Ground truth non trovata: {gt_path}"
     
-    # Carica
-    img = np.array(Image.open(img_path))
+    # Immagine e ground truth: store a shard (zero-copy) o PNG
+    img, gt, error = load_image_and_gt(base_name)
+    if error:
+        return None, None, None, error
     pred = np.array(Image.open(pred_path))
-    gt = np.array(Image.open(gt_path))
     
     return img, pred, gt, None
 
 
+def confusion_counts(pred, gt):
+    """Matrice di confusione binaria in una passata: bincount di 2*gt + pred
+    
+    Returns:
+        Array int64 [TN, FP, FN, TP]
+    """
+    codes = (gt > 0).view(np.uint8) * np.uint8(2) + (pred > 0).view(np.uint8)
+    return np.bincount(codes.ravel(), minlength=4).astype(np.int64)
+
+
+def metrics_from_counts(counts):
+    """Dice, IoU, Accuracy, Precision e Recall da [TN, FP, FN, TP] (per immagine o accumulati)"""
+    tn, fp, fn, tp = (int(c) for c in counts)
+    return {
+        'dice': 2.0 * tp / (2 * tp + fp + fn) if (2 * tp + fp + fn) > 0 else 0.0,
+        'iou': tp / (tp + fp + fn) if (tp + fp + fn) > 0 else 0.0,
+        'accuracy': (tp + tn) / (tn + fp + fn + tp),
+        'precision': tp / (tp + fp) if (tp + fp) > 0 else 0.0,
+        'recall': tp / (tp + fn) if (tp + fn) > 0 else 0.0,
+    }
+
+
 def calculate_metrics(pred, gt):
     """Calcola Dice, IoU e Accuracy"""
-    pred_bool = pred > 0
-    gt_bool = gt > 0
-    
-    # Dice Coefficient
-    intersection = np.sum(pred_bool & gt_bool)
-    dice = 2.0 * intersection / (np.sum(pred_bool) + np.sum(gt_bool)) if (np.sum(pred_bool) + np.sum(gt_bool)) > 0 else 0.0
-    
-    # IoU
-    union = np.sum(pred_bool | gt_bool)
-    iou = intersection / union if union > 0 else 0.0
-    
-    # Pixel Accuracy
-    accuracy = np.sum(pred_bool == gt_bool) / pred_bool.size
-    
-    return dice, iou, accuracy
+    m = metrics_from_counts(confusion_counts(pred, gt))
+    return m['dice'], m['iou'], m['accuracy']
 
 
 def visualize_comparison(img, pred, gt, title="", save_path=None):
@@ -160,8 +252,55 @@ def visualize_comparison(img, pred, gt, title="", save_path=None):
     return dice, iou, accuracy
 
 
-def write_report(results, report_file):
-    """Scrive report con tabelle metriche"""
+def evaluate_sample(img_name):
+    """Passata metriche per un campione (worker): legge solo predizione e ground truth
+    
+    Returns:
+        (img_name, counts, topo, error): counts = [TN, FP, FN, TP], topo il dict di
+        road_graph.topology_metrics (None se disattivate); le maschere non tornano al processo principale
+    """
+    base_name = img_name.replace('_0000.png', '')
+    pred_path = os.path.join(predictions_dir, base_name + '.png')
+    if not os.path.exists(pred_path):
+        return img_name, None, None, f"Predizione non trovata: {pred_path}"
+    
+    # La ground truth arriva dallo store (vista memmap, l'immagine non viene letta) o dal PNG
+    _, gt, error = load_image_and_gt(base_name, with_image=False)
+    if error:
+        return img_name, None, None, error
+    pred = np.array(Image.open(pred_path))
+    topo = topology_metrics(pred, gt, buffer_px=TOPO_BUFFER_PX) if TOPOLOGY_METRICS else None
+    return img_name, confusion_counts(pred, gt), topo, None
+
+
+def render_sample(img_name):
+    """Passata rendering per un campione (worker): salva la figura di confronto a 4 pannelli"""
+    base_name = img_name.replace('_0000.png', '')
+    img, pred, gt, error = load_image_triple(img_name)
+    if error:
+        return error
+    save_path = os.path.join(output_images_dir, f"{base_name}_comparison.png")
+    visualize_comparison(img, pred, gt, title=base_name, save_path=save_path)
+    return None
+
+
+def parallel_map(fn, items, executor):
+    """map ordinato sul pool (o nel processo principale se executor è None)"""
+    if executor is None:
+        return map(fn, items)
+    return executor.map(fn, items, chunksize=max(1, len(items) // (NUM_WORKERS * 8)))
+
+
+def write_report(results, report_file, total_counts=None, topo_results=None, topo_counts=None):
+    """Scrive report con tabelle metriche
+    
+    Args:
+        results: Lista di (img_name, dice, iou, accuracy, precision, recall)
+        report_file: Percorso del report
+        total_counts: Matrice di confusione [TN, FP, FN, TP] accumulata su tutte le immagini
+        topo_results: Lista di (img_name, completeness, correctness, quality, apls) (opzionale)
+        topo_counts: [len_gt, matched_gt, len_pred, matched_pred] accumulati su tutte le immagini
+    """
     with open(report_file, 'w', encoding='utf-8') as f:
         # Header
         f.write("═" * 80 + "\n")
@@ -179,6 +318,8 @@ def write_report(results, report_file):
         dices = [r[1] for r in results]
         ious = [r[2] for r in results]
         accs = [r[3] for r in results]
+        precs = [r[4] for r in results]
+        recs = [r[5] for r in results]
         
         # ═══ PRIMA: STATISTICHE GLOBALI ═══
         f.write("═" * 80 + "\n")
@@ -206,19 +347,67 @@ def write_report(results, report_file):
                 f"{np.min(accs):>10.4f} "
                 f"{np.max(accs):>10.4f}\n")
         
+        f.write(f"{'Precision':<20} "
+                f"{np.mean(precs):>12.4f} "
+                f"{np.std(precs):>12.4f} "
+                f"{np.min(precs):>10.4f} "
+                f"{np.max(precs):>10.4f}\n")
+        
+        f.write(f"{'Recall':<20} "
+                f"{np.mean(recs):>12.4f} "
+                f"{np.std(recs):>12.4f} "
+                f"{np.min(recs):>10.4f} "
+                f"{np.max(recs):>10.4f}\n")
+        
         f.write("\n")
         
+        # ═══ METRICHE SULL'INTERO SET (micro) ═══
+        if total_counts is not None:
+            micro = metrics_from_counts(total_counts)
+            tn, fp, fn, tp = (int(c) for c in total_counts)
+            f.write("═" * 80 + "\n")
+            f.write("METRICHE DATASET (micro: TP/FP/FN/TN sommati su tutte le immagini)\n")
+            f.write("═" * 80 + "\n\n")
+            f.write(f"TP: {tp}  FP: {fp}  FN: {fn}  TN: {tn}\n\n")
+            f.write(f"{'Dice Coefficient':<20} {micro['dice']:>12.4f}\n")
+            f.write(f"{'IoU':<20} {micro['iou']:>12.4f}\n")
+            f.write(f"{'Pixel Accuracy':<20} {micro['accuracy']:>12.4f}\n")
+            f.write(f"{'Precision':<20} {micro['precision']:>12.4f}\n")
+            f.write(f"{'Recall':<20} {micro['recall']:>12.4f}\n")
+            f.write("\n")
+        
+        # ═══ METRICHE TOPOLOGICHE (scheletro) ═══
+        if topo_results:
+            completeness, correctness, quality = completeness_correctness_quality(topo_counts)
+            apls = [r[4] for r in topo_results if r[4] is not None]
+            f.write("═" * 80 + "\n")
+            f.write(f"METRICHE TOPOLOGICHE (scheletro, buffer {TOPO_BUFFER_PX}px)\n")
+            f.write("═" * 80 + "\n\n")
+            f.write(f"{'Completeness':<20} {completeness:>12.4f}   (lunghezza GT ritrovata)\n")
+            f.write(f"{'Correctness':<20} {correctness:>12.4f}   (lunghezza predetta corretta)\n")
+            f.write(f"{'Quality':<20} {quality:>12.4f}\n")
+            if apls:
+                f.write(f"{'APLS (media)':<20} {np.mean(apls):>12.4f}   ({len(apls)} immagini con cammini)\n")
+            f.write("\n")
+            f.write(f"{'Immagine':<25} {'Compl.':>10} {'Corr.':>10} {'Quality':>10} {'APLS':>10}\n")
+            f.write("─" * 80 + "\n")
+            for img_name, comp, corr, qual, score in topo_results:
+                base_name = img_name.replace('_0000.png', '')
+                score_str = f"{score:>10.4f}" if score is not None else f"{'-':>10}"
+                f.write(f"{base_name:<25} {comp:>10.4f} {corr:>10.4f} {qual:>10.4f} {score_str}\n")
+            f.write("\n")
+        
         # ═══ POI: TABELLA RISULTATI INDIVIDUALI ═══
         f.write("═" * 80 + "\n")
         f.write("METRICHE PER OGNI IMMAGINE\n")
         f.write("═" * 80 + "\n\n")
         
-        f.write(f"{'Immagine':<25} {'Dice':>10} {'IoU':>10} {'Accuracy':>10}\n")
+        f.write(f"{'Immagine':<25} {'Dice':>10} {'IoU':>10} {'Accuracy':>10} {'Precision':>10} {'Recall':>10}\n")
         f.write("─" * 80 + "\n")
         
-        for img_name, dice, iou, acc in results:
+        for img_name, dice, iou, acc, prec, rec in results:
             base_name = img_name.replace('_0000.png', '')
-            f.write(f"{base_name:<25} {dice:>10.4f} {iou:>10.4f} {acc:>10.4f}\n")
+            f.write(f"{base_name:<25} {dice:>10.4f} {iou:>10.4f} {acc:>10.4f} {prec:>10.4f} {rec:>10.4f}\n")
         
         f.write("─" * 80 + "\n\n")
         
@@ -294,28 +483,46 @@ def main():
         selected_images = all_images
         print(f"📋 Modalità: ALL - Tutte le {len(all_images)} immagini")
     
-    print(f"\n🎨 Elaborazione {len(selected_images)} campioni...\n")
-    
-    # Lista per raccogliere risultati
-    results = []
-    
-    # Processa ogni immagine
-    for idx, img_name in enumerate(selected_images, 1):
-        base_name = img_name.replace('_0000.png', '')
-        print(f"[{idx}/{len(selected_images)}] {base_name}")
-        
-        img, pred, gt, error = load_image_triple(img_name)
-        
-        if error:
-            print(f"  ⚠️  {error}")
-            continue
-        
-        # Crea visualizzazione
-        save_path = os.path.join(output_images_dir, f"{base_name}_comparison.png")
-        dice, iou, accuracy = visualize_comparison(img, pred, gt, title=base_name, save_path=save_path)
+    print(f"\n🎨 Elaborazione {len(selected_images)} campioni ({NUM_WORKERS} processi)...\n")
+    
+    executor = ProcessPoolExecutor(max_workers=NUM_WORKERS) if NUM_WORKERS > 1 else None
+    try:
+        # Passata 1: metriche (in ordine di selezione), matrice di confusione accumulata in streaming
+        results = []
+        total_counts = np.zeros(4, dtype=np.int64)
+        topo_results = []
+        topo_counts = np.zeros(4, dtype=np.int64)
+        for idx, (img_name, counts, topo, error) in enumerate(
+                parallel_map(evaluate_sample, selected_images, executor), 1):
+            base_name = img_name.replace('_0000.png', '')
+            print(f"[{idx}/{len(selected_images)}] {base_name}")
+            if error:
+                print(f"  ⚠️  {error}")
+                continue
+            total_counts += counts
+            m = metrics_from_counts(counts)
+            results.append((img_name, m['dice'], m['iou'], m['accuracy'], m['precision'], m['recall']))
+            if topo is not None:
+                topo_counts += topo['counts']
+                topo_results.append((img_name, topo['completeness'], topo['correctness'],
+                                     topo['quality'], topo['apls']))
         
-        # Salva risultati
-        results.append((img_name, dice, iou, accuracy))
+        # Passata 2: figure di confronto (tutte o solo le peggiori per Dice)
+        to_render = [r[0] for r in results]
+        if RENDER_WORST_K is not None:
+            worst = sorted(results, key=lambda r: r[1])[:RENDER_WORST_K]
+            to_render = [r[0] for r in worst]
+            print(f"\n🖼️  Rendering delle {len(to_render)} immagini con Dice più basso")
+        for error in parallel_map(render_sample, to_render, executor):
+            if error:
+                print(f"  ⚠️  {error}")
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    if not results:
+        print("❌ Nessun campione valutato!")
+        return
     
     # Statistiche in console
     print("\n" + "="*70)
@@ -336,10 +543,24 @@ def main():
     print(f"\nPixel Accuracy:")
     print(f"  Media: {np.mean(accs):.4f} ± {np.std(accs):.4f}")
     print(f"  Range: [{np.min(accs):.4f}, {np.max(accs):.4f}]")
+    
+    # Metriche sull'intero set (micro: somma dei pixel di tutte le immagini)
+    micro = metrics_from_counts(total_counts)
+    print(f"\nDataset (micro, tutti i pixel):")
+    print(f"  Dice: {micro['dice']:.4f} | IoU: {micro['iou']:.4f} | "
+          f"Precision: {micro['precision']:.4f} | Recall: {micro['recall']:.4f}")
+    
+    if topo_results:
+        completeness, correctness, quality = completeness_correctness_quality(topo_counts)
+        apls = [r[4] for r in topo_results if r[4] is not None]
+        print(f"\nTopologia (scheletro, buffer {TOPO_BUFFER_PX}px):")
+        print(f"  Completeness: {completeness:.4f} | Correctness: {correctness:.4f} | Quality: {quality:.4f}")
+        if apls:
+            print(f"  APLS: {np.mean(apls):.4f} ± {np.std(apls):.4f} ({len(apls)} immagini)")
     print("="*70)
     
     # Scrivi report su file
-    write_report(results, output_report_file)
+    write_report(results, output_report_file, total_counts, topo_results, topo_counts)
     
     print(f"\n✅ Elaborazione completata!")
     print(f"   📊 Report: {output_report_file}")
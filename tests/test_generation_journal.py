@@ -0,0 +1,127 @@
+"""
+GenerationJournal (checkpoint + log JSONL) e atomic_write_bytes
+"""
+
+import json
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generation_journal import GenerationJournal, atomic_write_bytes  # noqa: E402
+
+FINGERPRINT = {'source': 'abc', 'image_size': 512}
+
+
+def make_entry(index):
+    return {'index': index, 'name': f"strade_{index:04d}", 'bbox': [0.0, 0.0, 1.0, 1.0]}
+
+
+def record_patches(dataset_dir, count):
+    """Journal con `count` patch registrate; restituisce lo stato RNG dell'ultima"""
+    journal = GenerationJournal(str(dataset_dir), FINGERPRINT)
+    rng = random.Random(7)
+    state = None
+    for i in range(count):
+        rng.random()
+        state = rng.getstate()
+        journal.record(make_entry(i), attempts=3 * (i + 1), rng_state=state)
+    journal.close()
+    return state
+
+
+def test_atomic_write_bytes_replaces_without_leftovers(tmp_path):
+    path = str(tmp_path / "patch.png")
+    atomic_write_bytes(path, b"first")
+    atomic_write_bytes(path, b"second")
+    with open(path, 'rb') as f:
+        assert f.read() == b"second"
+    assert os.listdir(tmp_path) == ["patch.png"]
+
+
+def test_atomic_write_bytes_keeps_old_file_on_failure(tmp_path):
+    path = str(tmp_path / "patch.png")
+    atomic_write_bytes(path, b"original")
+    with pytest.raises(TypeError):
+        atomic_write_bytes(path, "non bytes")  # La scrittura fallisce prima del rename
+    with open(path, 'rb') as f:
+        assert f.read() == b"original"
+
+
+def test_load_roundtrip(tmp_path):
+    state = record_patches(tmp_path, 3)
+    journal = GenerationJournal(str(tmp_path), FINGERPRINT)
+    saved, attempts, rng_state = journal.load()
+    assert (saved, attempts) == (3, 9)
+    assert rng_state == state
+    assert [e['index'] for e in journal.entries] == [0, 1, 2]
+
+    # Lo stato RNG ripristinato continua la stessa sequenza
+    resumed = random.Random()
+    resumed.setstate(rng_state)
+    reference = random.Random(7)
+    for _ in range(3):
+        reference.random()
+    assert resumed.random() == reference.random()
+
+
+def test_load_without_checkpoint(tmp_path):
+    assert GenerationJournal(str(tmp_path), FINGERPRINT).load() is None
+
+
+def test_load_drops_truncated_last_line(tmp_path):
+    record_patches(tmp_path, 2)
+    log_path = os.path.join(tmp_path, GenerationJournal.LOG_FILE)
+    # Crash durante la scrittura della riga della terza patch (checkpoint ancora a 2)
+    with open(log_path, 'a') as f:
+        f.write(json.dumps(make_entry(2))[:25])
+
+    journal = GenerationJournal(str(tmp_path), FINGERPRINT)
+    saved, attempts, _ = journal.load()
+    assert (saved, attempts) == (2, 6)
+    assert [e['index'] for e in journal.entries] == [0, 1]
+    with open(log_path, 'r') as f:
+        assert [json.loads(line)['index'] for line in f] == [0, 1]  # Riga troncata eliminata
+
+
+def test_load_drops_complete_line_beyond_checkpoint(tmp_path):
+    record_patches(tmp_path, 2)
+    # Riga scritta ma checkpoint non aggiornato (crash tra le due scritture)
+    with open(os.path.join(tmp_path, GenerationJournal.LOG_FILE), 'a') as f:
+        f.write(json.dumps(make_entry(2)) + "\n")
+
+    journal = GenerationJournal(str(tmp_path), FINGERPRINT)
+    assert journal.load()[0] == 2
+    assert len(journal.entries) == 2
+
+
+def test_load_rejects_journal_shorter_than_checkpoint(tmp_path):
+    record_patches(tmp_path, 3)
+    log_path = os.path.join(tmp_path, GenerationJournal.LOG_FILE)
+    with open(log_path, 'r') as f:
+        lines = f.readlines()
+    with open(log_path, 'w') as f:
+        f.writelines(lines[:1] + [lines[1][:10]])
+    with pytest.raises(ValueError):
+        GenerationJournal(str(tmp_path), FINGERPRINT).load()
+
+
+def test_load_rejects_other_fingerprint(tmp_path):
+    record_patches(tmp_path, 1)
+    with pytest.raises(ValueError):
+        GenerationJournal(str(tmp_path), {**FINGERPRINT, 'image_size': 256}).load()
+
+
+def test_record_after_load_appends(tmp_path):
+    record_patches(tmp_path, 2)
+    journal = GenerationJournal(str(tmp_path), FINGERPRINT)
+    journal.load()
+    journal.record(make_entry(2), attempts=10, rng_state=random.Random(1).getstate())
+    journal.close()
+
+    reloaded = GenerationJournal(str(tmp_path), FINGERPRINT)
+    assert reloaded.load()[:2] == (3, 10)
+    assert [e['index'] for e in reloaded.entries] == [0, 1, 2]
@@ -0,0 +1,201 @@
+"""
+Generazione end-to-end di made_dataset.main su strade sintetiche con tile generati
+localmente (nessuna rete): un run interrotto e ripreso deve produrre esattamente gli
+stessi file di un run senza interruzioni
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+gpd = pytest.importorskip("geopandas")
+from shapely.geometry import LineString  # noqa: E402  # pyright: ignore[reportMissingModuleSource]
+
+import made_dataset  # noqa: E402
+from tile_downloader import TileDownloader  # noqa: E402
+
+NUM_IMAGES = 6
+IMAGE_SIZE = 128
+# Stato interno del run (journal, checkpoint): non fa parte del dataset
+RUN_STATE_FILES = {"generation_state.json", "generation_journal.jsonl"}
+
+
+def synthetic_roads(seed=1, count=300):
+    """Strade casuali (spezzate di 3 punti) su un'area di ~10 km"""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        x, y = rng.uniform(4.30, 4.45), rng.uniform(50.80, 50.90)
+        lines.append(LineString([(x, y)] + [(x + rng.uniform(-0.01, 0.01), y + rng.uniform(-0.01, 0.01))
+                                            for _ in range(2)]))
+    return gpd.GeoDataFrame({'highway': ['primary'] * count}, geometry=lines, crs='EPSG:4326')
+
+
+def stub_tile(z, x, y):
+    """Tile JPEG deterministico per (z, x, y), abbastanza luminoso e poco verde da passare i filtri"""
+    seed = int(hashlib.md5(f"{z}/{x}/{y}".encode()).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+    tile = rng.integers(60, 200, (256, 256, 3), dtype=np.uint8)
+    tile[..., 1] = tile[..., 0] // 2 + 40
+    buf = BytesIO()
+    Image.fromarray(tile).save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+
+class StubDownloader(TileDownloader):
+    """TileDownloader che genera i tile invece di scaricarli"""
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        StubDownloader.instances.append(self)
+
+    def fetch_tile(self, z, x, y):
+        with self._counter_lock:
+            self.downloaded += 1
+        return stub_tile(z, x, y)
+
+
+@pytest.fixture
+def generation(tmp_path_factory, monkeypatch):
+    """Funzione run(out_dir, **config) che esegue made_dataset.main come un processo nuovo"""
+    source_dir = tmp_path_factory.mktemp("source")
+    osm_file = str(source_dir / "roads.osm.pbf")
+    with open(osm_file, 'wb') as f:
+        f.write(b"stub")  # Solo per source_cache_digest: le strade arrivano da synthetic_roads
+    roads = synthetic_roads()
+    monkeypatch.setattr(made_dataset, 'read_filtered_roads', lambda path: roads.copy())
+    monkeypatch.setattr(made_dataset, 'TileDownloader', StubDownloader)
+    monkeypatch.setattr(StubDownloader, 'instances', [])
+    monkeypatch.setattr(made_dataset, 'osm_file', osm_file)
+    monkeypatch.setattr(made_dataset, 'tile_cache_path', str(source_dir / "tiles.sqlite"))
+    monkeypatch.setattr(made_dataset, 'image_size', IMAGE_SIZE)
+    monkeypatch.setattr(made_dataset, 'download_workers', 4)
+    monkeypatch.setattr(made_dataset, 'patches_in_flight', 4)
+
+    def run(out_dir, num_images=NUM_IMAGES, num_workers=1, resume=True):
+        out_dir = str(out_dir)
+        config = {
+            'dataset_dir': out_dir,
+            'images_dir': os.path.join(out_dir, "imagesTr"),
+            'labels_dir': os.path.join(out_dir, "labelsTr"),
+            'all_dir': os.path.join(out_dir, "allTr"),
+            'labels_viz_dir': os.path.join(out_dir, "labelsTr_viz"),
+            'num_images': num_images,
+            'num_workers': num_workers,
+            'resume': resume,
+        }
+        for name, value in config.items():
+            monkeypatch.setattr(made_dataset, name, value)
+        # Come all'import del modulo in un processo nuovo
+        random.seed(42)
+        np.random.seed(42)
+        made_dataset.main()
+
+    return run
+
+
+def dataset_files(out_dir):
+    """{percorso relativo: byte} di tutti i file del dataset"""
+    files = {}
+    for root, _, names in os.walk(out_dir):
+        for name in names:
+            if name in RUN_STATE_FILES:
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, out_dir)] = f.read()
+    return files
+
+
+def assert_same_dataset(actual_dir, expected_dir):
+    actual, expected = dataset_files(actual_dir), dataset_files(expected_dir)
+    assert sorted(actual) == sorted(expected)
+    for rel in expected:
+        assert actual[rel] == expected[rel], f"{rel} diverso"
+
+
+@pytest.fixture
+def reference(generation, tmp_path):
+    """Dataset di riferimento generato senza interruzioni"""
+    out_dir = tmp_path / "reference"
+    generation(out_dir)
+    files = dataset_files(out_dir)
+    assert sum(rel.startswith("imagesTr") for rel in files) == NUM_IMAGES
+    assert sum(rel.startswith("labelsTr" + os.sep) for rel in files) == NUM_IMAGES
+    return out_dir
+
+
+def crash_after(stop_after):
+    """commit_patch che dopo `stop_after` patch scrive i PNG ma muore prima del journal"""
+    commit_patch = made_dataset.commit_patch
+    calls = []
+
+    def crashing_commit(outputs, index, *args, **kwargs):
+        calls.append(index)
+        if len(calls) > stop_after:
+            # PNG già su disco ma patch non registrata nel journal: il caso peggiore
+            made_dataset.write_patch_outputs(outputs, index)
+            raise KeyboardInterrupt
+        return commit_patch(outputs, index, *args, **kwargs)
+
+    return crashing_commit
+
+
+def test_resume_after_crash_is_byte_identical(generation, reference, tmp_path, monkeypatch):
+    stop_after = 3
+    commit_patch = made_dataset.commit_patch
+    out_dir = tmp_path / "resumed"
+    monkeypatch.setattr(made_dataset, 'commit_patch', crash_after(stop_after))
+    with pytest.raises(RuntimeError):
+        generation(out_dir)
+    monkeypatch.setattr(made_dataset, 'commit_patch', commit_patch)
+
+    with open(out_dir / made_dataset.GenerationJournal.STATE_FILE, 'r') as f:
+        assert json.load(f)['saved'] == stop_after
+
+    generation(out_dir)
+    assert_same_dataset(out_dir, reference)
+
+
+def test_resume_after_partial_run_is_byte_identical(generation, reference, tmp_path):
+    out_dir = tmp_path / "resumed"
+    generation(out_dir, num_images=2)
+    generation(out_dir)
+    assert_same_dataset(out_dir, reference)
+
+
+def test_restart_without_resume_is_byte_identical(generation, reference, tmp_path):
+    out_dir = tmp_path / "restarted"
+    generation(out_dir, num_images=4)
+    generation(out_dir, resume=False)
+    assert_same_dataset(out_dir, reference)
+
+
+def test_output_independent_of_worker_count(generation, reference, tmp_path):
+    out_dir = tmp_path / "workers"
+    generation(out_dir, num_workers=3)  # Render su ProcessPoolExecutor (spawn)
+    assert_same_dataset(out_dir, reference)
+
+
+def test_downloader_and_cache_closed_when_generation_fails(generation, tmp_path, monkeypatch):
+    import sqlite3
+
+    monkeypatch.setattr(made_dataset, 'commit_patch', crash_after(1))
+    with pytest.raises(RuntimeError):
+        generation(tmp_path / "failed")
+
+    (downloader,) = StubDownloader.instances
+    assert downloader.executor._shutdown
+    with pytest.raises(sqlite3.ProgrammingError):
+        downloader.cache.get(17, 0, 0)  # Connessione SQLite chiusa
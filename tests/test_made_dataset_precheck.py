@@ -0,0 +1,178 @@
+"""
+Validazione anticipata (precheck_satellite_tiles, compose_satellite_image_checked):
+su tile costruiti ogni scarto prima del resize deve coincidere con uno scarto di
+is_patch_valid sull'immagine finale, e le patch accettate restano identiche
+"""
+
+import itertools
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("geopandas")
+import made_dataset  # noqa: E402
+from made_dataset import (compose_satellite_image, compose_satellite_image_checked,  # noqa: E402
+                          is_patch_valid, precheck_satellite_tiles, quality_filters,
+                          resized_brightness_upper_bound, satellite_tile_grid)
+
+ZOOM = 17
+SIZE = 512
+
+
+def tile_center_bbox(lat, lon, zoom=ZOOM, deg=made_dataset.patch_size_deg):
+    """Bbox di `deg` gradi centrato sul centro del tile che contiene (lat, lon): interno al mosaico 3x3"""
+    tile_x, tile_y = made_dataset.latlon_to_tile(lat, lon, zoom)
+    n = 2 ** zoom
+    lon_c = (tile_x + 0.5) / n * 360.0 - 180.0
+    lat_c = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (tile_y + 0.5) / n))))
+    return [lon_c - deg / 2, lat_c - deg / 2, lon_c + deg / 2, lat_c + deg / 2]
+
+
+# ~470x740 px nel mosaico: upscale in x, downscale in y
+BBOX = tile_center_bbox(50.85, 4.35)
+
+
+def encode(tile):
+    buf = BytesIO()
+    Image.fromarray(tile).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def textured_tile(rng, low=90, high=200):
+    """Tile grigio-marrone con texture, poca vegetazione"""
+    tile = rng.integers(low, high, (256, 256, 3), dtype=np.uint8)
+    tile[..., 1] = tile[..., 0] // 2 + low // 2
+    return tile
+
+
+def tiles_from(arrays, missing=()):
+    """Lista (dx, dy, bytes o None) per compose_satellite_image da {(dx, dy): array}"""
+    return [(dx, dy, None if (dx, dy) in missing else encode(arrays[(dx, dy)]))
+            for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
+
+
+def repeated_tiles(tile):
+    """Stesso tile in tutte e 9 le posizioni (codificato una volta sola)"""
+    data = encode(tile)
+    return [(dx, dy, data) for dy in [-1, 0, 1] for dx in [-1, 0, 1]]
+
+
+def full_check(tiles, tile_x, tile_y, size=SIZE):
+    img = compose_satellite_image(BBOX, ZOOM, tile_x, tile_y, tiles, size)
+    return img, is_patch_valid(img, **quality_filters)
+
+
+def checked(tiles, tile_x, tile_y, size=SIZE):
+    return compose_satellite_image_checked(BBOX, ZOOM, tile_x, tile_y, tiles, size,
+                                           min_brightness=quality_filters['min_brightness'])
+
+
+def assert_consistent(tiles, tile_x, tile_y, size=SIZE):
+    """Scarto anticipato ⇒ scarto di is_patch_valid; accettata ⇒ stessa immagine. Restituisce lo scarto anticipato"""
+    img, (valid, _) = full_check(tiles, tile_x, tile_y, size)
+    early_img, early_reason = checked(tiles, tile_x, tile_y, size)
+    if early_reason is not None:
+        assert not valid, early_reason
+    else:
+        assert np.array_equal(np.asarray(early_img), np.asarray(img))
+    return early_reason
+
+
+@pytest.fixture(scope="module")
+def grid():
+    tile_x, tile_y, coords = satellite_tile_grid(BBOX, ZOOM)
+    return tile_x, tile_y, coords
+
+
+def test_missing_tiles_rejected_only_when_patch_invalid(grid):
+    tile_x, tile_y, coords = grid
+    rng = np.random.default_rng(0)
+    arrays = {c: textured_tile(rng) for c in coords}
+    encoded = tiles_from(arrays)
+    check = dict(size=SIZE, max_black_ratio=quality_filters['max_black_ratio'],
+                 max_black_band_size=quality_filters['max_black_band_size'])
+
+    rejected = 0
+    for count in (0, 1, 2):
+        for missing in itertools.combinations(coords, count):
+            reason = precheck_satellite_tiles(BBOX, ZOOM, tile_x, tile_y, set(missing), **check)
+            tiles = [(dx, dy, None if (dx, dy) in missing else data) for dx, dy, data in encoded]
+            _, (valid, _) = full_check(tiles, tile_x, tile_y)
+            if reason is not None:
+                rejected += 1
+                assert not valid, (missing, reason)
+    assert rejected > 0
+    # Senza il tile centrale manca gran parte del ritaglio
+    assert precheck_satellite_tiles(BBOX, ZOOM, tile_x, tile_y, {(0, 0)}, **check) is not None
+
+    # Tile nero (presente ma tutto a zero): non è "mancante" per il precheck, lo scarta is_patch_valid
+    arrays[(0, 0)] = np.zeros((256, 256, 3), dtype=np.uint8)
+    assert precheck_satellite_tiles(BBOX, ZOOM, tile_x, tile_y, set(), **check) is None
+    assert not full_check(tiles_from(arrays), tile_x, tile_y)[1][0]
+
+
+@pytest.mark.parametrize("size", [128, SIZE])
+def test_dark_tiles_rejected_only_when_patch_invalid(grid, size):
+    tile_x, tile_y, _ = grid
+    rng = np.random.default_rng(1)
+    min_brightness = quality_filters['min_brightness']
+
+    early = []
+    for level in range(0, 90, 5):
+        uniform = np.full((256, 256, 3), level, dtype=np.uint8)
+        noisy = np.clip(rng.normal(level, 25, (256, 256, 3)), 1, 255).astype(np.uint8)
+        early.append((level, assert_consistent(repeated_tiles(uniform), tile_x, tile_y, size)))
+        assert_consistent(repeated_tiles(noisy), tile_x, tile_y, size)
+
+    # Caso peggiore per il ringing LANCZOS: punti e linee chiare isolate su fondo scuro
+    for step in (2, 3, 7):
+        for value in (150, 255):
+            specks = np.full((256, 256, 3), 20, dtype=np.uint8)
+            specks[::step, ::step] = value
+            assert_consistent(repeated_tiles(specks), tile_x, tile_y, size)
+            lines = np.full((256, 256, 3), 25, dtype=np.uint8)
+            lines[:, ::step] = value
+            assert_consistent(repeated_tiles(lines), tile_x, tile_y, size)
+
+    # Le patch chiaramente scure sono scartate già prima del resize
+    for level, reason in early:
+        if level <= 0.6 * min_brightness:
+            assert reason is not None, level
+        if level >= min_brightness:
+            assert reason is None, level
+
+
+def test_vegetation_near_threshold_left_to_full_check(grid):
+    tile_x, tile_y, coords = grid
+    rng = np.random.default_rng(2)
+    green = np.array([80, 140, 60], dtype=np.uint8)  # 17*g > 23*r
+    soil = np.array([150, 130, 110], dtype=np.uint8)
+
+    decisions = []
+    for fraction in np.linspace(0.35, 0.60, 10):
+        arrays = {}
+        for c in coords:
+            # Blocchi 16x16: la frazione di verde sopravvive al resize (un misto pixel per pixel no)
+            is_green = np.kron(rng.random((16, 16)) < fraction, np.ones((16, 16), dtype=bool))
+            arrays[c] = np.where(is_green[..., None], green, soil)
+        tiles = tiles_from(arrays)
+        assert assert_consistent(tiles, tile_x, tile_y) is None  # Nessuno scarto anticipato per la vegetazione
+        decisions.append(full_check(tiles, tile_x, tile_y)[1][0])
+    assert True in decisions and False in decisions  # La soglia cade davvero nell'intervallo
+
+
+def test_brightness_upper_bound_holds_on_random_crops():
+    rng = np.random.default_rng(3)
+    for _ in range(40):
+        h, w = rng.integers(40, 800, 2)
+        size = int(rng.choice([128, 512]))
+        crop = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        crop[rng.random((h, w)) < rng.random()] = 0  # Fondo nero con densità variabile
+        resized = Image.fromarray(crop).resize((size, size), Image.Resampling.LANCZOS)
+        assert np.asarray(resized).mean() <= resized_brightness_upper_bound(crop, size)
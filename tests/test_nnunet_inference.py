@@ -0,0 +1,95 @@
+"""
+RoadPredictor: la sliding window in batch (sliding_window.py) deve dare le stesse
+probabilità della pipeline di nnU-Net (predict_single_npy_array), anche con ensemble
+di fold e mirroring. Usa una PlainConvUNet minuscola con pesi casuali costruita dal
+plans.json del modello addestrato.
+"""
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("nnunetv2")
+
+from nnunet_inference import RoadPredictor  # noqa: E402
+
+SOURCE_MODEL_DIR = os.path.join(ROOT, "nnUNet_results", "Dataset001_Strade", "nnUNetTrainer__nnUNetPlans__2d")
+PATCH = 64
+
+# nnU-Net accumula i logits delle finestre (e la media dei fold) in float16, la pipeline
+# condivisa in float32: le probabilità differiscono solo per questo arrotondamento
+ATOL = 1e-2
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """Cartella modello (plans.json, dataset.json, fold_0/1) con una rete a 3 stadi e patch 64x64"""
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer  # pyright: ignore[reportMissingImports]
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager  # pyright: ignore[reportMissingImports]
+
+    out = str(tmp_path_factory.mktemp("model"))
+    with open(os.path.join(SOURCE_MODEL_DIR, "plans.json"), "r") as f:
+        plans = json.load(f)
+    configuration = plans['configurations']['2d']
+    configuration['patch_size'] = [PATCH, PATCH]
+    configuration['architecture']['arch_kwargs'].update(
+        n_stages=3, features_per_stage=[4, 8, 16], kernel_sizes=[[3, 3]] * 3, strides=[[1, 1], [2, 2], [2, 2]],
+        n_conv_per_stage=[1, 1, 1], n_conv_per_stage_decoder=[1, 1])
+    with open(os.path.join(out, "plans.json"), "w") as f:
+        json.dump(plans, f)
+    shutil.copy(os.path.join(SOURCE_MODEL_DIR, "dataset.json"), out)
+
+    plans_manager = PlansManager(plans)
+    configuration_manager = plans_manager.get_configuration('2d')
+    for fold in (0, 1):
+        torch.manual_seed(fold)
+        network = nnUNetTrainer.build_network_architecture(plans_manager, configuration_manager, 3, 2,
+                                                           enable_deep_supervision=False)
+        os.makedirs(os.path.join(out, f"fold_{fold}"))
+        torch.save({'network_weights': network.state_dict(), 'trainer_name': 'nnUNetTrainer',
+                    'init_args': {'configuration': '2d'}, 'inference_allowed_mirroring_axes': (0, 1)},
+                   os.path.join(out, f"fold_{fold}", "checkpoint_final.pth"))
+    return out
+
+
+def sample_images():
+    """Patch esatta, immagine più grande (più finestre), più piccola (padding) e con bordi neri (crop)"""
+    rng = np.random.default_rng(0)
+    bordered = rng.integers(0, 256, (100, 150, 3), dtype=np.uint8)
+    bordered[:10] = 0
+    bordered[:, -7:] = 0
+    return [rng.integers(0, 256, (PATCH, PATCH, 3), dtype=np.uint8),
+            rng.integers(0, 256, (100, 150, 3), dtype=np.uint8),
+            rng.integers(0, 256, (40, 50, 3), dtype=np.uint8),
+            bordered]
+
+
+@pytest.mark.parametrize("folds", [(0,), (0, 1)])
+@pytest.mark.parametrize("use_mirroring", [False, True])
+def test_batch_matches_nnunet_pipeline(model_dir, folds, use_mirroring):
+    predictor = RoadPredictor(model_dir, folds, device='cpu', use_mirroring=use_mirroring, batch_size=3)
+    images = sample_images()
+
+    batched = predictor.predict_batch_probabilities(images)
+    assert len(batched) == len(images)
+    for img, probs in zip(images, batched):
+        reference = predictor.predict_probabilities(img)
+        assert probs.shape == reference.shape == img.shape[:2]
+        np.testing.assert_allclose(probs, reference, atol=ATOL)
+
+
+def test_predict_batch_thresholds_batched_probabilities(model_dir):
+    predictor = RoadPredictor(model_dir, (0,), device='cpu', use_mirroring=False)
+    images = sample_images()
+    masks = predictor.predict_batch(images, threshold=0.5)
+    for mask, probs in zip(masks, predictor.predict_batch_probabilities(images)):
+        assert mask.dtype == np.uint8
+        np.testing.assert_array_equal(mask, (probs >= 0.5).astype(np.uint8))
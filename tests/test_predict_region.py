@@ -0,0 +1,97 @@
+"""
+predict_region con una sorgente e un predittore finti: su un'area che non è multipla
+né della finestra né delle strisce il mosaico fuso deve coincidere ovunque con
+l'uscita del predittore (nessuna cucitura, nessun bordo non scritto)
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("geopandas")
+from predict_region import predict_region, region_grid  # noqa: E402
+
+DEG_PER_PX = 1e-5
+LON0, LAT0 = 4.0, 50.0
+
+
+def region_bbox(height, width):
+    return [LON0, LAT0 - height * DEG_PER_PX, LON0 + width * DEG_PER_PX, LAT0]
+
+
+def reference_probability(rows, cols):
+    """Probabilità attesa per pixel globale: valori k/255 con k in [1, 254] (0 = pixel mai scritto)"""
+    rng = np.random.default_rng(0)
+    table = rng.integers(1, 255, (1024, 1024))
+    return table[rows, cols] / 255.0
+
+
+class PositionSource:
+    """Sorgente al posto di RegionTileSource: ogni pixel codifica la sua posizione globale (R, G = riga, colonna mod 256; B = parti alte)"""
+
+    zoom = 17
+    missing = 0
+
+    def __init__(self):
+        self.windows = []
+
+    def prefetch(self, bboxes):
+        pass
+
+    def compose(self, bbox, size):
+        row = int(round((LAT0 - bbox[3]) / DEG_PER_PX))
+        col = int(round((bbox[0] - LON0) / DEG_PER_PX))
+        self.windows.append((row, col))
+        rows, cols = np.mgrid[row:row + size, col:col + size]
+        return np.stack([rows % 256, cols % 256, (rows // 256) * 16 + cols // 256], axis=-1).astype(np.uint8)
+
+
+def decode_position(img):
+    img = img.astype(np.int64)
+    return img[..., 0] + 256 * (img[..., 2] // 16), img[..., 1] + 256 * (img[..., 2] % 16)
+
+
+def position_predictor(img):
+    return reference_probability(*decode_position(img))
+
+
+@pytest.mark.parametrize("height, width", [(173, 250), (100, 61), (64, 64), (301, 197)])
+@pytest.mark.parametrize("overlap, block_windows", [(16, 2), (16, 1), (0, 3), (24, 100)])
+def test_mosaic_equals_predictor_output(tmp_path, height, width, overlap, block_windows):
+    window = 64
+    source = PositionSource()
+    metadata = predict_region(region_bbox(height, width), position_predictor, source, str(tmp_path), "area",
+                              window=window, overlap=overlap, deg_per_px=DEG_PER_PX, block_windows=block_windows)
+    h, w, _, _ = region_grid(region_bbox(height, width), window, DEG_PER_PX)
+    assert (metadata['height'], metadata['width']) == (h, w)
+
+    prob = np.load(tmp_path / metadata['prob_file'])
+    mask = np.load(tmp_path / metadata['mask_file'])
+    expected = reference_probability(*np.mgrid[0:h, 0:w])
+    np.testing.assert_array_equal(prob, np.rint(expected * 255).astype(np.uint8))
+    np.testing.assert_array_equal(mask, (expected >= 0.5).astype(np.uint8))
+
+    # Tutte le finestre dentro l'area, ultima riga/colonna allineata al bordo
+    starts = np.array(source.windows)
+    assert starts.min() >= 0
+    assert starts[:, 0].max() == h - window and starts[:, 1].max() == w - window
+    assert metadata['windows'] == len(source.windows)
+
+
+def test_constant_predictor_fills_every_pixel(tmp_path):
+    metadata = predict_region(region_bbox(150, 230), lambda img: np.full(img.shape[:2], 0.6), PositionSource(),
+                              str(tmp_path), "area", window=64, overlap=20, deg_per_px=DEG_PER_PX, block_windows=2)
+    prob = np.load(tmp_path / metadata['prob_file'])
+    mask = np.load(tmp_path / metadata['mask_file'])
+    assert (prob == 153).all()
+    assert (mask == 1).all()
+
+
+def test_invalid_overlap():
+    with pytest.raises(ValueError):
+        predict_region(region_bbox(100, 100), position_predictor, PositionSource(), "/nonexistent", "area",
+                       window=64, overlap=64, deg_per_px=DEG_PER_PX)
@@ -0,0 +1,133 @@
+"""
+Metriche di test_predictions.py (confusion_counts, metrics_from_counts) confrontate
+con un riferimento diretto sugli insiemi di pixel, casi vuoti e totali micro
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("matplotlib")
+import test_predictions  # noqa: E402
+from test_predictions import confusion_counts, metrics_from_counts  # noqa: E402
+
+
+def reference_metrics(pred, gt):
+    """Definizioni da manuale su P = pixel predetti strada, G = pixel strada veri"""
+    p, g = pred.ravel() > 0, gt.ravel() > 0
+    inter = np.sum(p & g)
+    union = np.sum(p | g)
+
+    def ratio(num, den):
+        return num / den if den > 0 else 0.0
+
+    return {
+        'dice': ratio(2 * inter, p.sum() + g.sum()),
+        'iou': ratio(inter, union),
+        'accuracy': np.mean(p == g),
+        'precision': ratio(inter, p.sum()),
+        'recall': ratio(inter, g.sum()),
+    }
+
+
+def assert_metrics_close(actual, expected):
+    assert actual.keys() == expected.keys()
+    for key in expected:
+        assert actual[key] == pytest.approx(expected[key], abs=1e-12), key
+
+
+def random_masks(rng, shape=(64, 48), density=0.3, value=1):
+    pred = (rng.random(shape) < density).astype(np.uint8) * value
+    gt = (rng.random(shape) < density).astype(np.uint8) * value
+    return pred, gt
+
+
+def test_counts_order_and_values():
+    pred = np.array([[0, 1, 0, 1]], dtype=np.uint8)
+    gt = np.array([[0, 0, 1, 1]], dtype=np.uint8)
+    counts = confusion_counts(pred, gt)
+    assert counts.dtype == np.int64
+    assert counts.tolist() == [1, 1, 1, 1]  # [TN, FP, FN, TP]
+    assert confusion_counts(pred * 255, gt * 255).tolist() == [1, 1, 1, 1]  # Maschere 0/255
+
+
+@pytest.mark.parametrize("density", [0.02, 0.3, 0.9])
+def test_metrics_match_reference(density):
+    rng = np.random.default_rng(int(density * 100))
+    for value in (1, 255):
+        pred, gt = random_masks(rng, density=density, value=value)
+        assert_metrics_close(metrics_from_counts(confusion_counts(pred, gt)), reference_metrics(pred, gt))
+
+
+def test_empty_ground_truth():
+    pred = np.zeros((32, 32), dtype=np.uint8)
+    pred[4:8, :] = 1
+    gt = np.zeros_like(pred)
+    m = metrics_from_counts(confusion_counts(pred, gt))
+    assert_metrics_close(m, reference_metrics(pred, gt))
+    assert (m['dice'], m['iou'], m['precision'], m['recall']) == (0.0, 0.0, 0.0, 0.0)
+    assert m['accuracy'] == pytest.approx(1 - 4 / 32)
+
+
+def test_empty_prediction():
+    gt = np.zeros((32, 32), dtype=np.uint8)
+    gt[:, 10:12] = 1
+    pred = np.zeros_like(gt)
+    m = metrics_from_counts(confusion_counts(pred, gt))
+    assert_metrics_close(m, reference_metrics(pred, gt))
+    assert (m['dice'], m['iou'], m['precision'], m['recall']) == (0.0, 0.0, 0.0, 0.0)
+    assert m['accuracy'] == pytest.approx(1 - 2 / 32)
+
+
+def test_both_empty():
+    empty = np.zeros((16, 16), dtype=np.uint8)
+    m = metrics_from_counts(confusion_counts(empty, empty))
+    assert (m['dice'], m['iou'], m['precision'], m['recall']) == (0.0, 0.0, 0.0, 0.0)
+    assert m['accuracy'] == 1.0
+
+
+def test_micro_totals_across_images():
+    rng = np.random.default_rng(7)
+    # Immagini di dimensioni e densità diverse, una senza strade: micro ≠ media per immagine
+    pairs = [random_masks(rng, (64, 64), 0.4), random_masks(rng, (32, 80), 0.05), random_masks(rng, (20, 20), 0.7)]
+    pairs.append((np.zeros((16, 16), dtype=np.uint8), np.zeros((16, 16), dtype=np.uint8)))
+
+    total = np.zeros(4, dtype=np.int64)
+    for pred, gt in pairs:
+        total += confusion_counts(pred, gt)
+    all_pred = np.concatenate([p.ravel() for p, _ in pairs])
+    all_gt = np.concatenate([g.ravel() for _, g in pairs])
+
+    assert total.tolist() == confusion_counts(all_pred, all_gt).tolist()
+    micro = metrics_from_counts(total)
+    assert_metrics_close(micro, reference_metrics(all_pred, all_gt))
+    macro_dice = np.mean([metrics_from_counts(confusion_counts(p, g))['dice'] for p, g in pairs])
+    assert micro['dice'] != pytest.approx(macro_dice)
+
+
+def test_evaluate_sample_reads_prediction_and_png_ground_truth(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    pred, gt = random_masks(rng)
+    for name in ("predictions", "imagesTr", "labelsTr"):
+        os.makedirs(tmp_path / name)
+    Image.fromarray(pred).save(tmp_path / "predictions" / "strade_0001.png")
+    Image.fromarray(gt).save(tmp_path / "labelsTr" / "strade_0001.png")
+    Image.fromarray(np.zeros((*gt.shape, 3), dtype=np.uint8)).save(tmp_path / "imagesTr" / "strade_0001_0000.png")
+    monkeypatch.setattr(test_predictions, 'predictions_dir', str(tmp_path / "predictions"))
+    monkeypatch.setattr(test_predictions, 'images_dir', str(tmp_path / "imagesTr"))
+    monkeypatch.setattr(test_predictions, 'labels_dir', str(tmp_path / "labelsTr"))
+    monkeypatch.setattr(test_predictions, 'USE_STORE', False)
+    monkeypatch.setattr(test_predictions, '_store', False)
+    monkeypatch.setattr(test_predictions, 'TOPOLOGY_METRICS', False)
+
+    name, counts, topo, error = test_predictions.evaluate_sample("strade_0001_0000.png")
+    assert (name, topo, error) == ("strade_0001_0000.png", None, None)
+    assert counts.tolist() == confusion_counts(pred, gt).tolist()
+
+    _, counts, _, error = test_predictions.evaluate_sample("strade_0002_0000.png")
+    assert counts is None and "Predizione non trovata" in error
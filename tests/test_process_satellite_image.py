@@ -0,0 +1,79 @@
+"""
+Regressione di process_satellite_image (PIL) rispetto al vecchio rendering matplotlib
+(imshow(extent=bbox, aspect='equal') su una Figure size x size)
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("matplotlib")
+
+from made_dataset import process_satellite_image  # noqa: E402
+
+
+def process_satellite_image_matplotlib(sat_img, bbox, size=512):
+    """Implementazione precedente (riferimento), copiata da made_dataset.py"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg  # pyright: ignore[reportMissingImports]
+    from matplotlib.figure import Figure  # pyright: ignore[reportMissingImports]
+
+    fig = Figure(figsize=(size/100, size/100), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(bbox[0], bbox[2])
+    ax.set_ylim(bbox[1], bbox[3])
+    ax.set_aspect('equal', adjustable='box')
+    ax.axis('off')
+    ax.set_facecolor('black')
+    ax.imshow(sat_img, extent=[bbox[0], bbox[2], bbox[1], bbox[3]], aspect='equal', interpolation='bilinear')
+    ax.set_xlim(bbox[0], bbox[2])
+    ax.set_ylim(bbox[1], bbox[3])
+    ax.set_aspect('equal', adjustable='box')
+    fig.set_size_inches(size/100, size/100)
+    canvas.draw()
+    img_array = np.frombuffer(canvas.buffer_rgba(), dtype=np.uint8).reshape(size, size, 4)
+    return Image.fromarray(img_array[:, :, :3], mode='RGB')
+
+
+def satellite_like(size, seed=0):
+    """Immagine RGB con bassa e alta frequenza (gradienti + rumore), come un ritaglio satellitare"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    base = np.stack([(x * 255 // size), (y * 255 // size), ((x + y) * 127 // size)], axis=-1)
+    noise = rng.integers(-30, 31, (size, size, 3))
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), mode='RGB')
+
+
+def pixel_diff(bbox, size=512, seed=0):
+    sat_img = satellite_like(size, seed)
+    new = np.asarray(process_satellite_image(sat_img, bbox, size=size), dtype=np.int16)
+    old = np.asarray(process_satellite_image_matplotlib(sat_img, bbox, size=size), dtype=np.int16)
+    assert new.shape == old.shape == (size, size, 3)
+    return np.abs(new - old)
+
+
+@pytest.mark.parametrize("bbox", [
+    [4.35, 50.85, 4.355, 50.855],   # Patch di made_dataset.py (patch_size_deg = 0.005)
+    [0.0, 0.0, 1.0, 1.0],
+    [-70.2, -33.5, -70.1, -33.4],
+])
+def test_square_bbox_is_pixel_exact(bbox):
+    # Caso di download_satellite_image: bbox quadrato, immagine già size x size
+    assert pixel_diff(bbox).max() == 0
+
+
+@pytest.mark.parametrize("bbox", [
+    [4.35, 50.85, 4.360, 50.855],   # 2:1 orizzontale
+    [4.35, 50.85, 4.355, 50.860],   # 1:2 verticale
+    [4.35, 50.85, 4.357, 50.855],   # 7:5
+])
+def test_non_square_bbox_is_close(bbox):
+    # Resize bilineare PIL vs ricampionamento di Agg: differenze solo ai bordi delle transizioni
+    diff = pixel_diff(bbox)
+    assert diff.mean() <= 1.0
+    assert diff.max() <= 16
@@ -0,0 +1,114 @@
+"""
+road_graph: scheletrizzazione su forme note e contro un Zhang-Suen diretto,
+completeness/correctness/quality e APLS su maschere identiche, interrotte e vuote
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("scipy")
+from road_graph import apls_score, skeletonize, topology_metrics, vectorize_skeleton  # noqa: E402
+
+SHAPE = (200, 200)
+
+
+def reference_zhang_suen(mask):
+    """Thinning di Zhang-Suen pixel per pixel, sull'intera immagine a ogni sotto-passo"""
+    img = np.pad((mask > 0).astype(np.uint8), 1)
+    while True:
+        changed = False
+        for first in (True, False):
+            remove = []
+            for y, x in np.argwhere(img):
+                p = [img[y - 1, x], img[y - 1, x + 1], img[y, x + 1], img[y + 1, x + 1],
+                     img[y + 1, x], img[y + 1, x - 1], img[y, x - 1], img[y - 1, x - 1]]
+                neighbors = sum(p)
+                transitions = sum(p[k] == 0 and p[(k + 1) % 8] == 1 for k in range(8))
+                if not (2 <= neighbors <= 6 and transitions == 1):
+                    continue
+                if first and p[0] * p[2] * p[4] == 0 and p[2] * p[4] * p[6] == 0:
+                    remove.append((y, x))
+                if not first and p[0] * p[2] * p[6] == 0 and p[0] * p[4] * p[6] == 0:
+                    remove.append((y, x))
+            for y, x in remove:
+                img[y, x] = 0
+            changed |= bool(remove)
+        if not changed:
+            return img[1:-1, 1:-1].astype(bool)
+
+
+def cross_roads():
+    """Strada orizzontale e verticale larghe 5 px che si incrociano"""
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[98:103, 10:190] = 1
+    mask[10:190, 60:65] = 1
+    return mask
+
+
+def test_skeletonize_horizontal_bar():
+    mask = np.zeros((30, 80), dtype=np.uint8)
+    mask[10:17, 5:75] = 255
+    skel = skeletonize(mask)
+    rows, cols = np.nonzero(skel)
+    assert skel.dtype == bool
+    assert set(rows) == {13}  # Riga centrale della barra
+    assert cols.min() > 5 and cols.max() < 74 and len(cols) == cols.max() - cols.min() + 1
+
+
+def test_skeletonize_cross_is_one_connected_junction():
+    skel = skeletonize(cross_roads())
+    assert not (skel & ~cross_roads().astype(bool)).any()  # Dentro la maschera
+    graph = vectorize_skeleton(skel)
+    assert sorted(graph['node_degree'].tolist()) == [1, 1, 1, 1, 4]
+    junction = graph['node_coords'][graph['node_degree'] == 4][0]
+    assert np.allclose(junction, (100, 62), atol=1.5)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_skeletonize_matches_reference_thinning(seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((48, 48), dtype=np.uint8)
+    for _ in range(6):  # Rettangoli sovrapposti: bordi, incroci e buchi
+        y, x = rng.integers(0, 40, 2)
+        h, w = rng.integers(3, 20, 2)
+        mask[y:y + h, x:x + w] = 1
+    mask[rng.random(mask.shape) < 0.03] ^= 1
+    np.testing.assert_array_equal(skeletonize(mask), reference_zhang_suen(mask))
+
+
+def test_skeletonize_empty():
+    assert not skeletonize(np.zeros((16, 16), dtype=np.uint8)).any()
+
+
+def test_identical_masks_score_one():
+    mask = cross_roads()
+    m = topology_metrics(mask, mask)
+    assert (m['completeness'], m['correctness'], m['quality'], m['apls']) == (1.0, 1.0, 1.0, 1.0)
+
+
+def test_broken_road_lowers_apls_not_completeness():
+    gt = cross_roads()
+    pred = gt.copy()
+    pred[95:106, 120:126] = 0  # Interruzione di 6 px sulla strada orizzontale
+    m = topology_metrics(pred, gt)
+    assert m['completeness'] > 0.98
+    assert m['correctness'] == 1.0
+    assert m['apls'] < 0.85  # I cammini che attraversano l'interruzione mancano
+
+
+def test_empty_prediction():
+    gt = cross_roads()
+    m = topology_metrics(np.zeros_like(gt), gt)
+    assert m['counts'].tolist()[1:] == [0, 0, 0]
+    assert (m['completeness'], m['correctness'], m['quality']) == (0.0, 0.0, 0.0)
+    assert m['apls'] == 0.0  # Nessun cammino GT ritrovato
+
+
+def test_apls_undefined_without_paths():
+    empty = np.zeros(SHAPE, dtype=bool)
+    assert apls_score(empty, empty) is None
@@ -0,0 +1,163 @@
+"""
+TileCache (SQLite, LRU, contatori) e TileDownloader in modalità offline su una cache
+pre-popolata: nessuna richiesta di rete
+"""
+
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tile_cache  # noqa: E402
+from tile_cache import TileCache  # noqa: E402
+from tile_downloader import TileDownloader, is_valid_tile  # noqa: E402
+
+
+def tile_bytes(seed, fmt='PNG'):
+    """Tile 256x256 casuale codificato"""
+    rng = np.random.default_rng(seed)
+    buf = BytesIO()
+    Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+class NoNetwork:
+    """Sessione HTTP che fallisce il test se viene usata"""
+
+    def get(self, *args, **kwargs):
+        raise AssertionError("richiesta di rete in modalità offline")
+
+    def close(self):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class FakeSession:
+    """Sessione HTTP che restituisce sempre lo stesso corpo con status 200"""
+
+    def __init__(self, content):
+        self.content = content
+        self.requests = 0
+
+    def get(self, *args, **kwargs):
+        self.requests += 1
+        return FakeResponse(self.content)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Orologio della cache che avanza di 1s a ogni lettura: ordine LRU deterministico"""
+    now = [1000.0]
+
+    def tick():
+        now[0] += 1.0
+        return now[0]
+
+    monkeypatch.setattr(tile_cache.time, 'time', tick)
+
+
+def make_downloader(cache, offline=False, session=None, max_retries=1):
+    downloader = TileDownloader(url_template="http://tiles.invalid/{z}/{x}/{y}", max_workers=2,
+                                max_retries=max_retries, cache=cache, offline=offline)
+    downloader.session.close()
+    downloader.session = session if session is not None else NoNetwork()
+    return downloader
+
+
+def test_offline_fetch_from_seeded_cache(tmp_path):
+    path = str(tmp_path / "tiles.sqlite")
+    seeded = {(17, 100 + i, 200): tile_bytes(i) for i in range(3)}
+    cache = TileCache(path)
+    for (z, x, y), data in seeded.items():
+        cache.put(z, x, y, data)
+    cache.close()
+
+    # Cache riaperta da disco, come in una nuova esecuzione
+    cache = TileCache(path)
+    assert len(cache) == 3
+    assert cache.total_bytes == sum(len(d) for d in seeded.values())
+    downloader = make_downloader(cache, offline=True)
+    try:
+        for (z, x, y), data in seeded.items():
+            assert downloader.fetch_tile(z, x, y) == data
+        assert downloader.submit(17, 101, 200).result() == seeded[(17, 101, 200)]
+        assert downloader.fetch_tile(17, 999, 999) is None
+    finally:
+        downloader.close()
+        cache.close()
+
+    assert cache.hits == 4
+    assert cache.misses == 1
+    assert downloader.failed == 1
+    assert downloader.downloaded == 0
+
+
+def test_hit_miss_counters(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    data = tile_bytes(0)
+    assert cache.get(17, 1, 1) is None
+    cache.put(17, 1, 1, data)
+    assert cache.get(17, 1, 1) == data
+    assert cache.get(17, 1, 1) == data
+    assert cache.get(17, 2, 1) is None
+    assert (17, 1, 1) in cache and (17, 2, 1) not in cache  # __contains__ non tocca i contatori
+
+    stats = cache.stats()
+    cache.close()
+    assert (stats['hits'], stats['misses']) == (2, 2)
+    assert stats['hit_rate'] == 0.5
+    assert stats['evictions'] == 0
+
+
+def test_lru_eviction_at_size_bound(tmp_path, clock):
+    size = 1000
+    cache = TileCache(str(tmp_path / "tiles.sqlite"), max_bytes=4 * size)
+    for x in range(4):
+        cache.put(17, x, 0, bytes([x]) * size)
+    assert cache.total_bytes == 4 * size and cache.evictions == 0
+
+    cache.get(17, 0, 0)  # Il tile più vecchio diventa il più recente
+    cache.put(17, 4, 0, bytes([4]) * size)  # Oltre il limite: si scende sotto il 90%
+
+    present = sorted(x for x in range(5) if (17, x, 0) in cache)
+    total = cache.total_bytes
+    evictions = cache.evictions
+    cache.close()
+    assert present == [0, 3, 4]  # Eliminati i due meno recenti (1 e 2), non lo 0 appena letto
+    assert evictions == 2
+    assert total == 3 * size <= 0.9 * 4 * size
+
+
+def test_invalid_http_200_body_is_not_cached(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    png = tile_bytes(1)
+    bodies = [b"<html>Service unavailable</html>", png[:len(png) // 2], tile_bytes(2, 'JPEG')[:2000]]
+    for i, body in enumerate(bodies):
+        assert not is_valid_tile(body)
+        session = FakeSession(body)
+        downloader = make_downloader(cache, session=session, max_retries=1)
+        assert downloader.fetch_tile(17, i, 0) is None
+        downloader.close()
+        assert session.requests == 1
+        assert (17, i, 0) not in cache
+
+    session = FakeSession(png)
+    downloader = make_downloader(cache, session=session)
+    assert downloader.fetch_tile(17, 9, 0) == png
+    downloader.close()
+    cached = cache.get(17, 9, 0)
+    cache.close()
+    assert cached == png
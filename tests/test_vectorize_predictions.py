@@ -0,0 +1,148 @@
+"""
+vectorize_predictions: una strada dritta che attraversa il taglio tra bande
+(vectorize_region) o il bordo tra patch (snap_border_ends) deve uscire come una
+sola linea nelle coordinate georeferenziate corrette
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("geopandas")
+import shapely  # noqa: E402  # pyright: ignore[reportMissingModuleSource]
+
+from vectorize_predictions import snap_border_ends, vectorize_patches, vectorize_region  # noqa: E402
+
+DEG_PER_PX = 1e-5
+GEOTRANSFORM = [4.0, DEG_PER_PX, 0.0, 50.0, 0.0, -DEG_PER_PX]
+
+
+def draw_road(mask, start, end, half_width=2):
+    """Segmento (riga, colonna) → (riga, colonna) largo 2*half_width+1 pixel"""
+    (r0, c0), (r1, c1) = start, end
+    steps = int(max(abs(r1 - r0), abs(c1 - c0))) + 1
+    for t in np.linspace(0, 1, steps):
+        r, c = int(round(r0 + t * (r1 - r0))), int(round(c0 + t * (c1 - c0)))
+        mask[max(0, r - half_width):r + half_width + 1, max(0, c - half_width):c + half_width + 1] = 1
+    return mask
+
+
+def to_geo(row, col, geotransform=GEOTRANSFORM):
+    """Centro del pixel (riga, colonna) in WGS84"""
+    x0, dx, _, y0, _, dy = geotransform
+    return x0 + (col + 0.5) * dx, y0 + (row + 0.5) * dy
+
+
+def distance_to_segment(points, a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    t = np.clip(((points - a) @ (b - a)) / ((b - a) @ (b - a)), 0, 1)
+    return np.linalg.norm(points - (a + t[:, None] * (b - a)), axis=1)
+
+
+def assert_single_line_along(edges, nodes, start, end, geotransform=GEOTRANSFORM, tol_px=2.0, end_tol_px=6.0):
+    """Un solo arco con due estremi vicini a start/end e vertici sul segmento start-end"""
+    deg = geotransform[1]
+    assert len(edges) == 1
+    assert sorted(nodes['degree'].tolist()) == [1, 1]
+    coords = shapely.get_coordinates(edges.geometry.iloc[0])
+    a, b = np.array(to_geo(*start, geotransform)), np.array(to_geo(*end, geotransform))
+    assert distance_to_segment(coords, a, b).max() <= tol_px * deg
+    ends = sorted([coords[0], coords[-1]], key=lambda p: np.linalg.norm(p - a))
+    assert np.linalg.norm(ends[0] - a) <= end_tol_px * deg
+    assert np.linalg.norm(ends[1] - b) <= end_tol_px * deg
+
+
+def write_region(tmp_path, mask, geotransform=GEOTRANSFORM):
+    np.save(tmp_path / "region_mask.npy", mask)
+    metadata_path = tmp_path / "region.json"
+    with open(metadata_path, 'w') as f:
+        json.dump({'mask_file': "region_mask.npy", 'geotransform': geotransform}, f)
+    return str(metadata_path)
+
+
+@pytest.mark.parametrize("start, end", [((20, 100), (280, 100)), ((20, 20), (280, 180))])
+@pytest.mark.parametrize("band_px", [64, 100, 1000])
+def test_region_bands_stitched_into_one_line(tmp_path, start, end, band_px):
+    mask = draw_road(np.zeros((300, 200), dtype=np.uint8), start, end)
+    edges, nodes = vectorize_region(write_region(tmp_path, mask), band_px=band_px, margin_px=32)
+    assert_single_line_along(edges, nodes, start, end)
+
+
+def test_region_vertical_road_coordinates(tmp_path):
+    mask = np.zeros((300, 200), dtype=np.uint8)
+    mask[20:281, 98:103] = 1
+    edges, _ = vectorize_region(write_region(tmp_path, mask), band_px=100, margin_px=32)
+    coords = shapely.get_coordinates(edges.geometry.iloc[0])
+    np.testing.assert_allclose(coords[:, 0], 4.0 + 100.5 * DEG_PER_PX)  # Colonna centrale, centro pixel
+
+
+def write_patches(tmp_path, masks, bboxes):
+    items = []
+    for i, (mask, bbox) in enumerate(zip(masks, bboxes)):
+        path = str(tmp_path / f"strade_{i:04d}.png")
+        Image.fromarray(mask).save(path)
+        items.append((f"strade_{i:04d}", path, bbox))
+    return items
+
+
+@pytest.mark.parametrize("left_rows, right_rows", [((64, 64), (64, 64)), ((30, 64), (64, 98))])
+def test_road_across_patch_border_is_one_line(tmp_path, left_rows, right_rows):
+    size = 128
+    deg = size * DEG_PER_PX
+    bboxes = [[4.0, 50.0 - deg, 4.0 + deg, 50.0], [4.0 + deg, 50.0 - deg, 4.0 + 2 * deg, 50.0]]
+    left = draw_road(np.zeros((size, size), dtype=np.uint8), (left_rows[0], 0), (left_rows[1], size - 1))
+    right = draw_road(np.zeros((size, size), dtype=np.uint8), (right_rows[0], 0), (right_rows[1], size - 1))
+    edges, nodes = vectorize_patches(write_patches(tmp_path, [left, right], bboxes), num_workers=1)
+    # Nelle coordinate di un mosaico delle due patch affiancate
+    assert_single_line_along(edges, nodes, (left_rows[0], 0), (right_rows[1], 2 * size - 1))
+
+
+def test_parallel_roads_in_adjacent_patches_stay_separate(tmp_path):
+    size = 128
+    deg = size * DEG_PER_PX
+    bboxes = [[4.0, 50.0 - deg, 4.0 + deg, 50.0], [4.0 + deg, 50.0 - deg, 4.0 + 2 * deg, 50.0]]
+    masks = []
+    for _ in range(2):
+        mask = np.zeros((size, size), dtype=np.uint8)
+        draw_road(mask, (30, 0), (30, size - 1))
+        draw_road(mask, (90, 0), (90, size - 1))
+        masks.append(mask)
+    edges, nodes = vectorize_patches(write_patches(tmp_path, masks, bboxes), num_workers=1)
+    assert len(edges) == 2
+    assert sorted(nodes['degree'].tolist()) == [1, 1, 1, 1]
+
+
+def test_snap_border_ends_pairs_mutual_nearest_of_other_patches():
+    lines = shapely.linestrings([
+        [(0.0, 0.0), (9.0, 0.0)],    # patch 0, fine al bordo
+        [(10.0, 1.0), (20.0, 1.0)],  # patch 1, inizio al bordo: si aggancia alla linea 0
+        [(9.0, 5.0), (0.0, 5.0)],    # patch 0, inizio al bordo: si aggancia alla linea 3
+        [(10.0, 5.5), (20.0, 5.5)],  # patch 1
+        [(8.5, -0.5), (8.5, -9.0)],  # patch 0: il più vicino alla linea 0, ma della stessa patch
+    ])
+    border_ends = np.array([[False, True], [True, False], [True, False], [True, False], [True, False]])
+    patch_ids = np.array([0, 1, 0, 1, 0])
+    snapped = snap_border_ends(lines, border_ends, patch_ids, snap_dist=3.0)
+
+    coords = [shapely.get_coordinates(line) for line in snapped]
+    np.testing.assert_allclose(coords[0][-1], (9.5, 0.5))
+    np.testing.assert_allclose(coords[1][0], (9.5, 0.5))
+    np.testing.assert_allclose(coords[2][0], (9.5, 5.25))
+    np.testing.assert_allclose(coords[3][0], (9.5, 5.25))
+    np.testing.assert_allclose(coords[4][0], (8.5, -0.5))  # Il suo più vicino (linea 1) ha già un'altra coppia
+    # Gli estremi non di bordo restano dove sono
+    np.testing.assert_allclose(coords[0][0], (0.0, 0.0))
+    np.testing.assert_allclose(coords[1][-1], (20.0, 1.0))
+
+
+def test_snap_border_ends_respects_distance():
+    lines = shapely.linestrings([[(0.0, 0.0), (9.0, 0.0)], [(15.0, 0.0), (25.0, 0.0)]])
+    border_ends = np.array([[False, True], [True, False]])
+    snapped = snap_border_ends(lines, border_ends, np.array([0, 1]), snap_dist=3.0)
+    np.testing.assert_allclose(shapely.get_coordinates(snapped), shapely.get_coordinates(lines))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Cache persistente su disco per i tile satellitari (z/x/y)
+Store SQLite singolo file con evizione LRU limitata in dimensione e contatori hit/miss
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class TileCache:
+    """Cache z/x/y dei tile su SQLite con evizione LRU
+
+    I tile sono salvati come byte originali (JPEG/PNG del server), indicizzati per
+    (z, x, y) e con hash SHA-1 del contenuto. Quando la dimensione totale supera
+    max_bytes vengono eliminati i tile con accesso meno recente.
+
+    Args:
+        path: Percorso del file SQLite
+        max_bytes: Dimensione massima della cache in byte (None = illimitata)
+    """
+
+    def __init__(self, path, max_bytes=4 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            " z INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL,"
+            " sha1 TEXT NOT NULL, data BLOB NOT NULL, size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (z, x, y))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tiles_lru ON tiles (last_access)")
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()
+        self.total_bytes = int(row[0])
+
+    def get(self, z, x, y):
+        """Restituisce i byte del tile o None se non presente"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM tiles WHERE z=? AND x=? AND y=?", (z, x, y)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE tiles SET last_access=? WHERE z=? AND x=? AND y=?",
+                (time.time(), z, x, y),
+            )
+            self.hits += 1
+            return bytes(row[0])
+
+    def put(self, z, x, y, data):
+        """Salva un tile (sovrascrive se già presente) ed esegue l'evizione LRU"""
+        digest = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM tiles WHERE z=? AND x=? AND y=?", (z, x, y)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tiles (z, x, y, sha1, data, size, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (z, x, y, digest, sqlite3.Binary(data), len(data), time.time()),
+            )
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        """Elimina i tile meno usati finché la cache torna sotto il 90% del limite"""
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute(
+            "SELECT z, x, y, size FROM tiles ORDER BY last_access ASC"
+        )
+        to_delete = []
+        freed = 0
+        for z, x, y, size in rows:
+            if self.total_bytes - freed <= target:
+                break
+            to_delete.append((z, x, y))
+            freed += size
+        rows.close()
+        self._conn.executemany("DELETE FROM tiles WHERE z=? AND x=? AND y=?", to_delete)
+        self.total_bytes -= freed
+        self.evictions += len(to_delete)
+
+    def __contains__(self, key):
+        z, x, y = key
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM tiles WHERE z=? AND x=? AND y=?", (z, x, y)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def stats(self):
+        """Contatori della cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'evictions': self.evictions,
+            'size_mb': self.total_bytes / (1024**2),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
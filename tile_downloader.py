@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Download tile satellitari con sessione HTTP condivisa (keep-alive)
+Executor globale a concorrenza limitata e rate limiting per host
+"""
+
+import time
+import threading
+from io import BytesIO
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests  # pyright: ignore[reportMissingModuleSource]
+from requests.adapters import HTTPAdapter  # pyright: ignore[reportMissingModuleSource]
+from PIL import Image  # pyright: ignore[reportMissingImports]
+
+# ESRI World Imagery (nessuna API key richiesta)
+ARCGIS_TILE_URL = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+
+
+def is_valid_tile(data):
+    """True se i byte si decodificano per intero come immagine
+
+    Scarta pagine di errore e corpi troncati serviti con HTTP 200, che altrimenti
+    finirebbero nella cache persistente e verrebbero riproposti a ogni esecuzione.
+    """
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.load()
+        return True
+    except Exception:
+        return False
+
+
+class HostRateLimiter:
+    """Token bucket per host: max `rate` richieste/secondo con burst `burst`
+
+    Args:
+        rate: Richieste al secondo per host (None o <= 0 = nessun limite)
+        burst: Numero di richieste consentite a raffica
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate if rate and rate > 0 else None
+        self.burst = burst if burst else (max(1.0, self.rate) if self.rate else 1.0)
+        self._buckets = {}  # host -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def acquire(self, host):
+        """Blocca finché non è disponibile un token per l'host"""
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1.0:
+                    self._buckets[host] = (tokens - 1.0, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1.0 - tokens) / self.rate
+            time.sleep(wait)
+
+
+class TileDownloader:
+    """Scarica tile z/x/y con una sessione keep-alive e un executor condiviso
+
+    Un'unica istanza per processo: il throughput dipende da max_workers e non dal
+    numero di patch, e le connessioni TCP/TLS vengono riusate tra tile e patch.
+
+    Args:
+        url_template: Template URL con {z}, {x}, {y}
+        max_workers: Download concorrenti massimi (anche dimensione pool connessioni)
+        rate_per_host: Richieste/secondo massime per host (None = illimitato)
+        timeout: Timeout richiesta in secondi
+        max_retries: Tentativi per tile prima di arrendersi
+        cache: TileCache opzionale
+        offline: Se True usa solo la cache
+    """
+
+    def __init__(self, url_template=ARCGIS_TILE_URL, max_workers=16, rate_per_host=None,
+                 timeout=8, max_retries=2, cache=None, offline=False):
+        self.url_template = url_template
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.cache = cache
+        self.offline = offline
+        self.rate_limiter = HostRateLimiter(rate_per_host)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tile")
+
+        self.downloaded = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+
+    def fetch_tile(self, z, x, y):
+        """Restituisce i byte del tile (cache o rete) oppure None se tutti i tentativi falliscono
+
+        Una risposta 200 che non è un'immagine valida (is_valid_tile) conta come
+        tentativo fallito e non viene salvata in cache.
+        """
+        if self.cache is not None:
+            data = self.cache.get(z, x, y)
+            if data is not None:
+                return data
+
+        url = self.url_template.format(z=z, x=x, y=y)
+        host = urlsplit(url).netloc
+
+        for attempt in range(0 if self.offline else self.max_retries):
+            try:
+                self.rate_limiter.acquire(host)
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code == 200 and is_valid_tile(response.content):
+                    if self.cache is not None:
+                        self.cache.put(z, x, y, response.content)
+                    with self._counter_lock:
+                        self.downloaded += 1
+                    return response.content
+                elif attempt < self.max_retries - 1:
+                    time.sleep(0.3 * (attempt + 1))  # backoff: 0.3s, 0.6s
+            except Exception:
+                if attempt < self.max_retries - 1:
+                    time.sleep(0.3 * (attempt + 1))
+
+        with self._counter_lock:
+            self.failed += 1
+        return None
+
+    def submit(self, z, x, y):
+        """Accoda il download di un tile sull'executor condiviso (restituisce un Future)"""
+        return self.executor.submit(self.fetch_tile, z, x, y)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
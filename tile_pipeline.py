@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Motore asyncio per il download dei tile con più patch in volo
+Deduplica i tile condivisi tra patch vicine e consegna le immagini composite
+in ordine a una coda di validazione/render (con backpressure)
+"""
+
+import queue
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+_SENTINEL = object()
+
+
+class AsyncTileFetcher:
+    """Fetch asincrono dei tile sopra un TileDownloader
+
+    Lo stesso tile richiesto da più patch contemporaneamente viene scaricato una sola
+    volta (future condiviso); i tile appena scaricati restano in un piccolo LRU in
+    memoria per le patch vicine successive. Retry, backoff e cache su disco restano
+    quelli del TileDownloader; un tile fallito vale None (→ nero in composizione).
+
+    La validazione è a stadi: tile_check_fn viene chiamata prima di scaricare e a ogni
+    tile fallito; se la patch è già sicuramente da scartare, i download ancora in coda
+    che nessun'altra patch aspetta vengono cancellati e non si compone nulla.
+
+    Args:
+        downloader: TileDownloader condiviso
+        tile_grid_fn: f(bbox, zoom) → (tile_x, tile_y, [(dx, dy), ...])
+        compose_fn: f(bbox, zoom, tile_x, tile_y, tiles, size) → (PIL.Image o None, motivo scarto o None)
+        tile_check_fn: f(bbox, zoom, tile_x, tile_y, missing) → motivo scarto o None (opzionale)
+        memory_tiles: Numero di tile recenti tenuti in memoria
+        compose_workers: Thread per composizione/crop/resize
+    """
+
+    def __init__(self, downloader, tile_grid_fn, compose_fn, tile_check_fn=None, memory_tiles=1024, compose_workers=2):
+        self.downloader = downloader
+        self.tile_grid_fn = tile_grid_fn
+        self.compose_fn = compose_fn
+        self.tile_check_fn = tile_check_fn
+        self.memory_tiles = memory_tiles
+        self.dedup_hits = 0
+        self.early_rejects = 0
+        self.cancelled_tiles = 0
+        self._pending = {}
+        self._waiters = {}
+        self._recent = OrderedDict()
+        self._compose_executor = ThreadPoolExecutor(max_workers=compose_workers, thread_name_prefix="compose")
+
+    async def fetch_tile(self, z, x, y):
+        """Restituisce i byte del tile (o None), condividendo i download in corso"""
+        key = (z, x, y)
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            self.dedup_hits += 1
+            return self._recent[key]
+
+        future = self._pending.get(key)
+        if future is None or future.cancelled():
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.downloader.executor, self.downloader.fetch_tile, z, x, y)
+            self._pending[key] = future
+            future.add_done_callback(lambda f, key=key: self._remember(key, f))
+        else:
+            self.dedup_hits += 1
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Nessun'altra patch aspetta questo tile: annulla il download se non è ancora partito
+            if self._waiters.get(key, 0) <= 1 and not future.done():
+                future.cancel()
+                self.cancelled_tiles += 1
+            raise
+        finally:
+            remaining = self._waiters.get(key, 1) - 1
+            if remaining > 0:
+                self._waiters[key] = remaining
+            else:
+                self._waiters.pop(key, None)
+
+    def _remember(self, key, future):
+        if self._pending.get(key) is future:
+            self._pending.pop(key)
+        if future.cancelled() or future.exception() is not None:
+            return
+        data = future.result()
+        if data is None:
+            return  # Non memorizzare i fallimenti: una patch successiva può ritentare
+        self._recent[key] = data
+        while len(self._recent) > self.memory_tiles:
+            self._recent.popitem(last=False)
+
+    async def fetch_patch(self, bbox, zoom=17, size=512):
+        """Scarica i tile di una patch in parallelo e restituisce (immagine composita, motivo scarto)
+
+        Se la patch viene scartata prima della composizione l'immagine è None.
+        """
+        tile_x, tile_y, coords = self.tile_grid_fn(bbox, zoom)
+        missing = set()
+
+        # Stadio 0: geometria (parti del bbox fuori dal mosaico 3x3), prima di scaricare
+        if self.tile_check_fn is not None:
+            reason = self.tile_check_fn(bbox, zoom, tile_x, tile_y, missing)
+            if reason is not None:
+                self.early_rejects += 1
+                return None, reason
+
+        # Stadio 1: tile falliti, controllati appena arrivano
+        tasks = {asyncio.ensure_future(self.fetch_tile(zoom, tile_x + dx, tile_y + dy)): (dx, dy)
+                 for dx, dy in coords}
+        results = {}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                new_missing = False
+                for task in done:
+                    data = task.result()
+                    results[tasks[task]] = data
+                    if data is None:
+                        missing.add(tasks[task])
+                        new_missing = True
+                if new_missing and self.tile_check_fn is not None:
+                    reason = self.tile_check_fn(bbox, zoom, tile_x, tile_y, missing)
+                    if reason is not None:
+                        self.early_rejects += 1
+                        return None, reason
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # Stadio 2: composizione (con eventuali controlli prima del resize)
+        tiles = [(dx, dy, results[(dx, dy)]) for dx, dy in coords]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._compose_executor, self.compose_fn,
+                                          bbox, zoom, tile_x, tile_y, tiles, size)
+
+    def close(self):
+        self._compose_executor.shutdown(wait=True)
+
+
+class PatchPipeline:
+    """Pipeline candidati → download (N patch in volo) → coda di validazione/render
+
+    Il ciclo asyncio gira in un thread in background; l'iterazione restituisce
+    (candidate, sat_img, reject_reason) nello stesso ordine dei candidati, quindi il
+    risultato non dipende dalla latenza di rete. Candidati con bbox None (nessuna
+    patch trovata) o scartati in anticipo passano con sat_img None.
+
+    Args:
+        candidates: Iteratore di (bbox, roads_in_patch, center)
+        fetcher: AsyncTileFetcher
+        zoom: Livello zoom tile
+        size: Dimensione immagine finale
+        in_flight: Numero massimo di patch in download contemporaneamente
+        fetch: Se False non scarica nulla (sat_img sempre None)
+    """
+
+    def __init__(self, candidates, fetcher, zoom=17, size=512, in_flight=8, fetch=True):
+        self.candidates = candidates
+        self.fetcher = fetcher
+        self.zoom = zoom
+        self.size = size
+        self.in_flight = max(1, in_flight)
+        self.fetch = fetch
+        self._queue = queue.Queue(maxsize=self.in_flight)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = None
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._thread_main, name="patch-pipeline", daemon=True)
+        self._thread.start()
+        while True:
+            item = self._queue.get()
+            if item is _SENTINEL:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def _thread_main(self):
+        try:
+            asyncio.run(self._run())
+        except BaseException as e:  # Propaga l'errore al thread principale
+            self._error = e
+        finally:
+            self._put(_SENTINEL, force=True)
+
+    async def _run(self):
+        window = deque()
+        try:
+            for candidate in self.candidates:
+                if self._stop.is_set():
+                    break
+                bbox = candidate[0]
+                if self.fetch and bbox is not None:
+                    task = asyncio.ensure_future(self.fetcher.fetch_patch(bbox, self.zoom, self.size))
+                else:
+                    task = None
+                window.append((candidate, task))
+                if len(window) >= self.in_flight:
+                    await self._emit(window.popleft())
+            while window and not self._stop.is_set():
+                await self._emit(window.popleft())
+        finally:
+            for _, task in window:
+                if task is not None:
+                    task.cancel()
+
+    async def _emit(self, item):
+        candidate, task = item
+        sat_img, reason = await task if task is not None else (None, None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._put, (candidate, sat_img, reason))
+
+    def _put(self, item, force=False):
+        """Put bloccante con backpressure; rinuncia se la pipeline è stata chiusa"""
+        while True:
+            if self._stop.is_set() and not force:
+                return False
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if force and self._stop.is_set():
+                    # Consumatore chiuso: svuota per far passare la sentinella
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def close(self):
+        """Ferma la pipeline (i download in corso vengono cancellati) e attende il thread"""
+        self._stop.set()
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+        self.fetcher.close()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Vettorizzazione delle maschere predette in una rete stradale georeferenziata
+Maschera → scheletro → nodi/archi (road_graph.vectorize_skeleton) → semplificazione →
+coordinate WGS84 dal bbox della patch (journal di generazione) o dal geotransform del
+mosaico di predict_region.py. Le reti delle patch adiacenti vengono unite in una sola:
+gli estremi che toccano il bordo della patch vengono agganciati a quelli delle patch
+vicine, poi le linee sono nodate e fuse.
+
+Output: GeoPackage con layer 'lines' (archi, come il layer lines dell'OSM usato da
+made_dataset.py) e 'nodes' (incroci ed estremi con il loro grado).
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import geopandas as gpd  # pyright: ignore[reportMissingModuleSource]
+import shapely  # pyright: ignore[reportMissingModuleSource]
+from PIL import Image  # pyright: ignore[reportMissingImports]
+from scipy.spatial import cKDTree  # pyright: ignore[reportMissingImports]
+from concurrent.futures import ProcessPoolExecutor
+
+from road_graph import skeletonize, vectorize_skeleton
+from generation_journal import GenerationJournal
+
+# ========== CONFIGURAZIONE ==========
+dataset_name = "Dataset001_Strade"
+fold = 0
+raw_data_dir = f"/workspace/nnUNet_raw/{dataset_name}"  # Journal con i bbox delle patch
+predictions_dir = f"/workspace/nnUNet_results/{dataset_name}/nnUNetTrainer__nnUNetPlans__2d/fold_{fold}/validation"
+output_file = "/workspace/risultati/road_network.gpkg"
+
+NUM_WORKERS = os.cpu_count() or 1  # 1 = tutto nel processo principale
+MIN_SPUR_PX = 10  # Rami morti, segmenti isolati e cappi più corti vengono scartati (pixel)
+SIMPLIFY_PX = 1.5  # Tolleranza Douglas-Peucker (pixel)
+BORDER_PX = 16  # Estremi entro questa distanza dal bordo della patch possono agganciarsi alle vicine
+SNAP_PX = 48  # Distanza massima (pixel) tra estremi di patch diverse da unire (strade oblique sul bordo)
+REGION_BAND_PX = 2048  # Righe del mosaico vettorizzate insieme (memoria ∝ banda × larghezza)
+REGION_MARGIN_PX = 64  # Righe extra sopra/sotto ogni banda: lo scheletro al taglio è quello del mosaico intero
+# ========================================
+
+
+def patch_geotransform(bbox, shape):
+    """Geotransform GDAL [x0, dx, 0, y0, 0, -dy] di una patch (bbox WGS84 su shape (H, W))"""
+    h, w = shape[:2]
+    return [bbox[0], (bbox[2] - bbox[0]) / w, 0.0, bbox[3], 0.0, -(bbox[3] - bbox[1]) / h]
+
+
+def load_patch_bboxes(dataset_dir):
+    """Bbox delle patch dal journal di generazione
+
+    Returns:
+        dict nome patch (es. 'strade_0000') → [minx, miny, maxx, maxy]
+    """
+    path = os.path.join(dataset_dir, GenerationJournal.LOG_FILE)
+    bboxes = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                bboxes[entry['name']] = entry['bbox']
+    return bboxes
+
+
+def skeleton_lines(mask, min_spur_px=MIN_SPUR_PX):
+    """Archi dello scheletro di una maschera come LineString in pixel (x = colonna, y = riga, centro del pixel)
+
+    Returns:
+        (lines, graph): array di LineString e grafo di road_graph.vectorize_skeleton
+    """
+    graph = vectorize_skeleton(skeletonize(mask), min_spur_px=min_spur_px)
+    n_edges = len(graph['edge_u'])
+    if n_edges == 0:
+        return np.empty(0, dtype=object), graph
+    xy = graph['edge_coords'][:, ::-1] + 0.5
+    edge_index = np.repeat(np.arange(n_edges), np.diff(graph['edge_offsets']))
+    return shapely.linestrings(xy, indices=edge_index), graph
+
+
+def georeference(lines, geotransform):
+    """Linee da pixel a WGS84 con un geotransform GDAL"""
+    a, b, c, d, e, f = geotransform
+    return shapely.transform(lines, lambda p: np.stack([a + p[:, 0] * b + p[:, 1] * c,
+                                                        d + p[:, 0] * e + p[:, 1] * f], axis=1))
+
+
+def vectorize_mask(mask, geotransform, min_spur_px=MIN_SPUR_PX, simplify_px=SIMPLIFY_PX, border_px=BORDER_PX):
+    """Linee georeferenziate di una maschera
+
+    Returns:
+        (lines, border_ends): array di LineString WGS84 e array (n, 2) bool che indica
+        se l'inizio/la fine di ogni linea è un estremo libero vicino al bordo della maschera
+    """
+    h, w = mask.shape[:2]
+    lines, graph = skeleton_lines(mask, min_spur_px)
+    if len(lines) == 0:
+        return lines, np.zeros((0, 2), dtype=bool)
+
+    # Geometrie in pixel semplificate tutte insieme
+    if simplify_px:
+        lines = shapely.simplify(lines, simplify_px, preserve_topology=False)
+    lines = georeference(lines, geotransform)
+
+    rc = graph['node_coords']
+    near_border = ((rc[:, 0] < border_px) | (rc[:, 0] >= h - 1 - border_px) |
+                   (rc[:, 1] < border_px) | (rc[:, 1] >= w - 1 - border_px))
+    free_end = near_border & (graph['node_degree'] == 1)
+    border_ends = np.stack([free_end[graph['edge_u']], free_end[graph['edge_v']]], axis=1)
+    return lines, border_ends
+
+
+def vectorize_patch(item):
+    """Worker: (nome, percorso predizione, bbox) → (nome, linee, estremi di bordo)"""
+    name, pred_path, bbox = item
+    mask = np.array(Image.open(pred_path)) > 0
+    lines, border_ends = vectorize_mask(mask, patch_geotransform(bbox, mask.shape))
+    return name, lines, border_ends
+
+
+def snap_border_ends(lines, border_ends, patch_ids, snap_dist, k=8):
+    """Unisce gli estremi di bordo di patch diverse (coppie di vicini più prossimi reciproci)
+
+    Una strada che attraversa il bordo tra due patch termina in entrambe poco prima del
+    bordo; se attraversa in obliquo i due estremi possono distare decine di pixel lungo
+    il bordo, quindi si accoppiano solo estremi che sono l'uno il più vicino dell'altro
+    (tra quelli di altre patch entro snap_dist) e li si sposta nel loro punto medio.
+    """
+    coords, index = shapely.get_coordinates(lines, return_index=True)
+    counts = np.bincount(index, minlength=len(lines))
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ends = np.stack([first, first + counts - 1], axis=1)  # posizione in coords di inizio/fine
+
+    positions = ends[border_ends]
+    owners = np.broadcast_to(patch_ids[:, None], border_ends.shape)[border_ends]
+    n = len(positions)
+    if n > 1:
+        points = coords[positions]
+        k = min(k + 1, n)
+        dist, nearest = cKDTree(points).query(points, k=k, distance_upper_bound=snap_dist)
+        valid = np.isfinite(dist)
+        candidates = np.where(valid, nearest, 0)
+        valid &= owners[candidates] != owners[:, None]
+        # Primo vicino valido di ogni estremo (le distanze sono già ordinate)
+        has = valid.any(axis=1)
+        best = np.where(has, candidates[np.arange(n), valid.argmax(axis=1)], -1)
+        mutual = has & (best[np.maximum(best, 0)] == np.arange(n)) & (np.arange(n) < best)
+        a, b = np.flatnonzero(mutual), best[mutual]
+        midpoint = (points[a] + points[b]) / 2
+        coords[positions[a]] = midpoint
+        coords[positions[b]] = midpoint
+    return shapely.linestrings(coords, indices=index)
+
+
+def build_network(lines):
+    """Noda e fonde le linee: archi (con nodi u, v) e nodi (con grado)
+
+    Returns:
+        (edges, nodes): GeoDataFrame EPSG:4326
+    """
+    merged = shapely.line_merge(shapely.union_all(lines))
+    edges = shapely.get_parts(merged)
+    edges = edges[~shapely.is_empty(edges)]
+    endpoints = np.concatenate([shapely.get_coordinates(shapely.get_point(edges, 0)),
+                                shapely.get_coordinates(shapely.get_point(edges, -1))])
+    node_xy, inverse = np.unique(np.round(endpoints, 9), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    u, v = inverse[:len(edges)], inverse[len(edges):]
+
+    edges_gdf = gpd.GeoDataFrame({'u': u, 'v': v}, geometry=edges, crs='EPSG:4326')
+    if len(edges_gdf):
+        edges_gdf['length_m'] = edges_gdf.to_crs(edges_gdf.estimate_utm_crs()).length.round(2)
+    else:
+        edges_gdf['length_m'] = np.zeros(0)
+    nodes_gdf = gpd.GeoDataFrame({'degree': np.bincount(inverse, minlength=len(node_xy))},
+                                 geometry=shapely.points(node_xy), crs='EPSG:4326')
+    return edges_gdf, nodes_gdf
+
+
+def write_network(edges, nodes, path):
+    """Scrive i layer 'lines' e 'nodes' in un GeoPackage (file temporaneo + rename)"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp.gpkg"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    edges.to_file(tmp_path, layer='lines', driver='GPKG')
+    nodes.to_file(tmp_path, layer='nodes', driver='GPKG')
+    os.replace(tmp_path, path)
+
+
+def vectorize_patches(items, num_workers=NUM_WORKERS, snap_px=SNAP_PX):
+    """Vettorizza le patch (nome, percorso, bbox) e unisce le reti
+
+    Returns:
+        (edges, nodes) GeoDataFrame EPSG:4326
+    """
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        results = (executor.map(vectorize_patch, items, chunksize=max(1, len(items) // (num_workers * 8)))
+                   if executor is not None else map(vectorize_patch, items))
+        all_lines, all_ends, patch_ids = [], [], []
+        for i, (name, lines, border_ends) in enumerate(results):
+            all_lines.append(lines)
+            all_ends.append(border_ends)
+            patch_ids.append(np.full(len(lines), i))
+            if (i + 1) % 500 == 0:
+                print(f"   {i + 1}/{len(items)} patch")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    lines = np.concatenate(all_lines) if all_lines else np.empty(0, dtype=object)
+    if len(lines) == 0:
+        return build_network(lines)
+    border_ends = np.concatenate(all_ends)
+    patch_ids = np.concatenate(patch_ids)
+
+    # Tolleranza di aggancio in gradi dalla risoluzione media delle patch
+    deg_per_px = np.mean([(bbox[2] - bbox[0]) / Image.open(path).width for _, path, bbox in items[:50]])
+    lines = snap_border_ends(lines, border_ends, patch_ids, snap_px * deg_per_px)
+    return build_network(lines)
+
+
+def vectorize_region(metadata_path, band_px=REGION_BAND_PX, margin_px=REGION_MARGIN_PX,
+                     min_spur_px=MIN_SPUR_PX, simplify_px=SIMPLIFY_PX):
+    """Vettorizza il mosaico di predict_region.py (<name>.json + <name>_mask.npy) a bande di righe
+
+    Ogni banda è letta dal memmap con margin_px righe in più per lato, scheletrizzata e
+    ritagliata alle sue righe in coordinate pixel globali prima della semplificazione: i
+    segmenti che attraversano il taglio sono gli stessi nelle due bande adiacenti e
+    vengono tagliati nello stesso punto, quindi build_network (union_all + line_merge)
+    li ricongiunge. In memoria c'è una sola banda alla volta.
+
+    Returns:
+        (edges, nodes) GeoDataFrame EPSG:4326
+    """
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+    mask = np.load(os.path.join(os.path.dirname(metadata_path), metadata['mask_file']), mmap_mode='r')
+    h, w = mask.shape
+    all_lines = []
+    for top in range(0, h, band_px):
+        bottom = min(h, top + band_px)
+        r0, r1 = max(0, top - margin_px), min(h, bottom + margin_px)
+        lines, _ = skeleton_lines(np.asarray(mask[r0:r1]) > 0, min_spur_px)
+        if len(lines) == 0:
+            continue
+        lines = shapely.transform(lines, lambda p: p + np.array([0.0, r0]))
+        lines = shapely.clip_by_rect(lines, 0, top, w, bottom)
+        lines = lines[~shapely.is_empty(lines)]
+        if simplify_px:
+            lines = shapely.simplify(lines, simplify_px, preserve_topology=False)
+        all_lines.append(georeference(lines, metadata['geotransform']))
+        print(f"   Righe {bottom}/{h}")
+    lines = np.concatenate(all_lines) if all_lines else np.empty(0, dtype=object)
+    return build_network(lines)
+
+
+def main(region_metadata=None):
+    print("\n" + "="*60)
+    print("🛣️  VETTORIZZAZIONE RETE STRADALE")
+    print("="*60 + "\n")
+    start = time.time()
+
+    if region_metadata:
+        print(f"🗺️  Mosaico: {region_metadata}")
+        edges, nodes = vectorize_region(region_metadata)
+        n_patches = None
+    else:
+        if not os.path.exists(predictions_dir):
+            print(f"❌ Cartella predizioni non trovata: {predictions_dir}")
+            sys.exit(1)
+        bboxes = load_patch_bboxes(raw_data_dir)
+        pred_files = sorted(f for f in os.listdir(predictions_dir) if f.endswith('.png'))
+        items = [(f[:-4], os.path.join(predictions_dir, f), bboxes[f[:-4]]) for f in pred_files if f[:-4] in bboxes]
+        missing = len(pred_files) - len(items)
+        print(f"📊 {len(items)} predizioni con bbox ({NUM_WORKERS} processi)")
+        if missing:
+            print(f"   ⚠️  {missing} predizioni senza bbox nel journal (ignorate)")
+        edges, nodes = vectorize_patches(items)
+        n_patches = len(items)
+
+    write_network(edges, nodes, output_file)
+    elapsed = time.time() - start
+    print(f"\n✅ {len(edges)} archi, {len(nodes)} nodi, {edges['length_m'].sum() / 1000:.1f} km")
+    if n_patches:
+        print(f"   {n_patches / elapsed * 60:.0f} patch/minuto ({elapsed:.1f}s)")
+    print(f"   Salvato in: {output_file}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Vettorizza le maschere predette in una rete stradale')
+    parser.add_argument('--region', type=str, help='JSON di un mosaico di predict_region.py (invece delle patch)')
+    parser.add_argument('--output', type=str, help='GeoPackage di output (default: output_file)')
+    args = parser.parse_args()
+    if args.output:
+        output_file = args.output
+    main(args.region)
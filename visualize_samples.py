@@ -11,15 +11,28 @@ from PIL import Image
 import matplotlib.pyplot as plt
 from pathlib import Path
 
+from array_store import ArrayStore
+
 # Configurazione
 dataset_dir = "/workspace/nnUNet_raw/Dataset001_Strade"
 images_dir = os.path.join(dataset_dir, "imagesTr")
 labels_dir = os.path.join(dataset_dir, "labelsTr")
 labels_viz_dir = os.path.join(dataset_dir, "labelsTr_viz")
 num_samples = 4  # Numero di campioni da visualizzare
+store = ArrayStore.open(dataset_dir)  # Store a shard .npy (None se la generazione non l'ha prodotto)
+
+def num_dataset_samples():
+    """Numero di campioni (dallo store se presente, altrimenti file in imagesTr)"""
+    if store is not None:
+        return len(store)
+    return len(os.listdir(images_dir))
 
 def load_sample(idx):
-    """Carica immagine e label per un indice specifico"""
+    """Carica immagine e label per un indice specifico (dallo store se presente, altrimenti PNG)"""
+    if store is not None and f"strade_{idx:04d}" in store:
+        img, label = store.get(f"strade_{idx:04d}")
+        return img, label, label * np.uint8(255)
+    
     img_name = f"strade_{idx:04d}_0000.png"
     lbl_name = f"strade_{idx:04d}.png"
     
@@ -49,8 +62,7 @@ def visualize_samples(indices=None, save_path=None):
     """Visualizza campioni del dataset"""
     if indices is None:
         # Seleziona campioni casuali
-        all_files = sorted(os.listdir(images_dir))
-        max_idx = len(all_files) - 1
+        max_idx = num_dataset_samples() - 1
         indices = random.sample(range(max_idx + 1), min(num_samples, max_idx + 1))
     
     n_samples = len(indices)
@@ -109,19 +121,31 @@ def print_dataset_stats():
     print("📊 STATISTICHE DATASET001_STRADE")
     print("="*60)
     
-    # Conta file
-    n_images = len([f for f in os.listdir(images_dir) if f.endswith('.png')])
-    n_labels = len([f for f in os.listdir(labels_dir) if f.endswith('.png')])
-    
-    print(f"\n📁 File:")
-    print(f"  • Immagini: {n_images}")
-    print(f"  • Label: {n_labels}")
-    
-    # Dimensione totale
-    images_size = sum(os.path.getsize(os.path.join(images_dir, f)) 
-                     for f in os.listdir(images_dir)) / (1024**2)
-    labels_size = sum(os.path.getsize(os.path.join(labels_dir, f)) 
-                     for f in os.listdir(labels_dir)) / (1024**2)
+    if store is not None:
+        # Store a shard: conteggio dall'indice, spazio occupato dagli shard .npy
+        # (st_blocks: l'ultimo shard è preallocato ma scritto solo in parte)
+        n_images = n_labels = len(store)
+        print(f"\n📦 Store: {store.store_dir} (shard da {store.shard_size} campioni)")
+        print(f"  • Campioni: {n_images}")
+        shard_files = os.listdir(store.store_dir)
+        images_size = sum(os.stat(os.path.join(store.store_dir, f)).st_blocks * 512
+                          for f in shard_files if f.startswith('images_')) / (1024**2)
+        labels_size = sum(os.stat(os.path.join(store.store_dir, f)).st_blocks * 512
+                          for f in shard_files if f.startswith('labels_')) / (1024**2)
+    else:
+        # Conta file
+        n_images = len([f for f in os.listdir(images_dir) if f.endswith('.png')])
+        n_labels = len([f for f in os.listdir(labels_dir) if f.endswith('.png')])
+        
+        print(f"\n📁 File:")
+        print(f"  • Immagini: {n_images}")
+        print(f"  • Label: {n_labels}")
+        
+        # Dimensione totale
+        images_size = sum(os.path.getsize(os.path.join(images_dir, f)) 
+                         for f in os.listdir(images_dir)) / (1024**2)
+        labels_size = sum(os.path.getsize(os.path.join(labels_dir, f)) 
+                         for f in os.listdir(labels_dir)) / (1024**2)
     
     print(f"\n💾 Dimensioni:")
     print(f"  • Immagini: {images_size:.1f} MB")
@@ -172,8 +196,7 @@ if __name__ == "__main__":
             print(f"Campioni selezionati: {indices}")
         else:
             # Seleziona casuali
-            all_files = sorted(os.listdir(images_dir))
-            max_idx = len(all_files) - 1
+            max_idx = num_dataset_samples() - 1
             indices = random.sample(range(max_idx + 1), min(num_samples, max_idx + 1))
             print(f"Campioni casuali: {indices}")
         